@@ -1,17 +1,191 @@
 """Base class for Telegram bot plugins."""
 
+import asyncio
+import signal
+import time
 from abc import ABC, abstractmethod
-from telegram.ext import Application
+from collections import deque
+from typing import Any, Awaitable, Dict, List
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor
+from store.clients import registry
+from store.db import TelegramStore, AsyncMongoManager, WriteBuffer
+from store.journal import Journal
+from store.persistence import StorePersistence
+from store.sqlite import SQLiteManager
 import logging
 
 
+class _Lane:
+    """The updates of one user, waiting or running."""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """PerUserUpdateProcessor runs the updates of different users in
+    parallel, and the updates of the same user one after the other, in the
+    order they arrived.
+
+    Handlers like Lipok's handle_button read and write context.user_data,
+    and rely on the user's previous update having been handled. Updates
+    without a user are ordered per chat, updates without either run
+    unordered.
+
+    At most workers updates run at a time, and at most max_queued more are
+    queued, either for a worker or behind an earlier update of their user.
+    This doesn't bound the application's backlog: PTB starts a task for
+    every update as soon as it takes it off its update queue, and the
+    updates past workers + max_queued wait in those tasks, unbounded, to be
+    let in, in the order they arrived. max_queued only bounds the updates
+    holding a user's lane, and the queued count in stats().
+    """
+
+    def __init__(self, workers: int, max_queued: int = 10000, window: int = 1000):
+        super().__init__(max_concurrent_updates=workers + max_queued)
+        self.workers = workers
+        self._workers = asyncio.Semaphore(workers)
+        self._lanes: Dict[Any, _Lane] = {}
+        self._waits = deque(maxlen=window)
+        self.running = 0
+        self.queued = 0
+        self.peak_queued = 0
+        self.processed = 0
+
+    @staticmethod
+    def ordering_key(update: object) -> Any:
+        """Returns the key whose updates are run in order, or None."""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return ("user", update.effective_user.id)
+        if update.effective_chat:
+            return ("chat", update.effective_chat.id)
+        return None
+
+    async def _run(self, coroutine: Awaitable[Any], queued_at: float) -> None:
+        async with self._workers:
+            self.queued -= 1
+            self.running += 1
+            self._waits.append(time.monotonic() - queued_at)
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+                self.processed += 1
+
+    async def do_process_update(
+            self, update: object, coroutine: Awaitable[Any]) -> None:
+        queued_at = time.monotonic()
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        key = self.ordering_key(update)
+        if key is None:
+            await self._run(coroutine, queued_at)
+            return
+        # asyncio locks are fair, updates get the lock of their user in the
+        # order they arrived.
+        lane = self._lanes.setdefault(key, _Lane())
+        lane.pending += 1
+        try:
+            async with lane.lock:
+                await self._run(coroutine, queued_at)
+        finally:
+            lane.pending -= 1
+            if not lane.pending:
+                del self._lanes[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the number of running and queued updates, the peak queue
+        depth, the number of users with queued or running updates, and the
+        p50, p99 and max time the recent updates were queued, in ms."""
+        waits = sorted(self._waits)
+        stats = {
+            "workers": self.workers,
+            "running": self.running,
+            "queued": self.queued,
+            "peak_queued": self.peak_queued,
+            "users": len(self._lanes),
+            "processed": self.processed,
+        }
+        for name, p in [("p50", 0.5), ("p99", 0.99)]:
+            stats[f"queue_wait_{name}_ms"] = (
+                waits[min(len(waits) - 1, int(len(waits) * p))] * 1000
+                if waits else 0.0)
+        stats["queue_wait_max_ms"] = waits[-1] * 1000 if waits else 0.0
+        return stats
+
+
 class BaseBot(ABC):
-    def __init__(self, api_key, host, port, bot_name, **kwargs):
+    def __init__(
+            self,
+            api_key,
+            host,
+            port,
+            bot_name,
+            buffer_size=0,
+            buffer_delay=1.0,
+            journal_path="",
+            store="mongo",
+            sqlite_path="",
+            timeseries_metadata=False,
+            update_ttl_days=0,
+            full_updates=False,
+            updates_durability="relaxed",
+            metadata_durability="journaled",
+            mongo_max_pool_size=50,
+            mongo_min_pool_size=4,
+            mode="polling",
+            webhook_listen="127.0.0.1",
+            webhook_port=8443,
+            webhook_url="",
+            webhook_secret="",
+            webhook_max_connections=40,
+            concurrent_updates=1,
+            bot_api_url="",
+            persist_user_data=False,
+            persistence_interval=5.0,
+            **kwargs):
         self.api_key = api_key
         self.host = host
         self.port = port
         self.bot_name = bot_name
-        self.app = Application.builder().token(api_key).build()
+        self.buffer_size = buffer_size
+        self.buffer_delay = buffer_delay
+        self.journal_path = journal_path
+        self.store = store
+        self.sqlite_path = sqlite_path
+        self.timeseries_metadata = timeseries_metadata
+        self.update_ttl_days = update_ttl_days
+        self.full_updates = full_updates
+        self.updates_durability = updates_durability
+        self.metadata_durability = metadata_durability
+        self.mongo_max_pool_size = mongo_max_pool_size
+        self.mongo_min_pool_size = mongo_min_pool_size
+        self.mode = mode
+        self.webhook_listen = webhook_listen
+        self.webhook_port = webhook_port
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.webhook_max_connections = webhook_max_connections
+        builder = Application.builder().token(api_key)
+        if bot_api_url:
+            builder = builder.base_url(bot_api_url)
+        if concurrent_updates > 1:
+            builder = builder.concurrent_updates(
+                PerUserUpdateProcessor(concurrent_updates))
+        if persist_user_data:
+            builder = builder.persistence(
+                StorePersistence(update_interval=persistence_interval))
+        self.app = builder.build()
         self.logger = logging.getLogger(self.__class__.__name__)
 
     @abstractmethod
@@ -19,8 +193,153 @@ class BaseBot(ABC):
         """Setup bot-specific command handlers"""
         pass
 
+    def setup_store(self) -> TelegramStore:
+        """Initializes the bot's TelegramStore, used by the handlers.
+
+        The store is backed by mongo at host:port, or, if store is "sqlite",
+        by the SQLite file at sqlite_path (<bot_name>.sqlite3 by default).
+        Mongo clients come from the process-wide store.clients.registry,
+        with pools of mongo_min_pool_size to mongo_max_pool_size
+        connections.
+
+        If buffer_size is set, inserts are batched in a WriteBuffer that is
+        flushed every buffer_size writes or buffer_delay seconds. If
+        journal_path is set, inserts are instead appended to a Journal at
+        that path and replayed into mongo in the background.
+
+        Updates are written with the updates_durability profile, metadata
+        and rollups with metadata_durability, see
+        TelegramStore.write_concerns.
+        """
+        if self.store == "sqlite":
+            db_manager = SQLiteManager(
+                self.sqlite_path or f"{self.bot_name}.sqlite3")
+        else:
+            registry.configure(
+                maxPoolSize=self.mongo_max_pool_size,
+                minPoolSize=self.mongo_min_pool_size)
+            db_manager = AsyncMongoManager(f"mongodb://{self.host}:{self.port}")
+        write_buffer = None
+        if self.buffer_size > 0:
+            write_buffer = WriteBuffer(
+                db_manager,
+                max_size=self.buffer_size,
+                max_delay=self.buffer_delay)
+        journal = None
+        if self.journal_path:
+            journal = Journal(db_manager, self.journal_path)
+        self.telegram_store = TelegramStore(
+            db_manager,
+            bot=self.app.bot,
+            bot_name=self.bot_name,
+            write_buffer=write_buffer,
+            journal=journal,
+            timeseries_metadata=self.timeseries_metadata,
+            update_ttl_days=self.update_ttl_days,
+            compact_updates=not self.full_updates,
+            write_profiles={
+                TelegramStore.update_table_name: self.updates_durability,
+                TelegramStore.metadata_table_name: self.metadata_durability,
+                TelegramStore.rollup_table_name: self.metadata_durability,
+            })
+        if isinstance(self.app.persistence, StorePersistence):
+            self.app.persistence.store = self.telegram_store
+        return self.telegram_store
+
+    def _webhook_options(self) -> Dict[str, Any]:
+        if not self.webhook_secret:
+            raise ValueError("webhook mode needs a webhook_secret")
+        return {
+            "listen": self.webhook_listen,
+            "port": self.webhook_port,
+            "url_path": self.bot_name,
+            "webhook_url": self.webhook_url or None,
+            "secret_token": self.webhook_secret,
+            "max_connections": self.webhook_max_connections,
+        }
+
+    def run_webhook(self):
+        """Serves telegram's webhook requests at
+        webhook_listen:webhook_port/<bot_name>, and registers webhook_url
+        with telegram.
+
+        Requests without the webhook_secret in their
+        X-Telegram-Bot-Api-Secret-Token header are rejected with a 403.
+        Telegram sends up to webhook_max_connections requests at a time, the
+        handlers of concurrent_updates of them run at a time, see
+        PerUserUpdateProcessor.
+        """
+        self.app.run_webhook(**self._webhook_options())
+
     def run(self):
         """Start the bot"""
         self.logger.info(f"Starting {self.__class__.__name__} bot...")
         self.setup_handlers()
-        self.app.run_polling()
+        # Open the mongo connections before the first update arrives.
+        registry.warm()
+        try:
+            if self.mode == "webhook":
+                self.run_webhook()
+            else:
+                self.app.run_polling()
+        finally:
+            self._close()
+
+    async def serve(self, stop: asyncio.Event):
+        """Runs the bot on the running event loop until stop is set.
+
+        Unlike run, this doesn't set up the handlers or handle signals, so
+        that several bots can share a process, see run_bots.
+        """
+        self.logger.info(f"Starting {self.__class__.__name__} bot {self.bot_name}...")
+        # The handlers of this bot run in tasks started from this one, and
+        # get its store from TelegramStore().
+        TelegramStore.use(self.telegram_store)
+        try:
+            async with self.app:
+                if self.mode == "webhook":
+                    await self.app.updater.start_webhook(**self._webhook_options())
+                else:
+                    await self.app.updater.start_polling()
+                await self.app.start()
+                await stop.wait()
+                await self.app.updater.stop()
+                await self.app.stop()
+        finally:
+            await asyncio.to_thread(self._close)
+
+    def _close(self):
+        processor = self.app.update_processor
+        if isinstance(processor, PerUserUpdateProcessor):
+            self.logger.info(f"Update processor stats: {processor.stats()}")
+        self.logger.info("Flushing buffered and journaled writes...")
+        self.telegram_store.close()
+
+
+def run_bots(bots: List[BaseBot]):
+    """Runs bots in one process, on one event loop, until SIGINT or SIGTERM.
+
+    Every bot has its own Application and TelegramStore, the stores of bots
+    on the same mongod share its connection pool, see store.clients. A bot
+    that fails, eg with an invalid token, is logged and stopped without
+    stopping the others.
+    """
+    for bot in bots:
+        bot.setup_handlers()
+    # Open the mongo connections before the first update arrives.
+    registry.warm()
+
+    async def _serve(bot: BaseBot, stop: asyncio.Event):
+        try:
+            await bot.serve(stop)
+        except Exception:
+            bot.logger.exception(f"Bot {bot.bot_name} stopped")
+
+    async def _serve_all():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await asyncio.gather(*[_serve(bot, stop) for bot in bots])
+
+    asyncio.run(_serve_all())
@@ -0,0 +1,94 @@
+import asyncio
+import datetime
+import unittest
+from telegram import Update, Message, Chat, User
+from bots.base import PerUserUpdateProcessor
+
+
+def _update(update_id: int, user_id: int) -> Update:
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            text="food",
+            from_user=User(id=user_id, first_name=f"user{user_id}", is_bot=False),
+        ),
+    )
+
+
+class TestPerUserUpdateProcessor(unittest.IsolatedAsyncioTestCase):
+
+    async def test_orders_updates_per_user(self):
+        processor = PerUserUpdateProcessor(workers=3)
+        handled = {1: [], 2: [], 3: [], 4: []}
+        running, peak = set(), []
+
+        async def handle(update: Update):
+            user_id = update.effective_user.id
+            self.assertNotIn(user_id, running)
+            running.add(user_id)
+            peak.append(len(running))
+            # Later updates of a user finish sooner, they'd overtake the
+            # earlier ones if they ran in parallel.
+            await asyncio.sleep(0.01 * (10 - update.update_id % 10))
+            handled[user_id].append(update.update_id)
+            running.discard(user_id)
+
+        updates = [_update(i, i % 4 + 1) for i in range(40)]
+        async with processor:
+            await asyncio.gather(*[
+                processor.process_update(u, handle(u)) for u in updates])
+
+        for user_id, update_ids in handled.items():
+            self.assertEqual(update_ids, list(range(user_id - 1, 40, 4)))
+        # Different users ran in parallel, within the worker bound.
+        self.assertEqual(max(peak), 3)
+        stats = processor.stats()
+        self.assertEqual(stats["processed"], 40)
+        self.assertEqual((stats["running"], stats["queued"], stats["users"]),
+                         (0, 0, 0))
+        # The first 3 got a worker as they arrived.
+        self.assertEqual(stats["peak_queued"], 37)
+        self.assertGreater(stats["queue_wait_max_ms"], 0)
+
+    async def test_bounds_queued_updates(self):
+        processor = PerUserUpdateProcessor(workers=1, max_queued=2)
+        handled = []
+
+        async def handle(update: Update):
+            await asyncio.sleep(0.01)
+            handled.append(update.update_id)
+
+        updates = [_update(i, i % 2 + 1) for i in range(10)]
+        async with processor:
+            tasks = [asyncio.create_task(processor.process_update(u, handle(u)))
+                     for u in updates]
+            await asyncio.sleep(0.005)
+            # One runs and 2 are queued, the rest wait to be let in.
+            stats = processor.stats()
+            self.assertEqual((stats["running"], stats["queued"]), (1, 2))
+            await asyncio.gather(*tasks)
+
+        self.assertEqual(processor.stats()["peak_queued"], 2)
+        # The updates past the bound are let in in the order they arrived.
+        self.assertEqual(handled, list(range(10)))
+
+    async def test_unordered_updates(self):
+        processor = PerUserUpdateProcessor(workers=2)
+        done = []
+
+        async def handle(i):
+            await asyncio.sleep(0.01 * (3 - i))
+            done.append(i)
+
+        # Updates without a user or chat, eg errors, run unordered.
+        await asyncio.gather(*[
+            processor.process_update(object(), handle(i)) for i in range(3)])
+        self.assertEqual(sorted(done), [0, 1, 2])
+        self.assertEqual(done[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,14 +28,17 @@ Notes:
 
 from telegram.ext import CallbackQueryHandler
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ForceReply
-from store.db import TelegramStore, MongoManager
+from store.db import TelegramStore, CircuitOpenError
+from constants import UNAVAILABLE_MSG, PRICE_PATTERN
 from telegram.ext import CommandHandler, CallbackContext, MessageHandler, filters
 from telegram import Update
+import re
 import logging
-from typing import List, Dict, Any
+from types import MappingProxyType
+from typing import List, Dict, Any, Mapping
 from .base import BaseBot
 import datetime
-from summary import create_summary
+from summary import create_summary, metadata_to_totals
 from translations.lipok import *
 
 logger = logging.getLogger(__name__)
@@ -50,21 +53,65 @@ class LipokBotUpdate():
     path of buttons pressed by the user to end up at the current state.
     """
 
+    # Index of each field in a selection path, eg:
+    # 7196436554:/start:food:wheat:outside:custom:10
+    CATEGORY_INDEX = 2
+    SUBCATEGORY_INDEX = 3
+    SOURCE_INDEX = 4
+    PRICE_INDEX = 5
+
+    @staticmethod
+    def parse_selection_path(selection_path: str) -> Dict[str, Any]:
+        """Parses a user id prefixed selection path into typed fields.
+
+        Args:
+            selection_path: eg "7196436554:/start:food:wheat:outside:0-50" or
+            "7196436554:/start:food:wheat:outside:custom:10".
+
+        Returns:
+            A dict with the keys category, subcategory, source, price_low,
+            price_high and is_custom. Fields that the path hasn't reached yet
+            are None. Prices are only set when the path ends in a range or
+            custom amount matching PRICE_PATTERN, like the summaries, in
+            which case price_low == price_high for custom amounts.
+        """
+        elements = selection_path.split(":")
+
+        def element(i):
+            return elements[i] if len(elements) > i else None
+
+        fields = {
+            "category": element(LipokBotUpdate.CATEGORY_INDEX),
+            "subcategory": element(LipokBotUpdate.SUBCATEGORY_INDEX),
+            "source": element(LipokBotUpdate.SOURCE_INDEX),
+            "price_low": None,
+            "price_high": None,
+            "is_custom": PRICE_CUSTOM in elements[LipokBotUpdate.PRICE_INDEX:],
+        }
+        if len(elements) <= LipokBotUpdate.PRICE_INDEX:
+            return fields
+
+        if not re.fullmatch(PRICE_PATTERN, elements[-1]):
+            return fields
+        prices = [int(p) for p in elements[-1].split("-")]
+        fields["price_low"], fields["price_high"] = min(prices), max(prices)
+        return fields
+
     @staticmethod
-    def insert(update: Update, **kwargs):
+    async def insert(update: Update, **kwargs):
         if update is None:
             return
 
         ts = TelegramStore()
-        ts.insert_update(update)
+        await ts.insert_update_async(update)
         logger.debug(f"Inserted update: {update}")
 
         if "selection_path" not in kwargs or not kwargs["selection_path"]:
             return
 
         # Create metadata document with update_id as reference
-        # Prepend the user id to all selection paths so it can be used in the
-        # filter. This is a bit of a hack, but it works.
+        # Prepend the user id to all selection paths. Summaries still split
+        # the raw path, but queries go through the parsed fields and user_id.
         selection_path = f"{update.effective_user.id}:{kwargs.get('selection_path')}"
         metadata = {
             "update_id": update.update_id,
@@ -74,15 +121,18 @@ class LipokBotUpdate():
             "user_name": update.effective_user.name,
             "user_username": update.effective_user.username,
             "user_language_code": update.effective_user.language_code,
+            **LipokBotUpdate.parse_selection_path(selection_path),
         }
         # Store metadata in separate collection
-        ts.insert_metadata(metadata)
+        await ts.insert_metadata_async(metadata)
         logger.info(f"Inserted metadata: {metadata}")
 
     @staticmethod
-    def get_user_metadata(user_id: int) -> List[Dict[str, Any]]:
+    async def get_user_metadata(user_id: int) -> List[Dict[str, Any]]:
         """Get metadata for a user.
 
+        Only the fields needed for a summary are fetched.
+
         Args:
             user_id: The user id to get metadata for.
 
@@ -90,7 +140,32 @@ class LipokBotUpdate():
             A list of metadata for the user.
         """
         ts = TelegramStore()
-        return ts.get_metadata(selection_path_pattern=f"{user_id}:")
+        return await ts.get_metadata_async(
+            user_id, projection=TelegramStore.LIPOK_SUMMARY)
+
+    @staticmethod
+    async def get_user_totals(user_id: int) -> Dict[str, Any] | None:
+        """Get the spending totals of a user.
+
+        The totals are read from the user's rollups. Users without rollups,
+        and every user while the rollups aren't built (see
+        TelegramStore.rollups_built), are summarized from their metadata, in
+        the db if possible and in python otherwise.
+
+        Returns:
+            None if the user has no metadata, else the totals as returned by
+            TelegramStore.get_rollups.
+        """
+        ts = TelegramStore()
+        if ts.rollups_built:
+            totals = await ts.get_rollups_async(user_id)
+            if totals is not None:
+                return totals
+        try:
+            return await ts.get_metadata_summary_async(user_id)
+        except NotImplementedError:
+            metadata = await LipokBotUpdate.get_user_metadata(user_id)
+            return metadata_to_totals(metadata) if metadata else None
 
 
 class LipokBot(BaseBot):
@@ -101,11 +176,7 @@ class LipokBot(BaseBot):
 
     def setup_handlers(self):
         # Initialize MongoDB store
-        ts = TelegramStore(
-            MongoManager(f"mongodb://{self.host}:{self.port}"),
-            bot=self.app.bot,
-            bot_name=self.bot_name
-        )
+        ts = self.setup_store()
         print('Initialized telegram store ', ts)
 
         # Add handlers
@@ -118,87 +189,91 @@ class LipokBot(BaseBot):
         self.app.add_handler(MessageHandler(
             filters.TEXT & ~filters.COMMAND, handle_custom_price))
 
-    @staticmethod
-    def get_main_keyboard() -> InlineKeyboardMarkup:
-        keyboard = [
-            [InlineKeyboardButton(get_button_text(
-                FOOD), callback_data=f"category:{FOOD}")],
-            [InlineKeyboardButton(get_button_text(
-                HOUSEHOLD), callback_data=f"category:{HOUSEHOLD}")],
-            [InlineKeyboardButton(get_button_text(
-                FUEL), callback_data=f"category:{FUEL}")],
-            [InlineKeyboardButton(get_button_text(
-                SUMMARY), callback_data=f"{SUMMARY}")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+    # The menu, every category with its subcategories in the order they're
+    # shown.
+    MENU = {
+        FOOD: [VEGETABLES, FRUITS, MEATS, RICE, MILLETS, WHEAT, DAIRY],
+        HOUSEHOLD: [SOAP, CLOTHES, STATIONARY, COSMETICS],
+        FUEL: [PETROL, GAS, DIESEL],
+    }
+
+    # The keyboards of every (language, menu node), see build_keyboards.
+    # They're static, so they're built once, instead of on every button
+    # press. Telegram objects are immutable, handlers can send them as is.
+    keyboards: Mapping[tuple[str, str], InlineKeyboardMarkup] = {}
+
+    @classmethod
+    def menu_nodes(cls) -> List[str]:
+        """Returns every menu node that has a keyboard: "main",
+        "category:<category>", "source:<category>:<subcategory>" and
+        "price", after the callback_data of the button that leads to them."""
+        nodes = ["main", "price"]
+        for category, subcategories in cls.MENU.items():
+            nodes.append(f"category:{category}")
+            nodes.extend(f"source:{category}:{s}" for s in subcategories)
+        return nodes
+
+    @classmethod
+    def build_keyboard(cls, language: str, node: str) -> InlineKeyboardMarkup:
+        """Returns a new keyboard for a menu node, see menu_nodes."""
+        def button(key, callback_data):
+            return InlineKeyboardButton(
+                get_button_text(key, language), callback_data=callback_data)
+
+        kind, _, path = node.partition(":")
+        if node == "main":
+            rows = [*[[button(c, f"category:{c}")] for c in cls.MENU],
+                    [button(SUMMARY, SUMMARY)]]
+        elif node == "price":
+            rows = [[button(p, f"price:{p}")
+                     for p in [PRICE_0_50, PRICE_50_100, PRICE_100_200]],
+                    [button(PRICE_CUSTOM, f"price:{PRICE_CUSTOM}")]]
+        elif kind == "category":
+            rows = [[button(s, f"subcategory:{path}:{s}")]
+                    for s in cls.MENU[path]]
+        elif kind == "source":
+            rows = [[button(source, f"source:{path}:{source}")]
+                    for source in [WITHIN_VILLAGE, OUTSIDE_VILLAGE]]
+        else:
+            raise ValueError(f"Unknown menu node: {node}")
+        return InlineKeyboardMarkup(rows)
 
-    @staticmethod
-    def get_category_keyboard(category: str) -> InlineKeyboardMarkup:
-        if category == FOOD:
-            keyboard = [
-                [InlineKeyboardButton(get_button_text(VEGETABLES),
-                                      callback_data=f"subcategory:{FOOD}:{VEGETABLES}")],
-                [InlineKeyboardButton(get_button_text(FRUITS),
-                                      callback_data=f"subcategory:{FOOD}:{FRUITS}")],
-                [InlineKeyboardButton(get_button_text(MEATS),
-                                      callback_data=f"subcategory:{FOOD}:{MEATS}")],
-                [InlineKeyboardButton(get_button_text(RICE),
-                                      callback_data=f"subcategory:{FOOD}:{RICE}")],
-                [InlineKeyboardButton(get_button_text(MILLETS),
-                                      callback_data=f"subcategory:{FOOD}:{MILLETS}")],
-                [InlineKeyboardButton(get_button_text(WHEAT),
-                                      callback_data=f"subcategory:{FOOD}:{WHEAT}")],
-                [InlineKeyboardButton(get_button_text(DAIRY),
-                                      callback_data=f"subcategory:{FOOD}:{DAIRY}")]
-            ]
-        elif category == HOUSEHOLD:
-            keyboard = [
-                [InlineKeyboardButton(get_button_text(SOAP),
-                                      callback_data=f"subcategory:{HOUSEHOLD}:{SOAP}")],
-                [InlineKeyboardButton(get_button_text(CLOTHES),
-                                      callback_data=f"subcategory:{HOUSEHOLD}:{CLOTHES}")],
-                [InlineKeyboardButton(get_button_text(STATIONARY),
-                                      callback_data=f"subcategory:{HOUSEHOLD}:{STATIONARY}")],
-                [InlineKeyboardButton(get_button_text(COSMETICS),
-                                      callback_data=f"subcategory:{HOUSEHOLD}:{COSMETICS}")]
-            ]
-        elif category == FUEL:
-            keyboard = [
-                [InlineKeyboardButton(get_button_text(PETROL),
-                                      callback_data=f"subcategory:{FUEL}:{PETROL}")],
-                [InlineKeyboardButton(get_button_text(GAS),
-                                      callback_data=f"subcategory:{FUEL}:{GAS}")],
-                [InlineKeyboardButton(get_button_text(DIESEL),
-                                      callback_data=f"subcategory:{FUEL}:{DIESEL}")]
-            ]
-        return InlineKeyboardMarkup(keyboard)
+    @classmethod
+    def build_keyboards(cls) -> Mapping[tuple[str, str], InlineKeyboardMarkup]:
+        """Returns the keyboard of every menu node, in every language."""
+        return MappingProxyType({
+            (language, node): cls.build_keyboard(language, node)
+            for language in LANGUAGES for node in cls.menu_nodes()})
 
-    @staticmethod
-    def get_source_keyboard(category: str, subcategory: str) -> InlineKeyboardMarkup:
-        keyboard = [
-            [InlineKeyboardButton(get_button_text(WITHIN_VILLAGE),
-                                  callback_data=f"source:{category}:{subcategory}:{WITHIN_VILLAGE}")],
-            [InlineKeyboardButton(get_button_text(OUTSIDE_VILLAGE),
-                                  callback_data=f"source:{category}:{subcategory}:{OUTSIDE_VILLAGE}")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+    @classmethod
+    def get_main_keyboard(cls, language: str = LANGUAGE) -> InlineKeyboardMarkup:
+        return cls.keyboards[(language, "main")]
+
+    @classmethod
+    def get_category_keyboard(
+            cls, category: str, language: str = LANGUAGE) -> InlineKeyboardMarkup:
+        return cls.keyboards[(language, f"category:{category}")]
+
+    @classmethod
+    def get_source_keyboard(
+            cls, category: str, subcategory: str,
+            language: str = LANGUAGE) -> InlineKeyboardMarkup:
+        return cls.keyboards[(language, f"source:{category}:{subcategory}")]
+
+    @classmethod
+    def get_price_keyboard(cls, language: str = LANGUAGE) -> InlineKeyboardMarkup:
+        return cls.keyboards[(language, "price")]
 
-    @staticmethod
-    def get_price_keyboard() -> InlineKeyboardMarkup:
-        keyboard = [
-            [InlineKeyboardButton(get_button_text(PRICE_0_50), callback_data=f"price:{PRICE_0_50}"),
-             InlineKeyboardButton(
-                 get_button_text(PRICE_50_100), callback_data=f"price:{PRICE_50_100}"),
-             InlineKeyboardButton(get_button_text(PRICE_100_200), callback_data=f"price:{PRICE_100_200}")],
-            [InlineKeyboardButton(get_button_text(PRICE_CUSTOM),
-                                  callback_data=f"price:{PRICE_CUSTOM}")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+
+LipokBot.keyboards = LipokBot.build_keyboards()
+
+
+def create_bot(**kwargs) -> LipokBot:
+    return LipokBot(**kwargs)
 
 
 def run_bot(**kwargs):
-    bot = LipokBot(**kwargs)
-    bot.run()
+    create_bot(**kwargs).run()
 
 
 async def start(update: Update, context: CallbackContext) -> None:
@@ -213,7 +288,7 @@ async def start(update: Update, context: CallbackContext) -> None:
         return
 
     current_path = "/start"
-    LipokBotUpdate.insert(update, selection_path=current_path)
+    await LipokBotUpdate.insert(update, selection_path=current_path)
     context.user_data[LipokBot.SELECTION_PATH] = current_path
 
     reply_markup = LipokBot.get_main_keyboard()
@@ -237,12 +312,22 @@ async def handle_button(update: Update, context: CallbackContext) -> None:
     data = query.data.split(":")
     current_path = f"{context.user_data.get(LipokBot.SELECTION_PATH, '/start')}:{data[-1]}"
     context.user_data[LipokBot.SELECTION_PATH] = current_path
-    LipokBotUpdate.insert(update, selection_path=current_path)
+    try:
+        await LipokBotUpdate.insert(update, selection_path=current_path)
+    except CircuitOpenError:
+        # Mongo is down. A summary can't be served either, it says so below.
+        if data[0] != SUMMARY:
+            raise
 
     if data[0] == SUMMARY:
-        user_metadata = LipokBotUpdate.get_user_metadata(
-            update.effective_user.id)
-        summary = create_summary(updates=[], metadata=user_metadata)
+        try:
+            totals = await LipokBotUpdate.get_user_totals(
+                update.effective_user.id)
+        except CircuitOpenError:
+            await query.message.reply_text(UNAVAILABLE_MSG)
+            await clear_state_and_start(update, context)
+            return
+        summary = create_summary(updates=[], metadata=[], totals=totals)
         if summary is not None:
             await query.message.reply_document(
                 document=summary,
@@ -298,19 +383,28 @@ async def handle_button(update: Update, context: CallbackContext) -> None:
 
 
 async def handle_custom_price(update: Update, context: CallbackContext) -> None:
-    """Handles custom price input from user."""
+    """Handles custom price input from user.
+
+    The price is trimmed, and asked for again unless it matches
+    PRICE_PATTERN, so that the stored path is summarized the same way
+    everywhere.
+    """
     if context.user_data.get("state") != "awaiting_custom_price":
         return
 
     logger = logging.getLogger(__name__)
 
-    price = update.message.text
+    price = update.message.text.strip()
+    if not re.fullmatch(PRICE_PATTERN, price):
+        await update.message.reply_text(
+            "Please enter a valid price, eg 50 or 50-100.")
+        return
     current_path = context.user_data.get(
         LipokBot.SELECTION_PATH, str(update.effective_user.id))
 
     # Complete path with custom price
     final_path = f"{current_path}:{price}"
-    LipokBotUpdate.insert(update, selection_path=final_path)
+    await LipokBotUpdate.insert(update, selection_path=final_path)
 
     await update.message.reply_text(f"Price set to: {price}")
     await clear_state_and_start(update, context)
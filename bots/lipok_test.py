@@ -0,0 +1,150 @@
+import unittest
+from datetime import datetime
+from unittest import mock
+from bots.lipok import LipokBot, LipokBotUpdate, handle_custom_price
+from store.db import TelegramStore
+from store.memory import MemoryManager
+from translations.lipok import LANGUAGES, FOOD, RICE, SUMMARY
+
+
+class TestLipokBotUpdate(unittest.TestCase):
+
+    def test_parse_selection_path(self):
+        parse = LipokBotUpdate.parse_selection_path
+        self.assertEqual(parse("1:/start:food:rice:within:50-100"), {
+            "category": "food",
+            "subcategory": "rice",
+            "source": "within",
+            "price_low": 50,
+            "price_high": 100,
+            "is_custom": False,
+        })
+        custom = parse("1:/start:fuel:gas:outside:custom:120")
+        self.assertEqual((custom["price_low"], custom["price_high"]), (120, 120))
+        self.assertTrue(custom["is_custom"])
+
+        # Incomplete paths and non numeric custom prices have no price.
+        self.assertEqual(parse("1:/start:food")["subcategory"], None)
+        self.assertEqual(
+            parse("1:/start:food:rice:within:custom")["price_high"], None)
+        self.assertEqual(
+            parse("1:/start:food:rice:within:custom:abc")["price_high"], None)
+        # Nor do prices that int() accepts, but the summaries don't.
+        for price in ["50 ", "+5", "1_000", "٣"]:
+            self.assertEqual(parse(
+                f"1:/start:food:rice:within:custom:{price}")["price_high"], None)
+
+
+class TestHandleCustomPrice(unittest.IsolatedAsyncioTestCase):
+
+    def _update(self, text):
+        update = mock.MagicMock()
+        update.message.text = text
+        update.message.reply_text = mock.AsyncMock()
+        update.effective_user.id = 1
+        return update
+
+    async def _handle(self, text):
+        update = self._update(text)
+        context = mock.MagicMock()
+        context.user_data = {
+            "state": "awaiting_custom_price",
+            LipokBot.SELECTION_PATH: "1:/start:food:rice:within:custom",
+        }
+        with mock.patch.object(LipokBotUpdate, "insert") as insert, \
+                mock.patch("bots.lipok.clear_state_and_start") as restart:
+            await handle_custom_price(update, context)
+        return update, context, insert, restart
+
+    async def test_trims_the_price(self):
+        _, _, insert, restart = await self._handle(" 50 \n")
+        insert.assert_awaited_once()
+        path = insert.call_args.kwargs["selection_path"]
+        self.assertEqual(path, "1:/start:food:rice:within:custom:50")
+        self.assertEqual(
+            LipokBotUpdate.parse_selection_path(path)["price_high"], 50)
+        restart.assert_awaited_once()
+
+    async def test_asks_again_for_an_invalid_price(self):
+        for text in ["abc", "+5", "1_000", "5 0", "1000000000000"]:
+            update, context, insert, restart = await self._handle(text)
+            insert.assert_not_called()
+            restart.assert_not_called()
+            update.message.reply_text.assert_awaited_once()
+            self.assertEqual(context.user_data["state"], "awaiting_custom_price")
+
+
+class TestLipokBotTotals(unittest.IsolatedAsyncioTestCase):
+
+    def _metadata(self, update_id, selection_path):
+        selection_path = f"1:{selection_path}"
+        return {
+            "update_id": update_id,
+            "selection_path": selection_path,
+            "timestamp": datetime(2024, 1, 1 + update_id),
+            "user_id": 1,
+            "user_name": "user1",
+            **LipokBotUpdate.parse_selection_path(selection_path),
+        }
+
+    def setUp(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        self.manager = MemoryManager()
+
+    async def test_totals_of_metadata_that_predates_rollups(self):
+        self.manager.insert(
+            self._metadata(0, "/start:food:rice:within:100-200"),
+            TelegramStore.get_db_name("test"), TelegramStore.metadata_table_name)
+        # The rollups are rebuilt on startup.
+        ts = TelegramStore(self.manager, bot_name="test")
+        ts.wait_for_indices()
+        await ts.insert_metadata_async(
+            self._metadata(1, "/start:fuel:gas:within:0-50"))
+        totals = await LipokBotUpdate.get_user_totals(1)
+        self.assertEqual(totals["category_totals"], {"food": 200, "fuel": 50})
+
+        # Until they are, the metadata is summarized instead.
+        ts.rollups_built = False
+        await ts.insert_metadata_async(
+            self._metadata(2, "/start:fuel:gas:within:custom:25"))
+        self.manager.delete({}, ts.db_name, ts.rollup_table_name)
+        totals = await LipokBotUpdate.get_user_totals(1)
+        self.assertEqual(totals["category_totals"], {"food": 200, "fuel": 75})
+
+
+class TestLipokBotKeyboards(unittest.TestCase):
+
+    def test_every_button_leads_to_a_keyboard(self):
+        for language in LANGUAGES:
+            nodes = ["main"]
+            seen = set()
+            while nodes:
+                node = nodes.pop()
+                seen.add(node)
+                for row in LipokBot.keyboards[(language, node)].inline_keyboard:
+                    for button in row:
+                        kind, _, rest = button.callback_data.partition(":")
+                        # subcategory buttons lead to the source keyboard.
+                        if kind == "subcategory":
+                            nodes.append(f"source:{rest}")
+                        elif kind == "category":
+                            nodes.append(button.callback_data)
+                        elif kind == "source":
+                            nodes.append("price")
+                        else:
+                            self.assertIn(kind, ["price", SUMMARY])
+            self.assertEqual(
+                seen, {n for lang, n in LipokBot.keyboards if lang == language})
+
+    def test_keyboards_are_cached(self):
+        self.assertIs(LipokBot.get_source_keyboard(FOOD, RICE),
+                      LipokBot.get_source_keyboard(FOOD, RICE))
+        self.assertNotEqual(LipokBot.get_main_keyboard("en"),
+                            LipokBot.get_main_keyboard("mr"))
+        with self.assertRaises(TypeError):
+            LipokBot.keyboards[("en", "main")] = None
+
+
+if __name__ == '__main__':
+    unittest.main()
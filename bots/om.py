@@ -27,12 +27,14 @@ Notes:
 """
 
 from summary import create_summary
-from constants import START_MSG, LABELS
+from constants import START_MSG, LABELS, UNAVAILABLE_MSG
 from telegram.ext import CommandHandler, CallbackContext, MessageHandler, filters
 from telegram import Update, ReplyKeyboardMarkup
 from pprint import pprint
 from .base import BaseBot
-from store.db import TelegramStore, MongoManager
+from store.db import TelegramStore, CircuitOpenError
+from pymongo import ASCENDING
+import asyncio
 import logging
 
 
@@ -40,11 +42,7 @@ class OMBot(BaseBot):
     def setup_handlers(self):
         self.logger.info("Setting up OM bot handlers...")
         # Initialize MongoDB store
-        ts = TelegramStore(
-            MongoManager(f"mongodb://{self.host}:{self.port}"),
-            bot=self.app.bot,
-            bot_name=self.bot_name
-        )
+        ts = self.setup_store()
         print('Initialized telegram store ', ts)
 
         # Add handlers
@@ -56,9 +54,12 @@ class OMBot(BaseBot):
         self.app.add_handler(MessageHandler(filters.PHOTO, handle_pic))
 
 
+def create_bot(**kwargs) -> OMBot:
+    return OMBot(**kwargs)
+
+
 def run_bot(**kwargs):
-    bot = OMBot(**kwargs)
-    bot.run()
+    create_bot(**kwargs).run()
 
 
 async def start(update: Update, context: CallbackContext) -> None:
@@ -129,16 +130,29 @@ async def handle_updates(update: Update, context: CallbackContext) -> None:
     if update.message and update.message.text == LABELS["summary"]:
         logging.info(
             f"Getting updates for user {update.message.from_user.name} with id {update.message.from_user.id}")
+        # Stream the user's history in date order, so the summary is built in
+        # a single pass without holding every update in memory. Both the
+        # cursor and the pdf rendering run in a worker thread.
         user_updates = ts.get_updates(
-            filter={"message.from.id": update.message.from_user.id})
+            filter={"message.from.id": update.message.from_user.id},
+            limit=-1,
+            sort=[("message.date", ASCENDING)],
+            projection=TelegramStore.OM_SUMMARY)
 
         # TODO(prashanth@): if this fails, send a reply_text asking the
         # user to retry.
+        try:
+            summary = await asyncio.to_thread(
+                create_summary, updates=user_updates, metadata=[], presorted=True)
+        except CircuitOpenError:
+            # Mongo is down, don't keep the user waiting on it.
+            await update.message.reply_text(UNAVAILABLE_MSG)
+            return
         await update.message.reply_document(
-            document=create_summary(updates=user_updates, metadata=[]),
+            document=summary,
             filename="summary.pdf")
 
-    ts.insert_update(update)
+    await ts.insert_update_async(update)
 
 
 async def handle_pic(update: Update, context: CallbackContext) -> None:
@@ -5,11 +5,41 @@ import importlib
 import logging
 import os
 from dotenv import load_dotenv
+from bots.base import run_bots
+from store.db import TelegramStore
 
 # Load environment variables
 load_dotenv()
 
 
+def create_bot(entry: str, index: int, args, webhook_secret: str):
+    """Creates the bot of a --bots entry, plugin:bot_name:token_env."""
+    try:
+        plugin, bot_name, token_env = entry.split(":")
+    except ValueError:
+        raise ValueError(
+            f"--bots entry '{entry}' is not plugin:bot_name:token_env")
+    api_key = os.getenv(token_env)
+    if not api_key:
+        raise ValueError(f"{token_env} env var is not set.")
+    try:
+        plugin_module = importlib.import_module(f"bots.{plugin}")
+    except ImportError:
+        raise ValueError(f"Plugin '{plugin}' not found in bots directory")
+    options = {
+        **vars(args),
+        "plugin": plugin,
+        "bot_name": bot_name,
+        "webhook_port": args.webhook_port + index,
+    }
+    if args.webhook_url:
+        options["webhook_url"] = f"{args.webhook_url.rstrip('/')}/{bot_name}"
+    if args.journal_path:
+        options["journal_path"] = f"{args.journal_path}.{bot_name}"
+    return plugin_module.create_bot(
+        api_key=api_key, webhook_secret=webhook_secret, **options)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Telegram Bot with Plugin Support")
@@ -21,6 +51,54 @@ def main():
                         help="The MongoDB port")
     parser.add_argument("--bot_name", type=str, default="ari",
                         help="User supplied chatbot name - this namespaces the database so you can run multiple bots on the same server and they will use different tables. It has no relationship to the bot name in telegram.")
+    parser.add_argument("--bots", type=str, nargs="+", default=[],
+                        help="Run several bots in this process, on one event loop, as plugin:bot_name:token_env entries, eg lipok:billa:BILLA_API_KEY om:ari:ARI_API_KEY. Each bot's token is read from its token_env env var. Overrides --plugin and --bot_name. With --mode webhook the i-th bot listens on --webhook_port + i, and --webhook_url is a prefix, the bot's url is <webhook_url>/<bot_name>. With --journal_path each bot journals to <journal_path>.<bot_name>.")
+    parser.add_argument("--store", type=str, default="mongo",
+                        choices=["mongo", "sqlite"],
+                        help="The database backend. sqlite keeps everything in a single local file, for small deployments that don't run a mongod.")
+    parser.add_argument("--sqlite_path", type=str, default="",
+                        help="The SQLite file used with --store sqlite. Defaults to <bot_name>.sqlite3.")
+    parser.add_argument("--timeseries_metadata", action="store_true",
+                        help="Store metadata in a mongo time-series collection. Migrate an existing metadata collection with hack/migrate_timeseries.py first.")
+    parser.add_argument("--update_ttl_days", type=int, default=0,
+                        help="Delete raw updates this many days after they are stored, through a mongo TTL index. 0 keeps them. To keep old updates in cold storage instead, see hack/archive_updates.py.")
+    parser.add_argument("--full_updates", action="store_true",
+                        help="Store the full telegram update, instead of only the fields the bots and summaries read (TelegramStore.compact_schema).")
+    parser.add_argument("--updates_durability", type=str, default="relaxed",
+                        choices=list(TelegramStore.write_concerns),
+                        help="The mongo write concern of raw updates: unacknowledged (w=0), relaxed (w=1), journaled (w=1, j) or majority (w=majority, j).")
+    parser.add_argument("--metadata_durability", type=str, default="journaled",
+                        choices=list(TelegramStore.write_concerns),
+                        help="The mongo write concern of metadata and rollups, see --updates_durability.")
+    parser.add_argument("--mongo_max_pool_size", type=int, default=50,
+                        help="The max number of connections in each mongo connection pool.")
+    parser.add_argument("--mongo_min_pool_size", type=int, default=4,
+                        help="The number of mongo connections opened before the bot starts polling, and kept open while idle.")
+    parser.add_argument("--mode", type=str, default="polling",
+                        choices=["polling", "webhook"],
+                        help="How updates are received. webhook serves telegram's webhook requests from a local HTTP server, and needs the WEBHOOK_SECRET env var.")
+    parser.add_argument("--webhook_listen", type=str, default="127.0.0.1",
+                        help="The address the webhook server listens on.")
+    parser.add_argument("--webhook_port", type=int, default=8443,
+                        help="The port the webhook server listens on.")
+    parser.add_argument("--webhook_url", type=str, default="",
+                        help="The public https url telegram posts updates to, usually a reverse proxy in front of the webhook server, eg https://example.com/<bot_name>. Defaults to https://<webhook_listen>:<webhook_port>/<bot_name>.")
+    parser.add_argument("--webhook_max_connections", type=int, default=40,
+                        help="The max number of webhook requests telegram sends at a time, 1-100.")
+    parser.add_argument("--concurrent_updates", type=int, default=1,
+                        help="The number of updates whose handlers run at a time. The updates of the same user are still handled one after the other, in order. 1 handles all updates one after the other.")
+    parser.add_argument("--bot_api_url", type=str, default="",
+                        help="The Bot API server, eg a local telegram-bot-api server at http://localhost:8081/bot. Defaults to https://api.telegram.org/bot.")
+    parser.add_argument("--persist_user_data", action="store_true",
+                        help="Store the handlers' per user state (context.user_data) in the database, so that it survives restarts.")
+    parser.add_argument("--persistence_interval", type=float, default=5.0,
+                        help="Seconds between the writes of a user's state, with --persist_user_data. Changes within an interval are written once.")
+    parser.add_argument("--buffer_size", type=int, default=0,
+                        help="Batch this many updates/metadata in memory before writing them to the database. 0 writes every insert immediately.")
+    parser.add_argument("--buffer_delay", type=float, default=1.0,
+                        help="The max number of seconds a buffered write waits before it is flushed. Only used with --buffer_size.")
+    parser.add_argument("--journal_path", type=str, default="",
+                        help="Append updates/metadata to a journal file at this path and write them to the database in the background, so that inserts don't stall while the database is down. Journaled writes that aren't in the database yet are replayed on the next start.")
     parser.add_argument(
         "--log-level",
         default="INFO",
@@ -33,6 +111,14 @@ def main():
     args = parser.parse_args()
     logging.getLogger().setLevel(args.log_level)
 
+    webhook_secret = os.getenv('WEBHOOK_SECRET', '')
+    if args.mode == "webhook" and not webhook_secret:
+        raise ValueError("WEBHOOK_SECRET env var is not set.")
+    if args.bots:
+        run_bots([create_bot(entry, i, args, webhook_secret)
+                  for i, entry in enumerate(args.bots)])
+        return
+
     api_key = os.getenv('API_KEY')
     if not api_key:
         raise ValueError("API_KEY env var is not set.")
@@ -40,7 +126,8 @@ def main():
     # Import and run the specified plugin
     try:
         plugin_module = importlib.import_module(f"bots.{args.plugin}")
-        plugin_module.run_bot(api_key=api_key, **vars(args))
+        plugin_module.run_bot(
+            api_key=api_key, webhook_secret=webhook_secret, **vars(args))
     except ImportError:
         raise ValueError(f"Plugin '{args.plugin}' not found in bots directory")
 
@@ -85,6 +85,12 @@ INDIA_TZ = 'Asia/Kolkata'
 # A pattern matching the first line of the summary in the symmary pdf.
 SUMMARY_PATTERN = r"Summary from ([\d\-]+) to ([\d\-]+)"
 
+# A price or price range at the end of a selection path, eg "50" or "0-50".
+# Custom prices are trimmed and checked against it when they are entered, and
+# every summary of the metadata only counts paths that end in one. Prices
+# have at most 12 digits, so that totals fit in a 64 bit integer.
+PRICE_PATTERN = r"[0-9]{1,12}(-[0-9]{1,12})?"
+
 # A pattern matching each line item (i.e each category) of the summary pdf.
 CATEGORY_PATTERN = r"(\w+.*):\s*(\d+)"
 
@@ -94,6 +100,9 @@ TEMPLATE_PATH = "./template.pdf"
 # The only characters allowed in the pdf summary.
 ALLOWED_CHARS = r"[^a-zA-Z0-9\s\t\-_:\n.,;!?(){}\[\]'\"@#$%&*+=]"
 
+# Sent instead of a summary while the database is unreachable.
+UNAVAILABLE_MSG = "Summaries are unavailable right now, please try again in a few minutes."
+
 # A placeholder for when the expense is unknown (i.e the user doesn't enter a
 # desription).
 UNKNOWN = "unknown"
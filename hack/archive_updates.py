@@ -0,0 +1,64 @@
+"""Moves old raw updates to cold storage, or restores them.
+
+Updates stored more than --days ago are moved to the zstd compressed
+updates_archive collection (--target collection), or to a zstd compressed
+BSON file per month under --archive_dir (--target file), see store.archive.
+It is safe to re-run, and meant to run periodically, eg from cron:
+
+    0 3 * * * python hack/archive_updates.py --bot_name billa --days 90
+
+Usage:
+    $ python hack/archive_updates.py --bot_name billa --days 90 --target file
+    $ python hack/archive_updates.py --bot_name billa --target file --list
+    $ python hack/archive_updates.py --bot_name billa --target file \
+        --restore 2024-01
+"""
+
+import common
+import argparse
+from store.archive import CollectionArchive, FileArchive, UpdateArchive
+from store.clients import registry
+from store.db import MongoManager, TelegramStore
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--mongo_uri", type=str,
+                        default="mongodb://localhost:27017")
+    parser.add_argument("--bot_name", type=str, default="billa")
+    parser.add_argument("--days", type=int, default=90,
+                        help="Archive the updates stored more than this many days ago.")
+    parser.add_argument("--target", type=str, default="collection",
+                        choices=["collection", "file"])
+    parser.add_argument("--archive_dir", type=str, default="archive",
+                        help="The directory of the monthly files of --target file.")
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--list", action="store_true",
+                        help="List the archived months and exit.")
+    parser.add_argument("--restore", type=str, default="",
+                        help="Move the updates of this month, eg 2024-01, back "
+                        "to the updates collection and exit.")
+    args = parser.parse_args()
+
+    m = MongoManager(
+        args.mongo_uri, client_options=registry.maintenance_options)
+    ts = TelegramStore(m, bot_name=args.bot_name, maintenance=True)
+    if args.target == "file":
+        target = FileArchive(args.archive_dir)
+    else:
+        target = CollectionArchive(m, batch_size=args.batch_size)
+    archive = UpdateArchive(ts, target, batch_size=args.batch_size)
+
+    if args.list:
+        for month in archive.months():
+            print(month)
+    elif args.restore:
+        print(f"Restored {archive.restore(args.restore)} updates of {args.restore}")
+    else:
+        print(f"Archived {archive.archive(args.days)} updates older than "
+              f"{args.days} days")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""Reprocesses the stored history of a bot in parallel.
+
+After a change to how selection paths are parsed, how rollups are computed
+or how updates are stored, the existing documents are stale. This re-runs
+the current code over every document of a collection. The jobs are:
+
+    metadata_fields: re-parses the selection_path of every metadata document
+        into its category, subcategory, source, price_low, price_high and
+        is_custom fields, with LipokBotUpdate.parse_selection_path.
+    compact_updates: rewrites every update in TelegramStore.compact_schema.
+    rollups: recomputes every rollup from the metadata, with
+        TelegramStore._rollup_update, and replaces the rollups collection.
+        Stop the bots that write to the db for the run: the rollups they
+        update while it runs are overwritten when the collection is
+        replaced, and the metadata they insert may be missed.
+
+The collection is split into --ranges ranges of _id, with boundaries picked
+from a random sample of _ids so that the ranges are about the same size.
+The ranges are processed by --workers processes. Each reads its range in
+batches of --batch_size documents, in _id order, and writes each batch with
+one unordered bulk write, so memory use doesn't depend on the collection
+size.
+
+Progress is checkpointed in the backfill collection of the bot's db, after
+every batch. An interrupted backfill resumes where it stopped when re-run
+with the same arguments, use --restart to start over. Every job is
+idempotent, so the batch that was being written when the backfill stopped
+is safely written again.
+
+Usage:
+    $ python hack/backfill.py --bot_name lipok --job metadata_fields
+    $ python hack/backfill.py --bot_name lipok --job rollups --workers 8
+"""
+
+import common
+import argparse
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pymongo import MongoClient, ReplaceOne, UpdateOne, ASCENDING
+from pymongo.database import Database
+from bots.lipok import LipokBotUpdate
+from store.db import TelegramStore, _apply_update, _upsert_base
+
+CHECKPOINT_TABLE = "backfill"
+
+
+class MetadataFields:
+    table_name = TelegramStore.metadata_table_name
+    projection = {"selection_path": 1}
+
+    def write(self, db: Database, range_index: int, docs: list) -> None:
+        db[self.table_name].bulk_write([
+            UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": LipokBotUpdate.parse_selection_path(
+                    doc["selection_path"])})
+            for doc in docs], ordered=False)
+
+    def start(self, db: Database) -> None:
+        pass
+
+    def finish(self, db: Database) -> None:
+        pass
+
+
+class CompactUpdates:
+    table_name = TelegramStore.update_table_name
+    projection = None
+
+    def write(self, db: Database, range_index: int, docs: list) -> None:
+        ops = []
+        for doc in docs:
+            compact = TelegramStore.compact_update(doc)
+            if compact != doc:
+                ops.append(ReplaceOne({"_id": doc["_id"]}, compact))
+        if ops:
+            db[self.table_name].bulk_write(ops, ordered=False)
+
+    def start(self, db: Database) -> None:
+        pass
+
+    def finish(self, db: Database) -> None:
+        pass
+
+
+class Rollups:
+    """Rollups sums every batch of metadata into one partial document of a
+    staging collection, keyed by the _id of the batch's first metadata.
+
+    A batch that is written again, eg after a resume, replaces its partial
+    instead of adding to it. Once every range is done, the partials are
+    summed into the rollups collection, which is atomically replaced, and
+    the rollups are marked as built, see TelegramStore.ROLLUPS_BUILT.
+    """
+    table_name = TelegramStore.metadata_table_name
+    projection = {
+        "user_id": 1,
+        "user_name": 1,
+        "timestamp": 1,
+        "category": 1,
+        "subcategory": 1,
+        "price_high": 1,
+    }
+    staging_table_name = "rollups_backfill"
+
+    def write(self, db: Database, range_index: int, docs: list) -> None:
+        rollups = {}
+        # The user_name of a rollup is the one of its earliest entry.
+        for doc in sorted(docs, key=lambda d: d["timestamp"]):
+            update = TelegramStore._rollup_update(doc)
+            if update is None:
+                continue
+            filter, changes = update
+            key = tuple(filter.values())
+            inserting = key not in rollups
+            if inserting:
+                rollups[key] = _upsert_base(filter)
+            _apply_update(rollups[key], changes, inserting)
+        db[self.staging_table_name].replace_one(
+            {"_id": docs[0]["_id"]},
+            {"range": range_index, "rollups": list(rollups.values())},
+            upsert=True)
+
+    def start(self, db: Database) -> None:
+        db.drop_collection(self.staging_table_name)
+
+    def finish(self, db: Database) -> None:
+        db[self.staging_table_name].aggregate([
+            {"$unwind": "$rollups"},
+            {"$replaceRoot": {"newRoot": "$rollups"}},
+            {"$sort": {"first_timestamp": ASCENDING}},
+            {"$group": {
+                "_id": {
+                    "user_id": "$user_id",
+                    "category": "$category",
+                    "description": "$description",
+                },
+                "total": {"$sum": "$total"},
+                "count": {"$sum": "$count"},
+                "first_timestamp": {"$min": "$first_timestamp"},
+                "last_timestamp": {"$max": "$last_timestamp"},
+                "user_name": {"$first": "$user_name"},
+            }},
+            {"$project": {
+                "_id": 0,
+                "user_id": "$_id.user_id",
+                "category": "$_id.category",
+                "description": "$_id.description",
+                "total": 1,
+                "count": 1,
+                "first_timestamp": 1,
+                "last_timestamp": 1,
+                "user_name": 1,
+            }},
+            {"$out": TelegramStore.rollup_table_name},
+        ], allowDiskUse=True)
+        db.drop_collection(self.staging_table_name)
+        db[TelegramStore.state_table_name].update_one(
+            {"name": TelegramStore.ROLLUPS_BUILT},
+            {"$set": {"at": datetime.now(timezone.utc)}}, upsert=True)
+
+
+JOBS = {
+    "metadata_fields": MetadataFields,
+    "compact_updates": CompactUpdates,
+    "rollups": Rollups,
+}
+
+
+def split(db: Database, table_name: str, ranges: int, sample: int) -> list:
+    """Returns ranges - 1 _id boundaries that split table_name into ranges of
+    about the same size, from a random sample of its _ids."""
+    ids = sorted(doc["_id"] for doc in db[table_name].aggregate([
+        {"$sample": {"size": sample * ranges}},
+        {"$project": {"_id": 1}},
+    ]))
+    return sorted(set(ids[len(ids) * i // ranges] for i in range(1, ranges)
+                      if ids))
+
+
+def process_range(
+        db: Database,
+        job_name: str,
+        range_index: int,
+        low,
+        high,
+        batch_size: int) -> int:
+    """Runs job_name over the documents with low <= _id < high, from the
+    range's checkpoint. Returns the number of documents processed."""
+    job = JOBS[job_name]()
+    checkpoints = db[CHECKPOINT_TABLE]
+    checkpoint_id = f"{job_name}:{range_index}"
+    checkpoint = checkpoints.find_one({"_id": checkpoint_id}) or {}
+    if checkpoint.get("done"):
+        return 0
+    processed = 0
+    last = checkpoint.get("last_id")
+    while True:
+        bounds = {}
+        if low is not None:
+            bounds["$gte"] = low
+        if high is not None:
+            bounds["$lt"] = high
+        if last is not None:
+            bounds["$gt"] = last
+        filter = {"_id": bounds} if bounds else {}
+        docs = list(db[job.table_name].find(filter, job.projection)
+                    .sort("_id", ASCENDING).limit(batch_size))
+        if not docs:
+            break
+        job.write(db, range_index, docs)
+        last = docs[-1]["_id"]
+        processed += len(docs)
+        checkpoints.update_one(
+            {"_id": checkpoint_id},
+            {"$set": {"last_id": last}, "$inc": {"processed": len(docs)}},
+            upsert=True)
+    checkpoints.update_one(
+        {"_id": checkpoint_id}, {"$set": {"done": True}}, upsert=True)
+    return processed
+
+
+def _worker(mongo_uri: str, db_name: str, *args) -> int:
+    # Mongo clients aren't fork safe, every worker connects on its own.
+    client = MongoClient(mongo_uri)
+    try:
+        return process_range(client[db_name], *args)
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--mongo_uri", type=str,
+                        default="mongodb://localhost:27017")
+    parser.add_argument("--bot_name", type=str, default="lipok")
+    parser.add_argument("--job", type=str, required=True, choices=list(JOBS))
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--ranges", type=int, default=0,
+                        help="The number of _id ranges. Defaults to 4 per worker.")
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--sample", type=int, default=100,
+                        help="The number of _ids sampled per range to pick the boundaries.")
+    parser.add_argument("--restart", action="store_true",
+                        help="Drop the checkpoints of --job and start over.")
+    args = parser.parse_args()
+
+    db_name = TelegramStore.get_db_name(args.bot_name)
+    db = MongoClient(args.mongo_uri)[db_name]
+    job = JOBS[args.job]()
+    checkpoints = db[CHECKPOINT_TABLE]
+    if args.restart:
+        checkpoints.delete_many({"_id": {"$regex": f"^{args.job}(:|$)"}})
+
+    # The boundaries are checkpointed too, so that a resume uses the same
+    # ranges as the run it resumes.
+    plan = checkpoints.find_one({"_id": args.job})
+    if plan is None:
+        boundaries = split(db, job.table_name,
+                           args.ranges or 4 * args.workers, args.sample)
+        job.start(db)
+        checkpoints.insert_one({"_id": args.job, "boundaries": boundaries})
+    else:
+        boundaries = plan["boundaries"]
+        print(f"Resuming {args.job} over {len(boundaries) + 1} ranges")
+    edges = [None, *boundaries, None]
+
+    t0 = time.perf_counter()
+    processed = 0
+    with ProcessPoolExecutor(args.workers) as pool:
+        futures = [
+            pool.submit(_worker, args.mongo_uri, db_name, args.job, i,
+                        edges[i], edges[i + 1], args.batch_size)
+            for i in range(len(edges) - 1)]
+        for done, future in enumerate(as_completed(futures), 1):
+            processed += future.result()
+            print(f"{done}/{len(futures)} ranges done, {processed} documents "
+                  f"in {time.perf_counter() - t0:.0f}s")
+
+    job.finish(db)
+    checkpoints.delete_many({"_id": {"$regex": f"^{args.job}(:|$)"}})
+    print(f"Backfilled {args.job} over {processed} documents of "
+          f"{db_name}.{job.table_name}")
+
+
+if __name__ == '__main__':
+    main()
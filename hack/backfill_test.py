@@ -0,0 +1,182 @@
+import unittest
+import mongomock
+from datetime import datetime, timedelta
+from unittest import mock
+from telegram import Update, Message, Chat, User, MessageEntity, PhotoSize
+import backfill
+from backfill import JOBS, CHECKPOINT_TABLE, Rollups, process_range, split
+from bots.lipok import LipokBotUpdate
+from store.db import MongoManager, TelegramStore
+
+TEST_USER_ID = 123
+TEST_USER_NAME = "ram"
+
+PATHS = [
+    "/start",
+    "/start:food:rice:within:0-50",
+    "/start:food:rice:outside:50-100",
+    "/start:food:wheat:within:custom:20",
+    "/start:fuel:gas:within:100-200",
+    "/start:food:rice:within:custom:abc",
+]
+
+
+class CrashingRollups(Rollups):
+    """Rollups that crash after writing its second batch, before the
+    batch is checkpointed."""
+    writes = 0
+
+    def write(self, db, range_index, docs):
+        super().write(db, range_index, docs)
+        self.writes += 1
+        if self.writes == 2:
+            raise RuntimeError("crash")
+
+
+class TestBackfill(unittest.TestCase):
+
+    def setUp(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        self.client = mongomock.MongoClient()
+        self.db = self.client[TelegramStore.get_db_name("test")]
+
+    def _insert_metadata(self, parsed=True, users=3):
+        start = datetime(2024, 1, 1)
+        docs = []
+        for user_id in range(users):
+            for i, path in enumerate(PATHS):
+                selection_path = f"{user_id}:{path}"
+                doc = {
+                    "update_id": user_id * len(PATHS) + i,
+                    "selection_path": selection_path,
+                    "timestamp": start + timedelta(days=i),
+                    "user_id": user_id,
+                    "user_name": TEST_USER_NAME,
+                }
+                if parsed:
+                    doc.update(LipokBotUpdate.parse_selection_path(selection_path))
+                docs.append(doc)
+        self.db[TelegramStore.metadata_table_name].insert_many(docs)
+
+    def _run(self, job_name, ranges=3, batch_size=2):
+        """Runs job_name like main, with the ranges processed in turn."""
+        job = JOBS[job_name]()
+        job.start(self.db)
+        table = self.db[job.table_name]
+        edges = [None, *split(self.db, job.table_name, ranges, 10), None]
+        processed = sum(
+            process_range(self.db, job_name, i, edges[i], edges[i + 1],
+                          batch_size)
+            for i in range(len(edges) - 1))
+        self.assertEqual(processed, table.count_documents({}))
+        job.finish(self.db)
+        self.db[CHECKPOINT_TABLE].drop()
+
+    def _store(self) -> TelegramStore:
+        ts = TelegramStore(MongoManager(client=self.client), bot_name="test")
+        ts.wait_for_indices()
+        return ts
+
+    def test_split(self):
+        self._insert_metadata(users=10)
+        boundaries = split(self.db, TelegramStore.metadata_table_name, 4, 10)
+        self.assertEqual(len(boundaries), 3)
+        self.assertEqual(boundaries, sorted(boundaries))
+
+    def test_metadata_fields(self):
+        self._insert_metadata(parsed=False)
+        self._run("metadata_fields")
+        # Parsing again changes nothing.
+        self._run("metadata_fields")
+        for doc in self.db[TelegramStore.metadata_table_name].find():
+            parsed = LipokBotUpdate.parse_selection_path(doc["selection_path"])
+            self.assertEqual({k: doc[k] for k in parsed}, parsed)
+
+    def test_compact_updates(self):
+        user = User(id=TEST_USER_ID, first_name=TEST_USER_NAME, is_bot=False)
+        chat = Chat(id=TEST_USER_ID, type="private", first_name=TEST_USER_NAME)
+        updates = self.db[TelegramStore.update_table_name]
+        updates.insert_many([
+            Update(update_id=1, message=Message(
+                message_id=1, date=datetime.now(), chat=chat, from_user=user,
+                text="/start",
+                entities=[MessageEntity("bot_command", 0, 6)])).to_dict(),
+            Update(update_id=2, message=Message(
+                message_id=2, date=datetime.now(), chat=chat, from_user=user,
+                caption="receipt",
+                photo=[PhotoSize("receipt", "r1", 800, 800)])).to_dict(),
+        ])
+        self._run("compact_updates")
+        text = updates.find_one({"update_id": 1})
+        self.assertNotIn("entities", text["message"])
+        self.assertEqual(text["message"]["chat"],
+                         {"id": TEST_USER_ID, "type": "private"})
+        photo = updates.find_one({"update_id": 2})
+        self.assertEqual(photo["message"]["caption"], "receipt")
+        self.assertEqual(photo["message"]["photo"][0]["file_id"], "receipt")
+
+    def test_rollups(self):
+        self._insert_metadata()
+        # A later entry under another name, the earliest entry's is kept.
+        self.db[TelegramStore.metadata_table_name].update_one(
+            {"update_id": 2 * len(PATHS) - 2}, {"$set": {"user_name": "ramu"}})
+        ts = self._store()
+        expected = ts.get_rollups(1)
+        self.assertEqual(expected["user_name"], TEST_USER_NAME)
+        self.db[TelegramStore.rollup_table_name].drop()
+        self.db[TelegramStore.state_table_name].drop()
+
+        self._run("rollups")
+        self.assertEqual(ts.get_rollups(1), expected)
+        self.assertEqual(
+            ts.get_rollups(1)["category_totals"], {"food": 170, "fuel": 200})
+        self.assertTrue(ts.is_marked(TelegramStore.ROLLUPS_BUILT))
+        self.assertNotIn(Rollups.staging_table_name,
+                         self.db.list_collection_names())
+
+    def test_resume_after_crash(self):
+        self._insert_metadata()
+        job = Rollups()
+        job.start(self.db)
+        checkpoints = self.db[CHECKPOINT_TABLE]
+        with mock.patch.dict(backfill.JOBS, {"rollups": CrashingRollups}):
+            with self.assertRaises(RuntimeError):
+                process_range(self.db, "rollups", 0, None, None, 4)
+        # The second batch was written, but only the first checkpointed.
+        first_batch = list(self.db[Rollups.table_name].find().sort("_id").limit(4))
+        checkpoint = checkpoints.find_one({"_id": "rollups:0"})
+        self.assertEqual(checkpoint["last_id"], first_batch[-1]["_id"])
+        self.assertEqual(checkpoint["processed"], 4)
+
+        # The resume writes the second batch again, and the rest.
+        processed = process_range(self.db, "rollups", 0, None, None, 4)
+        self.assertEqual(processed, 3 * len(PATHS) - 4)
+        self.assertTrue(checkpoints.find_one({"_id": "rollups:0"})["done"])
+        self.assertEqual(process_range(self.db, "rollups", 0, None, None, 4), 0)
+        job.finish(self.db)
+
+        ts = self._store()
+        for user_id in range(3):
+            self.assertEqual(ts.get_rollups(user_id)["category_totals"],
+                             {"food": 170, "fuel": 200})
+
+    def test_rewrite_batch(self):
+        self._insert_metadata()
+        job = Rollups()
+        job.start(self.db)
+        for _ in range(2):
+            # The checkpoint is lost, every batch is written again.
+            self.db[CHECKPOINT_TABLE].drop()
+            process_range(self.db, "rollups", 0, None, None, 4)
+        job.finish(self.db)
+        ts = self._store()
+        self.assertEqual(ts.get_rollups(2)["category_totals"],
+                         {"food": 170, "fuel": 200})
+        # One per user and (category, description).
+        self.assertEqual(
+            self.db[TelegramStore.rollup_table_name].count_documents({}), 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+"""Measures the cost of dispatching a Lipok button press.
+
+Runs handle_button over --presses button presses, cycling through the
+category, subcategory and source buttons of every menu path, and reports
+the mean and p50/p99 time per press, and the time to get one keyboard.
+Nothing leaves the process: the store is a MemoryManager and the Bot API
+calls are answered by a local request object, so the times are the
+handler's own work. The "cached" mode serves the keyboards from
+LipokBot.keyboards, the "rebuilt" mode rebuilds them on every press, like
+the handlers did before the keyboards were cached.
+
+Usage:
+    $ python hack/bench_buttons.py --presses 20000
+"""
+
+import common
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import time
+from types import SimpleNamespace
+from telegram import Bot, Update
+from telegram.request import BaseRequest
+from bots.lipok import LipokBot, handle_button
+from translations.lipok import LANGUAGE
+from store.db import TelegramStore
+from store.memory import MemoryManager
+
+
+class LocalRequest(BaseRequest):
+    """Answers every Bot API call in process, getMe with a bot user and the
+    rest with True."""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        result = True
+        if url.endswith("/getMe"):
+            result = {"id": 1, "is_bot": True, "first_name": "bench",
+                      "username": "bench_bot"}
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class RebuiltKeyboards(dict):
+    """Builds the keyboard of a node on every lookup."""
+
+    def __getitem__(self, key):
+        return LipokBot.build_keyboard(*key)
+
+
+def presses() -> list[str]:
+    """Returns the callback_data of every category, subcategory and source
+    button."""
+    data = []
+    for category, subcategories in LipokBot.MENU.items():
+        data.append(f"category:{category}")
+        for subcategory in subcategories:
+            data.append(f"subcategory:{category}:{subcategory}")
+            data.append(f"source:{category}:{subcategory}:within")
+    return data
+
+
+def _update(update_id: int, data: str) -> dict:
+    user = {"id": 1000 + update_id % 100, "is_bot": False, "first_name": "user"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(datetime.datetime.now().timestamp()),
+                "chat": {"id": user["id"], "type": "private"},
+                "text": "Choose",
+            },
+        },
+    }
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def bench(bot: Bot, n: int) -> list[float]:
+    data = presses()
+    updates = [Update.de_json(_update(i, data[i % len(data)]), bot)
+               for i in range(n)]
+    latencies = []
+    for update in updates:
+        context = SimpleNamespace(
+            user_data={LipokBot.SELECTION_PATH: "/start"})
+        start = time.perf_counter()
+        await handle_button(update, context)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--presses", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+    logging.getLogger("bots.lipok").setLevel(logging.WARNING)
+
+    TelegramStore(MemoryManager(), bot_name="bench_buttons").wait_for_indices()
+    bot = Bot("1:bench", request=LocalRequest(), get_updates_request=LocalRequest())
+    await bot.initialize()
+
+    # The modes take turns, so that the store's growth and warm up don't
+    # favor either.
+    cached = LipokBot.keyboards
+    modes = {"cached": cached, "rebuilt": RebuiltKeyboards()}
+    latencies = {mode: [] for mode in modes}
+    for _ in range(args.rounds):
+        for mode, keyboards in modes.items():
+            LipokBot.keyboards = keyboards
+            latencies[mode].extend(
+                await bench(bot, args.presses // args.rounds))
+    LipokBot.keyboards = cached
+
+    print(f"{args.presses} presses of {len(presses())} buttons")
+    print(f"{'keyboards':<10}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}"
+          f"{'keyboard us':>14}")
+    for mode, keyboards in modes.items():
+        start = time.perf_counter()
+        for node in LipokBot.menu_nodes():
+            keyboards[(LANGUAGE, node)]
+        keyboard = (time.perf_counter() - start) / len(LipokBot.menu_nodes())
+        values = latencies[mode]
+        print(f"{mode:<10}{sum(values) / len(values) * 1e6:>10.1f}"
+              f"{percentile(values, 0.5) * 1e6:>10.1f}"
+              f"{percentile(values, 0.99) * 1e6:>10.1f}"
+              f"{keyboard * 1e6:>14.1f}")
+
+if __name__ == '__main__':
+    asyncio.run(main())
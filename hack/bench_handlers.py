@@ -0,0 +1,175 @@
+"""Measures handler latency under concurrent users.
+
+Every simulated button press does what a Lipok handler does against the
+store: insert the update, insert its metadata and, every few presses, read
+the user's metadata back for a summary. The "sync" mode calls the blocking
+TelegramStore methods from inside the coroutine (the old handler code), the
+"async" mode awaits the *_async methods.
+
+Usage:
+    # Against mongomock, with an artificial round-trip latency, see
+    # SlowMongoManager.
+    $ python hack/bench_handlers.py --users 50 --presses 10 --latency_ms 20 --interval_ms 500
+
+    # Against a real mongod, through AsyncMongoManager, ie motor.
+    $ python hack/bench_handlers.py --mongo_uri mongodb://localhost:27017
+"""
+
+import common
+import argparse
+import asyncio
+import datetime
+import time
+import mongomock
+from telegram import Update, Message, Chat, User
+from store.db import MongoManager, AsyncMongoManager, TelegramStore
+
+
+class SlowMongoManager(MongoManager):
+    """A MongoManager that sleeps to emulate a network round-trip.
+
+    The blocking methods block on the sleep, the awaitable ones await it,
+    like AsyncMongoManager awaits motor, instead of DBManager's default of
+    running the blocking method in a worker thread. The mongomock call
+    itself doesn't wait on anything.
+    """
+
+    def __init__(self, latency: float, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    def insert(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return super().insert(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return super().update(*args, **kwargs)
+
+    def find(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return super().find(*args, **kwargs)
+
+    async def insert_async(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        return super().insert(*args, **kwargs)
+
+    async def update_async(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        return super().update(*args, **kwargs)
+
+    async def find_async(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        return super().find(*args, **kwargs)
+
+
+def _update(user_id: int, update_id: int) -> Update:
+    u = User(id=user_id, first_name=f"user{user_id}", is_bot=False)
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            text="food",
+            from_user=u,
+        ),
+    )
+
+
+def _metadata(update: Update) -> dict:
+    return {
+        "update_id": update.update_id,
+        "selection_path": f"{update.effective_user.id}:/start:food:rice:within:0-50",
+        "timestamp": datetime.datetime.now(),
+        "user_id": update.effective_user.id,
+        "user_name": update.effective_user.name,
+    }
+
+
+async def sync_handler(ts: TelegramStore, update: Update, summary: bool):
+    ts.insert_update(update)
+    ts.insert_metadata(_metadata(update))
+    if summary:
+        ts.get_metadata(update.effective_user.id)
+
+
+async def async_handler(ts: TelegramStore, update: Update, summary: bool):
+    await ts.insert_update_async(update)
+    await ts.insert_metadata_async(_metadata(update))
+    if summary:
+        await ts.get_metadata_async(update.effective_user.id)
+
+
+async def run(
+        handler,
+        ts: TelegramStore,
+        users: int,
+        presses: int,
+        interval: float,
+        first_update_id: int = 0) -> list[float]:
+    """Runs every user's presses concurrently, returns per-press latencies.
+
+    Each user presses a button every interval seconds. Latency is measured
+    from when the press was due to when its handler finished, so time spent
+    waiting behind another user's blocked handler is included. The presses
+    are updates first_update_id and up, so that a run doesn't repeat the
+    updates of an earlier one, whose inserts would be duplicate no-ops.
+    """
+    latencies = []
+    t0 = time.perf_counter()
+
+    async def user(user_id):
+        for i in range(presses):
+            due = t0 + i * interval
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+            update = _update(
+                user_id, first_update_id + (user_id - 1) * presses + i)
+            await handler(ts, update, summary=(i % 5 == 4))
+            latencies.append(time.perf_counter() - due)
+
+    await asyncio.gather(*(user(u) for u in range(1, users + 1)))
+    return latencies
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--presses", type=int, default=10)
+    parser.add_argument("--interval_ms", type=float, default=500,
+                        help="Time between two presses of the same user.")
+    parser.add_argument("--latency_ms", type=float, default=20,
+                        help="Emulated round-trip latency for mongomock.")
+    parser.add_argument("--mongo_uri", type=str, default="",
+                        help="Benchmark a real mongod instead of mongomock.")
+    args = parser.parse_args()
+
+    if args.mongo_uri:
+        manager = AsyncMongoManager(args.mongo_uri)
+    else:
+        manager = SlowMongoManager(
+            args.latency_ms / 1000, client=mongomock.MongoClient())
+    ts = TelegramStore(manager, bot_name="bench")
+
+    print(f"{'mode':<8}{'p50 ms':>10}{'p99 ms':>10}{'total s':>10}")
+    modes = [("sync", sync_handler), ("async", async_handler)]
+    for i, (name, handler) in enumerate(modes):
+        start = time.perf_counter()
+        latencies = asyncio.run(run(
+            handler, ts, args.users, args.presses, args.interval_ms / 1000,
+            first_update_id=i * args.users * args.presses))
+        total = time.perf_counter() - start
+        print(f"{name:<8}{percentile(latencies, 0.5) * 1000:>10.1f}"
+              f"{percentile(latencies, 0.99) * 1000:>10.1f}{total:>10.2f}")
+
+    if args.mongo_uri:
+        manager._drop_database(ts.db_name)
+
+
+if __name__ == '__main__':
+    main()
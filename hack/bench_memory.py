@@ -0,0 +1,95 @@
+"""Loads synthetic metadata into the in-memory store and times queries.
+
+Loads --rows priced metadata spread over --users users, then times the
+queries the bots make: a user's metadata (get_metadata), a user's metadata
+in a time range, and a bulk lookup of updates by id (find_in). Use --mongomock
+to compare against mongomock, with far fewer rows.
+
+Usage:
+    $ python hack/bench_memory.py --rows 1000000 --users 1000
+    $ python hack/bench_memory.py --rows 20000 --users 1000 --mongomock
+"""
+
+import common
+import argparse
+import datetime
+import random
+import time
+import mongomock
+from store.db import MongoManager, TelegramStore
+from store.memory import MemoryManager
+
+
+def _metadata(update_id: int, user_id: int, start: datetime.datetime) -> dict:
+    return {
+        "update_id": update_id,
+        "selection_path": f"{user_id}:/start:food:rice:within:0-50",
+        "timestamp": start + datetime.timedelta(minutes=update_id),
+        "user_id": user_id,
+        "user_name": f"user{user_id}",
+        "category": "food",
+        "subcategory": "rice",
+        "source": "within",
+        "price_low": 0,
+        "price_high": 50,
+        "is_custom": False,
+    }
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--batch_size", type=int, default=10000)
+    parser.add_argument("--mongomock", action="store_true",
+                        help="Benchmark mongomock instead of MemoryManager.")
+    args = parser.parse_args()
+
+    if args.mongomock:
+        manager = MongoManager(client=mongomock.MongoClient())
+    else:
+        manager = MemoryManager()
+    ts = TelegramStore(manager, bot_name="bench")
+    ts.wait_for_indices()
+    table = TelegramStore.metadata_table_name
+
+    start = datetime.datetime(2024, 1, 1)
+    t0 = time.perf_counter()
+    for i in range(0, args.rows, args.batch_size):
+        manager.insert_many(
+            [_metadata(u, u % args.users, start)
+             for u in range(i, min(i + args.batch_size, args.rows))],
+            ts.db_name, table, TelegramStore.unique_keys[table])
+    print(f"Loaded {args.rows} rows in {time.perf_counter() - t0:.1f}s")
+
+    users = [random.randrange(args.users) for _ in range(args.queries)]
+    day = datetime.timedelta(days=1)
+    queries = {
+        "user": lambda u: ts.get_metadata(u),
+        "user+day": lambda u: manager.find(
+            {"user_id": u, "timestamp": {
+                "$gte": start + u * day / args.users, "$lt": start + day * 30}},
+            0, ts.db_name, table),
+        "find_in": lambda u: manager.find_in(
+            "update_id", list(range(u, u + 1000)), ts.db_name, table),
+    }
+    print(f"{'query':<10}{'rows':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, query in queries.items():
+        latencies, rows = [], 0
+        for u in users:
+            t = time.perf_counter()
+            rows += len(query(u))
+            latencies.append(time.perf_counter() - t)
+        print(f"{name:<10}{rows // len(users):>8}"
+              f"{percentile(latencies, 0.5) * 1000:>10.2f}"
+              f"{percentile(latencies, 0.99) * 1000:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Compares the SQLite and mongo backends of the store.
+
+For each backend, inserts --users * --presses button presses (an update and
+a priced metadata each, like a Lipok handler), then builds every user's
+summary from their metadata and from their rollups. Reports the p50/p99
+latency of each step, the peak python memory of the summaries and the size
+of the data on disk.
+
+Usage:
+    # SQLite only, mongomock isn't a meaningful comparison.
+    $ python hack/bench_store.py --users 20 --presses 200
+
+    # SQLite vs a real mongod.
+    $ python hack/bench_store.py --mongo_uri mongodb://localhost:27017
+"""
+
+import common
+import argparse
+import datetime
+import os
+import tempfile
+import time
+import tracemalloc
+from telegram import Update, Message, Chat, User
+from store.db import MongoManager, TelegramStore
+from store.sqlite import SQLiteManager
+from summary import metadata_to_totals
+
+
+def _update(user_id: int, update_id: int) -> Update:
+    u = User(id=user_id, first_name=f"user{user_id}", is_bot=False)
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            text="food",
+            from_user=u,
+        ),
+    )
+
+
+def _metadata(update: Update) -> dict:
+    user = update.effective_user
+    return {
+        "update_id": update.update_id,
+        "selection_path": f"{user.id}:/start:food:rice:within:0-50",
+        "timestamp": datetime.datetime.now(),
+        "user_id": user.id,
+        "user_name": user.name,
+        "category": "food",
+        "subcategory": "rice",
+        "source": "within",
+        "price_low": 0,
+        "price_high": 50,
+        "is_custom": False,
+    }
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def timed(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def bench(ts: TelegramStore, users: int, presses: int) -> dict:
+    def press(update):
+        ts.insert_update(update)
+        ts.insert_metadata(_metadata(update))
+
+    inserts = [timed(press, _update(u, u * presses + i))
+               for i in range(presses) for u in range(1, users + 1)]
+
+    def summary(user_id):
+        metadata_to_totals(ts.get_metadata(
+            user_id, projection=TelegramStore.LIPOK_SUMMARY))
+
+    summaries = [timed(summary, u) for u in range(1, users + 1)]
+    # tracemalloc slows allocations down, so it gets a separate pass.
+    tracemalloc.start()
+    for u in range(1, users + 1):
+        summary(u)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rollups = [timed(ts.get_rollups, u) for u in range(1, users + 1)]
+    return {
+        "insert": inserts,
+        "summary": summaries,
+        "rollups": rollups,
+        "peak_mb": peak / 2**20,
+    }
+
+
+def mongo_size(manager: MongoManager, db_name: str) -> float:
+    stats = manager.client[db_name].command("dbstats")
+    return (stats["storageSize"] + stats["indexSize"]) / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--presses", type=int, default=200)
+    parser.add_argument("--mongo_uri", type=str, default="",
+                        help="Also benchmark the mongod at this uri.")
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    path = os.path.join(tmp.name, "bench.sqlite3")
+    backends = [("sqlite", SQLiteManager(path), lambda ts: (
+        sum(os.path.getsize(f"{path}{ext}") for ext in ["", "-wal"]
+            if os.path.exists(f"{path}{ext}")) / 2**20))]
+    if args.mongo_uri:
+        backends.append(("mongo", MongoManager(args.mongo_uri),
+                         lambda ts: mongo_size(ts._db_manager, ts.db_name)))
+
+    print(f"{args.users} users x {args.presses} presses")
+    print(f"{'backend':<8}{'step':<10}{'p50 ms':>10}{'p99 ms':>10}")
+    sizes = []
+    for name, manager, size in backends:
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        ts = TelegramStore(manager, bot_name="bench")
+        ts.wait_for_indices()
+        results = bench(ts, args.users, args.presses)
+        for step in ["insert", "summary", "rollups"]:
+            print(f"{name:<8}{step:<10}"
+                  f"{percentile(results[step], 0.5) * 1000:>10.2f}"
+                  f"{percentile(results[step], 0.99) * 1000:>10.2f}")
+        sizes.append((name, results["peak_mb"], size(ts)))
+        manager._drop_database(ts.db_name)
+
+    print(f"{'backend':<8}{'summary peak MB':>18}{'on disk MB':>12}")
+    for name, peak, disk in sizes:
+        print(f"{name:<8}{peak:>18.2f}{disk:>12.2f}")
+    tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
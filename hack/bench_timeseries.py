@@ -0,0 +1,97 @@
+"""Compares metadata as a plain and as a time-series collection.
+
+Loads the same synthetic metadata into two scratch databases, one with a
+plain metadata collection and one with a time-series one, then reports the
+storage size of each and the latency of a 30 day summary per user
+(TelegramStore.get_metadata_summary with a date range). Needs a real mongod,
+mongomock has no time-series collections.
+
+Usage:
+    $ python hack/bench_timeseries.py --rows 200000 --users 500
+"""
+
+import common
+import argparse
+import datetime
+import random
+import time
+from store.db import MongoManager, TelegramStore
+
+
+def _metadata(update_id: int, user_id: int, start: datetime.datetime) -> dict:
+    category = random.choice(["food", "household", "fuel"])
+    price = random.randrange(10, 500)
+    return {
+        "update_id": update_id,
+        "selection_path": f"{user_id}:/start:{category}:rice:within:{price}",
+        "timestamp": start + datetime.timedelta(minutes=update_id),
+        "user_id": user_id,
+        "user_name": f"user{user_id}",
+        "category": category,
+        "subcategory": "rice",
+        "source": "within",
+        "price_low": price,
+        "price_high": price,
+        "is_custom": False,
+    }
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo_uri", type=str,
+                        default="mongodb://localhost:27017")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=5000)
+    args = parser.parse_args()
+
+    m = MongoManager(args.mongo_uri)
+    start = datetime.datetime(2024, 1, 1)
+    span = datetime.timedelta(minutes=args.rows)
+    users = [random.randrange(args.users) for _ in range(args.queries)]
+    table = TelegramStore.metadata_table_name
+
+    print(f"{'collection':<12}{'storage MB':>12}{'index MB':>10}"
+          f"{'p50 ms':>10}{'p99 ms':>10}")
+    for name, timeseries in [("plain", False), ("timeseries", True)]:
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        ts = TelegramStore(
+            m, bot_name=f"bench_{name}", timeseries_metadata=timeseries)
+        m._drop_database(ts.db_name)
+        if timeseries:
+            ts._setup_timeseries()
+        ts.sync_indices()
+
+        random.seed(0)
+        for i in range(0, args.rows, args.batch_size):
+            m.insert_many(
+                [ts._with_meta(_metadata(u, u % args.users, start))
+                 for u in range(i, min(i + args.batch_size, args.rows))],
+                ts.db_name, table)
+
+        latencies = []
+        for u in users:
+            # A 30 day window at a random point of the loaded range.
+            since = start + span * random.random()
+            t = time.perf_counter()
+            ts.get_metadata_summary(
+                u, start=since, end=since + datetime.timedelta(days=30))
+            latencies.append(time.perf_counter() - t)
+
+        stats = m.client[ts.db_name].command("collStats", table)
+        print(f"{name:<12}{stats['storageSize'] / 2**20:>12.2f}"
+              f"{stats['totalIndexSize'] / 2**20:>10.2f}"
+              f"{percentile(latencies, 0.5) * 1000:>10.2f}"
+              f"{percentile(latencies, 0.99) * 1000:>10.2f}")
+        m._drop_database(ts.db_name)
+
+
+if __name__ == '__main__':
+    main()
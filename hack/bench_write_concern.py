@@ -0,0 +1,83 @@
+"""Measures insert throughput under each durability profile.
+
+For every profile in TelegramStore.write_concerns, inserts --inserts
+updates through TelegramStore.insert_update from --threads threads, like
+concurrent handlers, and reports the inserts per second and the p50/p99
+latency of an insert. Needs a real mongod, mongomock ignores write concerns.
+The majority profile needs a replica set.
+
+Usage:
+    $ python hack/bench_write_concern.py --inserts 20000 --threads 8
+    $ python hack/bench_write_concern.py --profiles relaxed journaled
+"""
+
+import common
+import argparse
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update, Message, Chat, User
+from store.db import MongoManager, TelegramStore
+
+
+def _update(update_id: int) -> Update:
+    user_id = update_id % 1000
+    u = User(id=user_id, first_name=f"user{user_id}", is_bot=False)
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            text="food",
+            from_user=u,
+        ),
+    )
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo_uri", type=str,
+                        default="mongodb://localhost:27017")
+    parser.add_argument("--inserts", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--profiles", nargs="+",
+                        default=list(TelegramStore.write_concerns),
+                        choices=list(TelegramStore.write_concerns))
+    args = parser.parse_args()
+
+    updates = [_update(i) for i in range(args.inserts)]
+    print(f"{args.inserts} inserts from {args.threads} threads")
+    print(f"{'profile':<16}{'inserts/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for profile in args.profiles:
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        manager = MongoManager(args.mongo_uri)
+        ts = TelegramStore(
+            manager, bot_name=f"bench_{profile}",
+            write_profiles={TelegramStore.update_table_name: profile})
+        manager._drop_database(ts.db_name)
+        ts.sync_indices()
+
+        def insert(update):
+            start = time.perf_counter()
+            ts.insert_update(update)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as pool:
+            latencies = list(pool.map(insert, updates))
+        elapsed = time.perf_counter() - start
+        print(f"{profile:<16}{args.inserts / elapsed:>10.0f}"
+              f"{percentile(latencies, 0.5) * 1000:>10.2f}"
+              f"{percentile(latencies, 0.99) * 1000:>10.2f}")
+        manager._drop_database(ts.db_name)
+
+
+if __name__ == '__main__':
+    main()
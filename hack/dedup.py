@@ -0,0 +1,72 @@
+"""Removes duplicate updates and metadata left over by retried writes.
+
+Before ingestion was keyed on update_id, a retried insert (or a Telegram
+redelivery) could store the same update twice, and double count it in the
+rollups. This script keeps the oldest document of every update_id (and every
+(update_id, selection_path) for metadata), deletes the rest, creates the
+unique indices that keep it that way and rebuilds the rollups. It is safe to
+re-run. Pass --timeseries_metadata if the bot runs with it, so that the
+indices of the time-series metadata are created instead. Stop the bots that write to the db first, the rollups they update
+while this runs are overwritten.
+
+Usage:
+    $ python hack/dedup.py --bot_name billa
+"""
+
+import common
+import argparse
+from store.clients import registry
+from store.db import MongoManager, TelegramStore
+
+
+def dedup(collection, keys: list, batch_size: int) -> int:
+    """Deletes all but the first document of every group of keys."""
+    pipeline = [
+        {"$sort": {"_id": 1}},
+        {"$group": {
+            "_id": {k: f"${k}" for k in keys},
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1},
+        }},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    deleted = 0
+    stale = []
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        stale.extend(group["ids"][1:])
+        if len(stale) >= batch_size:
+            deleted += collection.delete_many(
+                {"_id": {"$in": stale}}).deleted_count
+            stale = []
+    if stale:
+        deleted += collection.delete_many({"_id": {"$in": stale}}).deleted_count
+    return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo_uri", type=str,
+                        default="mongodb://localhost:27017")
+    parser.add_argument("--bot_name", type=str, default="billa")
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--timeseries_metadata", action="store_true",
+                        help="The bot stores metadata in a time-series collection.")
+    args = parser.parse_args()
+
+    m = MongoManager(
+        args.mongo_uri, client_options=registry.maintenance_options)
+    ts = TelegramStore(m, bot_name=args.bot_name, maintenance=True,
+                       timeseries_metadata=args.timeseries_metadata)
+
+    db = m.client[ts.db_name]
+    for table, keys in TelegramStore.unique_keys.items():
+        deleted = dedup(db[table], keys, args.batch_size)
+        print(f"Deleted {deleted} duplicate documents from {table}")
+
+    ts.sync_indices()
+    ts.rebuild_rollups()
+    print(f"Rebuilt rollups in {ts.db_name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Prints the declared indices and the TelegramStore queries they serve.
+
+With --bot_name, the declared indices are also compared against the ones
+that exist in that bot's database.
+
+Usage:
+    $ python hack/index_report.py
+    $ python hack/index_report.py --bot_name billa
+"""
+
+import common
+import argparse
+from store.db import MongoManager, TelegramStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo_uri", type=str,
+                        default="mongodb://localhost:27017")
+    parser.add_argument("--bot_name", type=str, default="")
+    args = parser.parse_args()
+
+    print(TelegramStore.index_report())
+    if not args.bot_name:
+        return
+
+    m = MongoManager(args.mongo_uri)
+    db_name = TelegramStore.get_db_name(args.bot_name)
+    print(f"\nIndices in {db_name}:")
+    for table_name, specs in TelegramStore.index_specs.items():
+        existing = set(m.client[db_name][table_name].index_information())
+        existing.discard("_id_")
+        declared = {spec["name"] for spec in specs}
+        for name in sorted(declared | existing):
+            if name not in existing:
+                status = "missing"
+            elif name not in declared:
+                status = "stale"
+            else:
+                status = "ok"
+            print(f"  {table_name}.{name}: {status}")
+
+
+if __name__ == '__main__':
+    main()
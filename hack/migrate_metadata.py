@@ -0,0 +1,56 @@
+"""Backfills the parsed selection path fields on existing metadata.
+
+Metadata written before the structured schema only has the raw
+selection_path. This script parses it into category, subcategory, source,
+price_low, price_high and is_custom, and creates the (user_id, timestamp)
+index that get_metadata relies on. It is safe to re-run, only documents
+without a category field are touched.
+
+Usage:
+    $ python hack/migrate_metadata.py --bot_name billa
+"""
+
+import common
+import argparse
+from pymongo import UpdateOne
+from bots.lipok import LipokBotUpdate
+from store.clients import registry
+from store.db import MongoManager, TelegramStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo_uri", type=str,
+                        default="mongodb://localhost:27017")
+    parser.add_argument("--bot_name", type=str, default="billa")
+    parser.add_argument("--batch_size", type=int, default=1000)
+    args = parser.parse_args()
+
+    m = MongoManager(
+        args.mongo_uri, client_options=registry.maintenance_options)
+    db_name = TelegramStore.get_db_name(args.bot_name)
+    m.sync_indices(
+        db_name, TelegramStore.metadata_table_name,
+        TelegramStore.index_specs[TelegramStore.metadata_table_name],
+        droppable=TelegramStore.retired_indices.get(
+            TelegramStore.metadata_table_name, []))
+    collection = m.client[db_name][TelegramStore.metadata_table_name]
+
+    migrated = 0
+    ops = []
+    cursor = collection.find(
+        {"category": {"$exists": False}}, {"selection_path": 1})
+    for doc in cursor.batch_size(args.batch_size):
+        fields = LipokBotUpdate.parse_selection_path(doc["selection_path"])
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields}))
+        if len(ops) >= args.batch_size:
+            migrated += collection.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        migrated += collection.bulk_write(ops, ordered=False).modified_count
+
+    print(f"Migrated {migrated} metadata documents in {db_name}")
+
+
+if __name__ == '__main__':
+    main()
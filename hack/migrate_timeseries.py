@@ -0,0 +1,83 @@
+"""Converts the metadata collection to a time-series collection.
+
+Mongo can't convert a collection in place, so this:
+    1. Renames metadata to metadata_plain (skipped if that already exists).
+    2. Creates metadata as a time-series collection.
+    3. Copies metadata_plain into it, adding the {user_id, category} meta
+       field, in batches.
+    4. Creates the time-series indices and rebuilds the rollups.
+
+Stop the bot before running this, and start it with --timeseries_metadata
+afterwards. metadata_plain is kept as a backup, drop it once the bot works.
+Documents without a timestamp can't be stored in a time-series collection,
+they are counted and left in metadata_plain.
+
+If the copy is interrupted, re-run with --restart to drop the partially
+filled time-series collection and copy again.
+
+Usage:
+    $ python hack/migrate_timeseries.py --bot_name billa
+"""
+
+import common
+import argparse
+from store.clients import registry
+from store.db import MongoManager, TelegramStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo_uri", type=str,
+                        default="mongodb://localhost:27017")
+    parser.add_argument("--bot_name", type=str, default="billa")
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--restart", action="store_true",
+                        help="Drop the time-series collection and copy again.")
+    args = parser.parse_args()
+
+    m = MongoManager(
+        args.mongo_uri, client_options=registry.maintenance_options)
+    db_name = TelegramStore.get_db_name(args.bot_name)
+    db = m.client[db_name]
+    table = TelegramStore.metadata_table_name
+    backup = f"{table}_plain"
+
+    collections = {c["name"]: c for c in db.list_collections()}
+    if backup not in collections:
+        if collections.get(table, {}).get("type") == "timeseries":
+            print(f"{db_name}.{table} is already a time-series collection")
+            return
+        if table in collections:
+            db[table].rename(backup)
+            print(f"Renamed {db_name}.{table} to {backup}")
+    elif args.restart:
+        db.drop_collection(table)
+    elif table in collections:
+        raise SystemExit(
+            f"{db_name}.{table} exists, re-run with --restart to copy again")
+
+    TelegramStore._instance = None
+    TelegramStore._db_manager = None
+    ts = TelegramStore(
+        m, bot_name=args.bot_name, timeseries_metadata=True, maintenance=True)
+
+    copied, skipped, batch = 0, 0, []
+    for doc in db[backup].find().batch_size(args.batch_size):
+        if doc.get("timestamp") is None:
+            skipped += 1
+            continue
+        batch.append(ts._with_meta(doc))
+        if len(batch) >= args.batch_size:
+            copied += len(db[table].insert_many(batch).inserted_ids)
+            batch = []
+    if batch:
+        copied += len(db[table].insert_many(batch).inserted_ids)
+    print(f"Copied {copied} documents, skipped {skipped} without a timestamp")
+
+    ts.sync_indices()
+    ts.rebuild_rollups()
+    print(f"Rebuilt rollups in {db_name}, drop {backup} once the bot works")
+
+
+if __name__ == '__main__':
+    main()
@@ -91,8 +91,9 @@ def main():
         {"$sort": {"total_selections": -1}}
     ]
 
-    # Execute aggregation and fetch results
-    results = list(collection.aggregate(pipeline))
+    # Execute aggregation and stream the results, the cursor only holds one
+    # batch in memory at a time.
+    results = collection.aggregate(pipeline, allowDiskUse=True, batchSize=100)
 
     # Prepare data for DataFrame
     flattened_data = []
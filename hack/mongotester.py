@@ -9,7 +9,7 @@ TEST_DB_NAME = "testdb"
 TEST_COLLECTION_NAME = "testcollection"
 TELEGRAM_DB_NAME = db.TelegramStore.get_db_name(bot_name="ari")
 TELEGRAM_COLLECTION_NAME = db.TelegramStore.update_table_name
-INDICES = db.TelegramStore.indices
+INDICES = db.TelegramStore.index_specs[TELEGRAM_COLLECTION_NAME]
 
 
 def check_test_db(client):
@@ -29,7 +29,8 @@ def check_test_db(client):
 def check_telegram_db(client):
     db = client[TELEGRAM_DB_NAME]
     collection = db[TELEGRAM_COLLECTION_NAME]
-    collection.create_index(INDICES)
+    for spec in INDICES:
+        collection.create_index(spec["keys"], name=spec["name"])
     
 
     documents = collection.find()
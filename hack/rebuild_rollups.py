@@ -0,0 +1,33 @@
+"""Recomputes the per-user spending rollups from the raw metadata.
+
+Rollups are maintained on every priced metadata insert. Run this after
+changing how rollups are computed, or to repair them, eg after restoring a
+metadata backup. Stop the bots that write to the db first, the rollups they
+update while this runs are overwritten.
+
+Usage:
+    $ python hack/rebuild_rollups.py --bot_name billa
+"""
+
+import common
+import argparse
+from store.clients import registry
+from store.db import MongoManager, TelegramStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo_uri", type=str,
+                        default="mongodb://localhost:27017")
+    parser.add_argument("--bot_name", type=str, default="billa")
+    args = parser.parse_args()
+
+    m = MongoManager(
+        args.mongo_uri, client_options=registry.maintenance_options)
+    ts = TelegramStore(m, bot_name=args.bot_name, maintenance=True)
+    ts.rebuild_rollups()
+    print(f"Rebuilt {ts.db_name}.{ts.rollup_table_name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Reports how much smaller updates are in the compact schema.
+
+Samples --sample stored updates of a bot, and compares the BSON size of each
+as stored with its size after TelegramStore.compact_update. Updates that are
+already compact show no reduction, run this against a db with updates stored
+before compact_updates, or with --full_updates.
+
+Usage:
+    $ python hack/update_sizes.py --bot_name lipok --sample 10000
+"""
+
+import common
+import argparse
+import bson
+from collections import Counter
+from store.db import MongoManager, TelegramStore
+
+
+def percentile(values: list[int], p: float) -> int:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo_uri", type=str,
+                        default="mongodb://localhost:27017")
+    parser.add_argument("--bot_name", type=str, default="lipok")
+    parser.add_argument("--sample", type=int, default=10000)
+    args = parser.parse_args()
+
+    m = MongoManager(args.mongo_uri)
+    collection = m.client[TelegramStore.get_db_name(args.bot_name)][
+        TelegramStore.update_table_name]
+    sizes, compact_sizes, kinds = [], [], Counter()
+    for doc in collection.aggregate([{"$sample": {"size": args.sample}}]):
+        sizes.append(len(bson.encode(doc)))
+        compact_sizes.append(len(bson.encode(TelegramStore.compact_update(doc))))
+        kinds.update(k for k in doc if k not in ("_id", "update_id"))
+    if not sizes:
+        print("No updates found")
+        return
+
+    print(f"Sampled {len(sizes)} updates: "
+          + ", ".join(f"{n} {k}" for k, n in kinds.most_common()))
+    print(f"{'':<10}{'mean B':>10}{'p50 B':>10}{'p99 B':>10}")
+    for name, values in [("stored", sizes), ("compact", compact_sizes)]:
+        print(f"{name:<10}{sum(values) / len(values):>10.0f}"
+              f"{percentile(values, 0.5):>10}{percentile(values, 0.99):>10}")
+    print(f"Compact updates are {1 - sum(compact_sizes) / sum(sizes):.0%} smaller")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""Posts recorded updates to a bot's webhook server and measures throughput.
+
+The updates are read from --updates_file, one telegram update per line as
+JSON, or else from the updates collection of --bot_name. They are posted
+--repeat times, with fresh update_ids, from --concurrency connections at a
+time (telegram itself uses up to --webhook_max_connections, 40 by default),
+with the secret token in the X-Telegram-Bot-Api-Secret-Token header. The
+client reports the requests per second and the p50/p99 latency of a
+request.
+
+To run without network, the client also serves a fake Bot API on
+--fake_api_port, that answers getMe, setWebhook, sendMessage etc with canned
+results. Start the client first, then the bot against the fake Bot API. The
+client waits for the webhook server before it starts posting:
+
+    $ python hack/webhook_client.py --updates_file updates.jsonl \\
+        --url http://127.0.0.1:8443/bench --secret bench --fake_api_port 8081
+    $ API_KEY=123:bench WEBHOOK_SECRET=bench python chatbot.py --plugin lipok \\
+        --bot_name bench --store sqlite --mode webhook --concurrent_updates 8 \\
+        --bot_api_url http://127.0.0.1:8081/bot
+
+A webhook request returns once the update is queued, so the throughput is
+that of the webhook server. The number of Bot API calls that the handlers
+made, eg replies, is reported for the fake Bot API, to compare how many of
+the updates were handled.
+"""
+
+import common
+import argparse
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import httpx
+from store.db import MongoManager, TelegramStore
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    """Answers every Bot API method with a canned result, and counts the
+    calls of every method in calls."""
+
+    calls = Counter()
+    bot = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        self.calls[method] += 1
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        params = {}
+        if self.headers.get("Content-Type", "").startswith(
+                "application/x-www-form-urlencoded"):
+            params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        if method == "getMe":
+            result = self.bot
+        elif method.startswith(("send", "edit")):
+            result = {
+                "message_id": self.calls[method],
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 1)), "type": "private"},
+                "from": self.bot,
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        response = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_updates(args) -> list[dict]:
+    if args.updates_file:
+        with open(args.updates_file) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    m = MongoManager(args.mongo_uri)
+    updates = m.find(
+        {}, args.limit, TelegramStore.get_db_name(args.bot_name),
+        TelegramStore.update_table_name)
+    for update in updates:
+        update.pop("_id", None)
+        update.pop(TelegramStore.update_ttl_field, None)
+    return updates
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def wait_for_server(client: httpx.AsyncClient, url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            # The webhook server only accepts POSTs, any response means it's up.
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def post_all(args, updates: list[dict]) -> None:
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        print(f"Waiting for the webhook server at {args.url}...")
+        await wait_for_server(client, args.url, args.wait)
+
+        r = await client.post(args.url, json=updates[0],
+                              headers={SECRET_HEADER: "wrong" + args.secret})
+        print(f"A request with the wrong secret token got a {r.status_code}")
+
+        headers = {SECRET_HEADER: args.secret}
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies, statuses = [], Counter()
+
+        async def post(update_id: int, update: dict):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    r = await client.post(
+                        args.url, json={**update, "update_id": update_id},
+                        headers=headers)
+                    statuses[r.status_code] += 1
+                except httpx.TransportError as e:
+                    statuses[e.__class__.__name__] += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            post(i, update)
+            for i, update in enumerate(updates * args.repeat, args.first_update_id)])
+        elapsed = time.perf_counter() - start
+
+    print(f"Posted {len(latencies)} updates from {args.concurrency} "
+          f"connections in {elapsed:.2f}s: {len(latencies) / elapsed:.0f} req/s, "
+          f"p50 {percentile(latencies, 0.5) * 1000:.1f}ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+    print("Status codes: " + ", ".join(
+        f"{n} x {code}" for code, n in statuses.most_common()))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8443/ari",
+                        help="The webhook server, http://<webhook_listen>:<webhook_port>/<bot_name>.")
+    parser.add_argument("--secret", type=str, required=True,
+                        help="The WEBHOOK_SECRET of the bot.")
+    parser.add_argument("--updates_file", type=str, default="")
+    parser.add_argument("--mongo_uri", type=str,
+                        default="mongodb://localhost:27017")
+    parser.add_argument("--bot_name", type=str, default="lipok",
+                        help="Read the updates of this bot, without --updates_file.")
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--first_update_id", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=40)
+    parser.add_argument("--fake_api_port", type=int, default=0,
+                        help="Serve a fake Bot API on this port, 0 doesn't.")
+    parser.add_argument("--wait", type=float, default=60,
+                        help="Seconds to wait for the webhook server to come up.")
+    args = parser.parse_args()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    updates = load_updates(args)
+    if not updates:
+        print("No updates found")
+        return
+    server = None
+    if args.fake_api_port:
+        server = ThreadingHTTPServer(("127.0.0.1", args.fake_api_port), FakeBotAPI)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving a fake Bot API at "
+              f"http://127.0.0.1:{args.fake_api_port}/bot")
+
+    asyncio.run(post_all(args, updates))
+
+    if server:
+        # Wait for the handlers of the queued updates to call the Bot API.
+        calls = -1
+        while calls != sum(FakeBotAPI.calls.values()):
+            calls = sum(FakeBotAPI.calls.values())
+            time.sleep(2)
+        server.shutdown()
+        print("Bot API calls: " + ", ".join(
+            f"{n} {method}" for method, n in FakeBotAPI.calls.most_common()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""Cold-tier archival of raw telegram updates.
+
+The handlers store the full Update.to_dict() of every button press, but the
+summaries never read the raw updates again, so they end up as most of the
+data on disk and in mongo's cache. UpdateArchive moves the updates older
+than a retention period out of the updates collection, into one of:
+
+    CollectionArchive: the updates_archive collection, compressed with zstd
+        by mongo (see DBManager.create_compressed).
+    FileArchive: a zstd compressed file of BSON documents per month, eg
+        <directory>/<db_name>/updates-2024-01.bson.zst.
+
+and restores a month of them on demand.
+
+An update's age is its insert time, ie the time of its ObjectId _id, so
+finding old updates is a range scan of the _id index. The archived month is
+also that of the _id.
+
+Usage:
+    archive = UpdateArchive(TelegramStore(), FileArchive("/var/lib/count"))
+    archive.archive(days=90)
+    archive.restore("2024-01")
+
+See hack/archive_updates.py.
+"""
+
+import io
+import os
+import bson
+import logging
+import zstandard
+from bson import ObjectId
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+from pymongo import ASCENDING
+from typing import Any, Dict, Iterable, Iterator, List
+from store.db import DBManager, TelegramStore
+
+logger = logging.getLogger(__name__)
+
+
+def _month(_id: ObjectId) -> str:
+    """Returns the "YYYY-MM" month an _id was generated in."""
+    return _id.generation_time.strftime("%Y-%m")
+
+
+def _month_range(month: str) -> dict:
+    """Returns the filter on _id that matches the updates of month."""
+    start = datetime.strptime(month, "%Y-%m").replace(tzinfo=timezone.utc)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return {"_id": {
+        "$gte": ObjectId.from_datetime(start),
+        "$lt": ObjectId.from_datetime(end),
+    }}
+
+
+class CollectionArchive:
+    """CollectionArchive keeps archived updates in another collection.
+
+    The archive collection is created with zstd block compression, which
+    takes a fraction of the space of the snappy compressed updates
+    collection. Archived updates keep their _id, so archiving an update twice
+    is a no-op.
+    """
+
+    def __init__(
+            self,
+            db_manager: DBManager,
+            table_name: str = "updates_archive",
+            batch_size: int = 1000):
+        self._db_manager = db_manager
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self._created = set()
+
+    def write(self, db_name: str, month: str, docs: Iterable[Dict[str, Any]]) -> None:
+        if db_name not in self._created:
+            if not self._db_manager.create_compressed(db_name, self.table_name):
+                logger.info(
+                    f"{db_name}.{self.table_name} is not zstd compressed")
+            self._created.add(db_name)
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) >= self.batch_size:
+                self._db_manager.insert_many(batch, db_name, self.table_name)
+                batch = []
+        if batch:
+            self._db_manager.insert_many(batch, db_name, self.table_name)
+
+    def read(self, db_name: str, month: str) -> Iterator[Dict[str, Any]]:
+        return self._db_manager.iter_find(
+            _month_range(month), db_name, self.table_name,
+            batch_size=self.batch_size, sort=[("_id", ASCENDING)])
+
+    def drop(self, db_name: str, month: str) -> None:
+        self._db_manager.delete(_month_range(month), db_name, self.table_name)
+
+    def months(self, db_name: str) -> List[str]:
+        """Returns the archived months, with a lookup of the first _id of
+        each, so this costs a round-trip per month rather than a scan."""
+        months = []
+        filter = {}
+        while True:
+            first = next(iter(self._db_manager.iter_find(
+                filter, db_name, self.table_name, batch_size=1,
+                sort=[("_id", ASCENDING)], projection={"_id": 1})), None)
+            if first is None:
+                return months
+            months.append(_month(first["_id"]))
+            filter = {"_id": {"$gte": _month_range(months[-1])["_id"]["$lt"]}}
+
+
+class FileArchive:
+    """FileArchive keeps archived updates in a zstd compressed file per month.
+
+    Every file is a concatenation of zstd frames of BSON documents, so it can
+    also be read with `zstd -dc updates-2024-01.bson.zst | bsondump`. Files
+    are never modified in place: a write copies the month's file, appends a
+    frame and atomically replaces it, so a crash can't leave a torn file.
+    Unlike CollectionArchive, an update archived twice (eg after a crash
+    between the write and the delete from the updates collection) is stored
+    twice, and de-duplicated on restore.
+    """
+
+    def __init__(self, directory: str, level: int = 10):
+        self.directory = directory
+        self.level = level
+
+    def path(self, db_name: str, month: str) -> str:
+        return os.path.join(self.directory, db_name, f"updates-{month}.bson.zst")
+
+    def write(self, db_name: str, month: str, docs: Iterable[Dict[str, Any]]) -> None:
+        path = self.path(db_name, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            if os.path.exists(path):
+                with open(path, "rb") as existing:
+                    while chunk := existing.read(1 << 20):
+                        f.write(chunk)
+            compressor = zstandard.ZstdCompressor(level=self.level)
+            with compressor.stream_writer(f, closefd=False) as writer:
+                for doc in docs:
+                    writer.write(bson.encode(doc))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def read(self, db_name: str, month: str) -> Iterator[Dict[str, Any]]:
+        with open(self.path(db_name, month), "rb") as f:
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                f, read_across_frames=True)
+            yield from bson.decode_file_iter(io.BufferedReader(reader))
+
+    def drop(self, db_name: str, month: str) -> None:
+        os.remove(self.path(db_name, month))
+
+    def months(self, db_name: str) -> List[str]:
+        directory = os.path.join(self.directory, db_name)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            name[len("updates-"):-len(".bson.zst")]
+            for name in os.listdir(directory)
+            if name.startswith("updates-") and name.endswith(".bson.zst"))
+
+
+class UpdateArchive:
+    """UpdateArchive moves old updates between the store and a target, a
+    CollectionArchive or a FileArchive.
+
+    Updates are only deleted from the updates collection once the target
+    has durably stored them. The store's write buffer and journal are not
+    consulted, they only hold recent updates.
+    """
+
+    def __init__(
+            self,
+            store: TelegramStore,
+            target: CollectionArchive | FileArchive,
+            batch_size: int = 1000):
+        self.store = store
+        self.target = target
+        self.batch_size = batch_size
+
+    def archive(self, days: int, now: datetime = None) -> int:
+        """Moves the updates stored more than days ago to the target.
+
+        Returns the number of updates archived. The _ids of a month's
+        updates are held in memory until the month is written out.
+        """
+        now = now or datetime.now(timezone.utc)
+        cutoff = ObjectId.from_datetime(now - timedelta(days=days))
+        db_manager = self.store._db_manager
+        table_name = self.store.update_table_name
+        docs = db_manager.iter_find(
+            {"_id": {"$lt": cutoff}}, self.store.db_name, table_name,
+            batch_size=self.batch_size, sort=[("_id", ASCENDING)])
+        archived = 0
+        for month, updates in groupby(docs, key=lambda d: _month(d["_id"])):
+            ids = []
+
+            def _track(updates=updates, ids=ids):
+                for u in updates:
+                    ids.append(u["_id"])
+                    yield u
+            self.target.write(self.store.db_name, month, _track())
+            for i in range(0, len(ids), db_manager.find_in_chunk_size):
+                db_manager.delete(
+                    {"_id": {"$in": ids[i:i + db_manager.find_in_chunk_size]}},
+                    self.store.db_name, table_name)
+            logger.info(
+                f"Archived {len(ids)} updates of {month} from "
+                f"{self.store.db_name}.{table_name}")
+            archived += len(ids)
+        return archived
+
+    def restore(self, month: str) -> int:
+        """Moves a month of archived updates back to the updates collection.
+
+        Updates that are already in the collection are skipped. Returns the
+        number of updates restored. Restored updates are still old, and are
+        archived again by the next archive(), or expired by the TTL index if
+        update_ttl_days is set.
+        """
+        db_manager = self.store._db_manager
+        table_name = self.store.update_table_name
+        unique_key = self.store.unique_keys[table_name]
+        restored, batch = 0, []
+        for doc in self.target.read(self.store.db_name, month):
+            batch.append(doc)
+            if len(batch) >= self.batch_size:
+                restored += db_manager.insert_many(
+                    batch, self.store.db_name, table_name, unique_key)
+                batch = []
+        if batch:
+            restored += db_manager.insert_many(
+                batch, self.store.db_name, table_name, unique_key)
+        self.target.drop(self.store.db_name, month)
+        logger.info(
+            f"Restored {restored} updates of {month} to "
+            f"{self.store.db_name}.{table_name}")
+        return restored
+
+    def months(self) -> List[str]:
+        """Returns the archived months, oldest first."""
+        return self.target.months(self.store.db_name)
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+from bson import ObjectId
+from datetime import datetime, timezone
+from store.archive import CollectionArchive, FileArchive, UpdateArchive
+from store.db import TelegramStore
+from store.memory import MemoryManager
+
+
+class TestUpdateArchive(unittest.TestCase):
+
+    def setUp(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        self.manager = MemoryManager()
+        self.ts = TelegramStore(self.manager, bot_name="test")
+        self.ts.wait_for_indices()
+        self.now = datetime(2024, 4, 15, tzinfo=timezone.utc)
+        # Two updates in each of January, February, March and April.
+        self.manager.insert_many(
+            [self._update(i, datetime(2024, 1 + i // 2, 1 + i, tzinfo=timezone.utc))
+             for i in range(8)],
+            self.ts.db_name, self.ts.update_table_name)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _update(self, update_id, stored):
+        return {
+            "_id": ObjectId.from_datetime(stored),
+            "update_id": update_id,
+            "message": {"message_id": update_id, "text": "/start"},
+        }
+
+    def _update_ids(self):
+        return sorted(u["update_id"] for u in self.manager.find(
+            {}, 0, self.ts.db_name, self.ts.update_table_name))
+
+    def _round_trip(self, target):
+        archive = UpdateArchive(self.ts, target, batch_size=1)
+        # Older than 60 days, ie January and February.
+        self.assertEqual(archive.archive(days=60, now=self.now), 4)
+        self.assertEqual(self._update_ids(), [4, 5, 6, 7])
+        self.assertEqual(archive.months(), ["2024-01", "2024-02"])
+        self.assertEqual(archive.archive(days=60, now=self.now), 0)
+
+        # A later run appends to the month that was partially archived.
+        self.assertEqual(archive.archive(days=30, now=self.now), 2)
+        self.assertEqual(archive.months(), ["2024-01", "2024-02", "2024-03"])
+        self.assertEqual(
+            [u["update_id"] for u in target.read(self.ts.db_name, "2024-02")],
+            [2, 3])
+
+        self.assertEqual(archive.restore("2024-02"), 2)
+        self.assertEqual(self._update_ids(), [2, 3, 6, 7])
+        self.assertEqual(archive.months(), ["2024-01", "2024-03"])
+
+    def test_collection_archive(self):
+        self._round_trip(CollectionArchive(self.manager))
+
+    def test_file_archive(self):
+        target = FileArchive(self.tmp.name)
+        self._round_trip(target)
+        self.assertTrue(os.path.exists(target.path(self.ts.db_name, "2024-01")))
+
+    def test_file_archive_restore_skips_duplicates(self):
+        target = FileArchive(self.tmp.name)
+        archive = UpdateArchive(self.ts, target)
+        archive.archive(days=60, now=self.now)
+        # As if a crash between the write and the delete archived 0 twice.
+        target.write(self.ts.db_name, "2024-01", [self._update(
+            0, datetime(2024, 1, 1, tzinfo=timezone.utc))])
+        self.assertEqual(archive.restore("2024-01"), 2)
+        self.assertEqual(self._update_ids(), [0, 1, 4, 5, 6, 7])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+"""A process-wide registry of mongo clients.
+
+MongoClient is thread safe and owns a pool of connections, so a process
+needs one client per mongo uri rather than one per MongoManager. The
+registry hands out that shared client (and a shared motor client, for the
+async code paths), with the pool size and timeout settings of the process,
+and warms their pools at startup so that the first users after a deploy
+don't wait on connection setup. It also records how long every operation
+waited to check a connection out of a pool.
+
+Usage:
+    registry.configure(maxPoolSize=20, minPoolSize=4)
+    client = registry.client("mongodb://localhost:27017")
+    registry.warm()
+    registry.stats()
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+from typing import Any, Dict
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient, monitoring
+
+logger = logging.getLogger(__name__)
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    """PoolListener counts the connections of a client's pools and keeps the
+    checkout wait times of the last window checkouts."""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=window)
+        self.open = 0
+        self.created = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+
+    def connection_created(self, event):
+        with self._lock:
+            self.created += 1
+
+    def connection_ready(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checkouts += 1
+            self._waits.append(event.duration)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+            self._waits.append(event.duration)
+
+    # The rest of the pool events aren't needed, but pymongo requires every
+    # handler.
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the connection counters, and the p50, p99 and max wait of
+        the recent checkouts, in ms."""
+        with self._lock:
+            waits = sorted(self._waits)
+            stats = {
+                "open": self.open,
+                "created": self.created,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+            }
+        for name, p in [("p50", 0.5), ("p99", 0.99)]:
+            stats[f"checkout_wait_{name}_ms"] = (
+                waits[min(len(waits) - 1, int(len(waits) * p))] * 1000
+                if waits else 0.0)
+        stats["checkout_wait_max_ms"] = waits[-1] * 1000 if waits else 0.0
+        return stats
+
+
+class ClientRegistry:
+    """ClientRegistry owns the mongo clients of the process, one per uri
+    (and options, see client).
+
+    Every client is created with options, see configure. minPoolSize is the
+    number of connections warm() opens up front, and that the pool keeps
+    open while idle. The timeouts are shorter than pymongo's defaults (eg 30s
+    of server selection), so that a down mongod fails an operation in time
+    for the RetryPolicy to retry it within its deadline.
+    """
+
+    default_options = {
+        "maxPoolSize": 50,
+        "minPoolSize": 4,
+        "connectTimeoutMS": 5000,
+        "serverSelectionTimeoutMS": 5000,
+        "socketTimeoutMS": 10000,
+        "waitQueueTimeoutMS": 5000,
+    }
+
+    # The options of the clients of maintenance tools, eg hack/dedup.py,
+    # see client. Their full collection aggregations and index builds can
+    # run for much longer than socketTimeoutMS, and would be retried by the
+    # RetryPolicy after timing out.
+    maintenance_options = {"socketTimeoutMS": None, "minPoolSize": 0}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.options = dict(self.default_options)
+        # uri -> (MongoClient, PoolListener), and the same for motor clients.
+        self._clients = {}
+        self._async_clients = {}
+
+    def configure(self, **options) -> None:
+        """Overrides the MongoClient options of the clients created from now
+        on, eg configure(maxPoolSize=20)."""
+        with self._lock:
+            self.options.update(options)
+
+    def _get(self, clients: dict, uri: str, client_class, options: dict) -> Any:
+        # Clients with their own options are shared by the callers that
+        # pass the same options, and named after them in stats.
+        name = uri
+        if options:
+            name = f"{uri} {options}"
+        with self._lock:
+            if name not in clients:
+                listener = PoolListener()
+                clients[name] = (
+                    client_class(uri, event_listeners=[listener],
+                                 **{**self.options, **options}),
+                    listener)
+            return clients[name][0]
+
+    def client(self, uri: str, **options) -> MongoClient:
+        """Returns the shared MongoClient of uri.
+
+        Args:
+            options: overrides the registry's options, eg
+                client(uri, **registry.maintenance_options). The client is
+                shared with the callers that pass the same options.
+        """
+        return self._get(self._clients, uri, MongoClient, options)
+
+    def async_client(self, uri: str, **options) -> AsyncIOMotorClient:
+        """Returns the shared motor client of uri, see client.
+
+        Motor runs a pymongo client of its own in worker threads, so this is
+        a separate pool from that of client(uri).
+        """
+        return self._get(self._async_clients, uri, AsyncIOMotorClient, options)
+
+    def _pools(self) -> list:
+        """Returns (name, pymongo client, listener) of every client."""
+        with self._lock:
+            return [
+                *[(name, c, l) for name, (c, l) in self._clients.items()],
+                *[(f"{name} (async)", c.delegate, l)
+                  for name, (c, l) in self._async_clients.items()],
+            ]
+
+    def warm(self, timeout: float = 10.0) -> None:
+        """Connects every client and waits until its pool has minPoolSize
+        connections open, or timeout seconds.
+
+        pymongo opens the minPoolSize connections in the background once the
+        server is discovered, the ping triggers the discovery. Failures are
+        logged, not raised, the bot can start without mongo and the
+        RetryPolicy takes over.
+        """
+        deadline = time.monotonic() + timeout
+        target = self.options.get("minPoolSize", 0)
+        for name, client, listener in self._pools():
+            start = time.monotonic()
+            try:
+                client.admin.command("ping")
+            except Exception as e:
+                logger.error(f"Failed to warm the mongo pool of {name}: {e}")
+                continue
+            while listener.open < target and time.monotonic() < deadline:
+                time.sleep(0.05)
+            logger.info(
+                f"Warmed the mongo pool of {name}: {listener.open} connections "
+                f"in {time.monotonic() - start:.2f}s")
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the pool stats of every client, see PoolListener.stats."""
+        return {name: listener.stats() for name, _, listener in self._pools()}
+
+    def close(self) -> None:
+        """Closes every client."""
+        with self._lock:
+            for client, _ in [*self._clients.values(),
+                              *self._async_clients.values()]:
+                client.close()
+            self._clients = {}
+            self._async_clients = {}
+
+
+# The registry of the process.
+registry = ClientRegistry()
@@ -0,0 +1,68 @@
+import unittest
+from types import SimpleNamespace
+from store.clients import ClientRegistry, PoolListener
+
+
+class TestClientRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ClientRegistry()
+        # Nothing listens on port 1, fail fast.
+        self.registry.configure(
+            serverSelectionTimeoutMS=50, connectTimeoutMS=50, maxPoolSize=7)
+        self.uri = "mongodb://localhost:1"
+
+    def tearDown(self):
+        self.registry.close()
+
+    def test_clients_are_shared(self):
+        client = self.registry.client(self.uri)
+        self.assertIs(self.registry.client(self.uri), client)
+        self.assertEqual(client.options.pool_options.max_pool_size, 7)
+        self.assertIs(
+            self.registry.async_client(self.uri),
+            self.registry.async_client(self.uri))
+        self.assertEqual(
+            set(self.registry.stats()), {self.uri, f"{self.uri} (async)"})
+
+    def test_client_options(self):
+        client = self.registry.client(self.uri)
+        self.assertEqual(client.options.pool_options.socket_timeout, 10)
+        maintenance = self.registry.client(
+            self.uri, **self.registry.maintenance_options)
+        self.assertIsNot(maintenance, client)
+        self.assertIs(
+            self.registry.client(self.uri, **self.registry.maintenance_options),
+            maintenance)
+        self.assertIsNone(maintenance.options.pool_options.socket_timeout)
+        # The registry's other options still apply.
+        self.assertEqual(maintenance.options.pool_options.max_pool_size, 7)
+        self.assertEqual(len(self.registry.stats()), 2)
+
+    def test_warm_tolerates_a_down_server(self):
+        self.registry.client(self.uri)
+        with self.assertLogs("store.clients", level="ERROR"):
+            self.registry.warm(timeout=1)
+        self.assertEqual(self.registry.stats()[self.uri]["open"], 0)
+
+
+class TestPoolListener(unittest.TestCase):
+
+    def test_checkout_waits(self):
+        listener = PoolListener(window=100)
+        self.assertEqual(listener.stats()["checkout_wait_p99_ms"], 0.0)
+        for ms in range(1, 201):
+            listener.connection_checked_out(SimpleNamespace(duration=ms / 1000))
+        listener.connection_check_out_failed(SimpleNamespace(duration=1.0))
+        listener.connection_ready(None)
+        stats = listener.stats()
+        self.assertEqual(stats["checkouts"], 200)
+        self.assertEqual(stats["checkout_failures"], 1)
+        self.assertEqual(stats["open"], 1)
+        # Only the last 100 waits are kept.
+        self.assertAlmostEqual(stats["checkout_wait_p50_ms"], 152)
+        self.assertAlmostEqual(stats["checkout_wait_max_ms"], 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
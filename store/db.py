@@ -6,21 +6,32 @@ Usage:
 
 Notes: 
     MongoManager: abstracts all the mongo logic.
+    AsyncMongoManager: a MongoManager that uses motor for the awaitable
+        (*_async) methods, so the bot handlers don't block the event loop.
     TelegramStore: encapsulates all the telegram logic.
 
 Ideally, these would not mix. Meaning, the telegram store would not expose the structure of a specific telegram datastructure to the mongo manager, and the mongo manager would not expose the connection details to the telegram store. That way, the store can use a different backend (eg mariadb) for storing the updates. 
 
-Specifically, the logic of how often and when to retry is embedded in the mongo manager, because this is very write-failure dependent. The mongo client exposes different types of write failures, not all of which are retryable. 
+Specifically, the logic of how often and when to retry is embedded in the mongo manager, because this is very write-failure dependent. The mongo client exposes different types of write failures, not all of which are retryable. The mongo managers retry through a RetryPolicy, which also trips a circuit breaker when mongo is down. 
 """
 
-import retry
+import re
+import time
+import random
+import asyncio
 import logging
-from pymongo import MongoClient, errors, ASCENDING
+import threading
+import contextvars
+from bson import ObjectId
+from datetime import datetime, timezone
+from pymongo import WriteConcern, errors, ASCENDING
 from pymongo.collection import Collection
 from pymongo.database import Database
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List
 from abc import ABC, abstractmethod
 from telegram import Update, Bot
+from store.clients import registry
+from constants import PRICE_PATTERN
 
 
 logging.basicConfig(level=logging.INFO)
@@ -30,69 +41,697 @@ logger = logging.getLogger(__name__)
 class DBManager(ABC):
     """Abstract class for all database managers."""
 
+    # The max number of values sent in a single find_in query.
+    find_in_chunk_size = 1000
+
     @abstractmethod
     def insert(
-            self, payload: Dict[str, Any], db_name: str, table_name: str) -> None:
+            self,
+            payload: Dict[str, Any],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None) -> bool:
         """Insert a payload into the db_name:table_name.
 
         It is up to the db manager to interpret how to transform keys and values in the given payload. 
+
+        Args:
+            unique_key: optional list of fields that identify the payload. If
+                a record with the same values already exists, the insert is a
+                no-op. This makes inserts safe to repeat.
+
+        Returns:
+            True if the payload was inserted, False if it was a duplicate.
         """
         pass
 
     @abstractmethod
     def find(
-            self, filter: dict, db_name: str, table_name: str) -> list[Dict[str, Any]]:
-        """Find records matching the given filter in db_name:table_name."""
+            self,
+            filter: dict,
+            limit: int,
+            db_name: str,
+            table_name: str,
+            projection: dict = None) -> list[Dict[str, Any]]:
+        """Find records matching the given filter in db_name:table_name.
+
+        Args:
+            projection: optional mongo style inclusion projection, eg
+                {"message.text": 1}. If set, only the given (dotted) fields
+                and _id are returned.
+        """
         pass
 
+    def find_in(
+            self,
+            key: str,
+            values: list,
+            db_name: str,
+            table_name: str) -> list[Dict[str, Any]]:
+        """Find all records whose key is one of values, in bulk.
+
+        Values are de-duplicated and sent in chunks of find_in_chunk_size, so
+        fetching N records costs N / find_in_chunk_size round-trips. The
+        order of the returned records is unspecified.
+        """
+        values = list(dict.fromkeys(values))
+        records = []
+        for i in range(0, len(values), self.find_in_chunk_size):
+            chunk = values[i:i + self.find_in_chunk_size]
+            records.extend(
+                self.find({key: {"$in": chunk}}, 0, db_name, table_name))
+        return records
+
+    def iter_find(
+            self,
+            filter: dict,
+            db_name: str,
+            table_name: str,
+            batch_size: int = 100,
+            sort: list = None,
+            projection: dict = None) -> Iterator[Dict[str, Any]]:
+        """Lazily iterate over the records matching filter.
+
+        Args:
+            sort: optional list of (key, direction) pairs.
+            batch_size: the number of records fetched per round-trip.
+            projection: see find.
+
+        The default materializes the results of find. Managers that support
+        cursors should override this to fetch batch_size records at a time.
+        """
+        records = self.find(filter, 0, db_name, table_name, projection)
+        for key, direction in reversed(sort or []):
+            records.sort(key=lambda r: _get_field(r, key),
+                         reverse=direction < 0)
+        return iter(records)
+
+    def insert_many(
+            self,
+            payloads: List[Dict[str, Any]],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None) -> int:
+        """Insert a batch of payloads into db_name:table_name.
+
+        Duplicates, as defined by unique_key (see insert), are skipped
+        without failing the rest of the batch. Returns the number of payloads
+        inserted.
+
+        The default inserts one payload at a time. Managers that support bulk
+        writes should override this.
+        """
+        return sum(self.insert(payload, db_name, table_name, unique_key)
+                   for payload in payloads)
+
+    async def insert_async(
+            self,
+            payload: Dict[str, Any],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None) -> bool:
+        """Awaitable version of insert.
+
+        The default runs the blocking insert in a worker thread so it doesn't
+        stall the event loop. Managers with an asyncio native driver should
+        override this.
+        """
+        return await asyncio.to_thread(
+            self.insert, payload, db_name, table_name, unique_key)
+
+    async def find_async(
+            self,
+            filter: dict,
+            limit: int,
+            db_name: str,
+            table_name: str,
+            projection: dict = None) -> list[Dict[str, Any]]:
+        """Awaitable version of find. See insert_async."""
+        return await asyncio.to_thread(
+            self.find, filter, limit, db_name, table_name, projection)
+
+    async def find_in_async(
+            self,
+            key: str,
+            values: list,
+            db_name: str,
+            table_name: str) -> list[Dict[str, Any]]:
+        """Awaitable version of find_in."""
+        values = list(dict.fromkeys(values))
+        records = []
+        for i in range(0, len(values), self.find_in_chunk_size):
+            chunk = values[i:i + self.find_in_chunk_size]
+            records.extend(await self.find_async(
+                {key: {"$in": chunk}}, 0, db_name, table_name))
+        return records
+
+    async def insert_many_async(
+            self,
+            payloads: List[Dict[str, Any]],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None) -> int:
+        """Awaitable version of insert_many. See insert_async."""
+        return await asyncio.to_thread(
+            self.insert_many, payloads, db_name, table_name, unique_key)
+
     @abstractmethod
-    def sync_indices(self, db_name: str, table_name: str, indices: list) -> None:
+    def update(
+            self,
+            filter: dict,
+            changes: dict,
+            db_name: str,
+            table_name: str,
+            upsert: bool = False) -> None:
+        """Atomically apply changes to the first record matching filter.
+
+        Args:
+            changes: mongo style update operators. Managers must support at
+                least $inc, $set, $setOnInsert, $min and $max.
+            upsert: if no record matches, insert one built from the equality
+                fields of the filter and the changes.
+        """
+        pass
+
+    async def update_async(
+            self,
+            filter: dict,
+            changes: dict,
+            db_name: str,
+            table_name: str,
+            upsert: bool = False) -> None:
+        """Awaitable version of update. See insert_async."""
+        await asyncio.to_thread(
+            self.update, filter, changes, db_name, table_name, upsert)
+
+    def aggregate(
+            self, pipeline: list, db_name: str, table_name: str) -> list[Dict[str, Any]]:
+        """Run a mongo style aggregation pipeline over db_name:table_name.
+
+        This is optional. Managers that can't run pipelines raise
+        NotImplementedError, and callers must fall back to computing the
+        result from find.
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support aggregation")
+
+    async def aggregate_async(
+            self, pipeline: list, db_name: str, table_name: str) -> list[Dict[str, Any]]:
+        """Awaitable version of aggregate. See insert_async."""
+        return await asyncio.to_thread(
+            self.aggregate, pipeline, db_name, table_name)
+
+    def delete(self, filter: dict, db_name: str, table_name: str) -> int:
+        """Delete every record matching filter, returns the deleted count.
+
+        This is optional, it is only used by maintenance tasks like
+        store.archive. Managers that can't delete raise NotImplementedError.
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support deletes")
+
+    def set_write_concern(
+            self, db_name: str, table_name: str, write_concern: dict) -> None:
+        """Sets the durability of the writes to db_name:table_name.
+
+        Args:
+            write_concern: mongo style write concern options, eg
+                {"w": 1, "j": True}, see TelegramStore.write_concerns.
+
+        This is optional, the default ignores it and writes with the
+        manager's own durability.
+        """
+        pass
+
+    def create_compressed(self, db_name: str, table_name: str) -> bool:
+        """Creates db_name:table_name with the strongest available storage
+        compression, for cold data that is rarely read.
+
+        This is optional, the default stores a plain table. Returns true if
+        the table is compressed.
+        """
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns counters about the health of the connection, if any."""
+        return {}
+
+    def create_timeseries(
+            self,
+            db_name: str,
+            table_name: str,
+            time_field: str,
+            meta_field: str) -> bool:
+        """Creates db_name:table_name as a time-series collection.
+
+        Time-series collections store measurements bucketed by meta_field and
+        time_field, which is much more compact for append-only events. They
+        can't have unique indices, so unique_key inserts into them check for
+        an existing record first.
+
+        This is optional, the default stores a plain table. Returns true if
+        the table is a time-series collection.
+        """
+        return False
+
+    @abstractmethod
+    def sync_indices(
+            self,
+            db_name: str,
+            table_name: str,
+            indices: list,
+            droppable: List[str] = None) -> None:
         """Sync the given list of indices. 
 
         Create the new ones, delete the stale ones.
+
+        Args:
+            indices: a list of index specs, see TelegramStore.index_specs.
+                Each spec has a "name", a list of (key, direction) "keys" and
+                optional create_index "options", eg {"unique": True}.
+            droppable: Optional. The names of the undeclared indices that are
+                dropped, by default every undeclared index is. A declared
+                index whose spec changed is always rebuilt.
         """
         pass
 
 
+class CircuitOpenError(Exception):
+    """Raised instead of calling the database while the breaker is open."""
+
+
+class CircuitBreaker:
+    """CircuitBreaker stops calls to a database that keeps failing.
+
+    The breaker opens after failure_threshold consecutive failed attempts.
+    While it is open, calls fail immediately with CircuitOpenError instead of
+    waiting on dead connections. After reset_timeout seconds it lets a single
+    trial call through (half open): the breaker closes if it succeeds and
+    opens again if it fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        # The number of times the breaker opened.
+        self.opened = 0
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if (self._state == self.OPEN and
+                    time.monotonic() - self._opened_at >= self.reset_timeout):
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        """Returns true if a call may go through."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            if self._trial:
+                return False
+            self._state, self._trial = self.HALF_OPEN, True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("Circuit breaker closed, the database is back")
+            self._state, self._trial, self.failures = self.CLOSED, False, 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self._state == self.HALF_OPEN or (
+                    self._state == self.CLOSED and
+                    self.failures >= self.failure_threshold):
+                if self._state == self.CLOSED:
+                    self.opened += 1
+                    logger.warning(
+                        f"Circuit breaker opened after {self.failures} failures")
+                self._state, self._opened_at = self.OPEN, time.monotonic()
+
+
+class RetryPolicy:
+    """RetryPolicy retries transient database errors.
+
+    A failed call is retried up to tries times, sleeping a random ("full
+    jitter") delay between 0 and base_delay * 2^attempt, capped at max_delay.
+    Retries stop once deadline seconds have passed since the first attempt.
+    Every attempt goes through the circuit breaker.
+
+    call() sleeps with time.sleep and must only be used off the event loop,
+    eg in the synchronous methods that the store runs in a thread.
+    call_async() sleeps with asyncio.sleep.
+    """
+
+    retryable = (errors.NetworkTimeout, errors.AutoReconnect)
+
+    def __init__(
+            self,
+            tries: int = 5,
+            base_delay: float = 0.25,
+            max_delay: float = 4.0,
+            deadline: float = 10.0,
+            breaker: CircuitBreaker = None):
+        self.tries = tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        # Counters, see stats().
+        self.calls = 0
+        self.retries = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the breaker state and the retry counters."""
+        return {
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "opened": self.breaker.opened,
+            "calls": self.calls,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "failed": self.failed,
+        }
+
+    def call(self, fn, *args, **kwargs):
+        """Calls fn, retrying transient errors."""
+        self.calls += 1
+        start = time.monotonic()
+        for attempt in range(self.tries):
+            self._admit()
+            try:
+                result = fn(*args, **kwargs)
+            except self.retryable as e:
+                delay = self._backoff(e, attempt, start)
+                time.sleep(delay)
+                continue
+            except Exception:
+                # Mongo answered, it's the request that failed.
+                self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+            return result
+
+    async def call_async(self, fn, *args, **kwargs):
+        """Awaits fn, retrying transient errors without blocking the loop."""
+        self.calls += 1
+        start = time.monotonic()
+        for attempt in range(self.tries):
+            self._admit()
+            try:
+                result = await fn(*args, **kwargs)
+            except self.retryable as e:
+                delay = self._backoff(e, attempt, start)
+                await asyncio.sleep(delay)
+                continue
+            except Exception:
+                self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+            return result
+
+    def check(self) -> None:
+        """Raises CircuitOpenError if the breaker is open.
+
+        Use this to fail fast before work that isn't run through call(), eg
+        iterating a cursor. Unlike a call, it doesn't use up the trial call
+        of a half open breaker.
+        """
+        if self.breaker.state == CircuitBreaker.OPEN:
+            self.rejected += 1
+            raise CircuitOpenError("The database is unavailable")
+
+    def _admit(self) -> None:
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise CircuitOpenError("The database is unavailable")
+
+    def _backoff(self, e: Exception, attempt: int, start: float) -> float:
+        """Records the failed attempt, returns the delay before the next one.
+
+        Raises e if there are no tries left or the deadline would pass.
+        """
+        self.breaker.record_failure()
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if (attempt == self.tries - 1 or
+                time.monotonic() - start + delay > self.deadline):
+            self.failed += 1
+            raise e
+        self.retries += 1
+        logger.warning(f"{e}, retrying in {delay:.2f} seconds...")
+        return delay
+
+
 class MongoManager(DBManager):
-    """MongoManager has all the logic to deal with the mongo connection."""
+    """MongoManager has all the logic to deal with the mongo connection.
 
-    # TODO(prashanth@): is the client thread safe? is that a concern in python3?
-    # TODO(prashanth@): if it is thread safe, can we make this a singleton?
-    # TODO(prashanth@): retry connection creation on network error.
-    def __init__(self, mongo_uri="mongodb://localhost:27017", client=None):
+    Every call to mongo goes through retry_policy, see RetryPolicy.
+    """
+
+    def __init__(
+            self,
+            mongo_uri="mongodb://localhost:27017",
+            client=None,
+            retry_policy: RetryPolicy = None,
+            client_options: dict = None):
+        """
+        Args:
+            client_options: overrides the registry's client options, eg
+                registry.maintenance_options for the scripts in hack/ that
+                run long aggregations, see ClientRegistry.client.
+        """
+        # MongoClient is thread safe, every manager of the process shares
+        # the registry's client, and its connection pool. The client
+        # connects lazily, connection failures are retried by retry_policy.
         if client is None:
-            self.client = MongoClient(mongo_uri)
+            self.client = registry.client(mongo_uri, **(client_options or {}))
         else:
             self.client = client
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        # The (db_name, table_name) of the time-series collections, see
+        # create_timeseries.
+        self._timeseries = set()
+        # (db_name, table_name) -> WriteConcern, see set_write_concern.
+        self._write_concerns = {}
+
+    def set_write_concern(
+            self, db_name: str, table_name: str, write_concern: dict) -> None:
+        """set_write_concern overrides the client's write concern for the
+        writes to a collection."""
+        self._write_concerns[(db_name, table_name)] = WriteConcern(**write_concern)
+
+    def _collection(self, client, db_name: str, table_name: str):
+        """Returns the collection of client, with its write concern."""
+        collection = client[db_name][table_name]
+        write_concern = self._write_concerns.get((db_name, table_name))
+        if write_concern is None:
+            return collection
+        return collection.with_options(write_concern=write_concern)
+
+    def create_timeseries(
+            self,
+            db_name: str,
+            table_name: str,
+            time_field: str,
+            meta_field: str) -> bool:
+        """create_timeseries creates the time-series collection, unless the
+        collection exists.
+
+        An existing plain collection is left alone and False is returned,
+        see hack/migrate_timeseries.py to convert it.
+        """
+        db = self.client[db_name]
+        existing = self.retry_policy.call(
+            lambda: list(db.list_collections(filter={"name": table_name})))
+        if not existing:
+            logger.info(f"Creating time-series collection {db_name}.{table_name}")
+            self.retry_policy.call(
+                db.create_collection, table_name,
+                timeseries={
+                    "timeField": time_field,
+                    "metaField": meta_field,
+                    "granularity": "minutes",
+                })
+        elif existing[0].get("type") != "timeseries":
+            return False
+        self._timeseries.add((db_name, table_name))
+        return True
 
-    @retry.retry(
-        (errors.NetworkTimeout, errors.AutoReconnect),
-        tries=5,
-        delay=2,
-        backoff=2
-    )
-    def insert(self, payload: Dict[str, Any], db_name: str, table_name: str) -> None:
+    def insert(
+            self,
+            payload: Dict[str, Any],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None) -> bool:
         """insert is a retry wrapper for insert_one. 
 
         If the collection in question does not exist, mongo will auto create it.
         github.com/mongodb/mongo/blob/r7.0.11/src/mongo/base/error_codes.yml
+
+        With a unique_key, the insert is an upsert that only sets fields on
+        insert, so a retry of a write that succeeded late is a no-op.
+        """
+        collection = self._collection(self.client, db_name, table_name)
+        if not unique_key:
+            self.retry_policy.call(collection.insert_one, payload)
+            return True
+        if (db_name, table_name) in self._timeseries:
+            # Time-series collections support neither upserts nor unique
+            # indices. The lookup and insert are retried together, so a
+            # retried insert that succeeded late is found by the lookup.
+            def _insert_new():
+                if collection.find_one(
+                        {k: payload.get(k) for k in unique_key}, {"_id": 1}):
+                    return False
+                collection.insert_one(payload)
+                return True
+            return self.retry_policy.call(_insert_new)
+        try:
+            result = self.retry_policy.call(
+                collection.update_one,
+                {k: payload.get(k) for k in unique_key},
+                {"$setOnInsert": payload},
+                upsert=True)
+        except errors.DuplicateKeyError:
+            # A concurrent upsert of the same payload won the race.
+            return False
+        if not result.acknowledged:
+            # With {"w": 0} there is no way to tell a duplicate apart.
+            return True
+        return result.upserted_id is not None
+
+    def insert_many(
+            self,
+            payloads: List[Dict[str, Any]],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None) -> int:
+        """insert_many is a retry wrapper for an unordered insert_many.
+
+        Duplicates are rejected by the collection's unique indices (or by _id,
+        so a retry after a partial write doesn't insert anything twice), and
+        skipped without failing the rest of the batch. Time-series
+        collections have no unique indices, the payloads whose unique_key
+        already exists are dropped before the write instead.
         """
-        # TODO(prashanth@): creating the collection if it doesn't exist will
-        # skip index creation. Currently to setup the collection with indices
-        # you must run hack/setup_db.py.
-        self.client[db_name][table_name].insert_one(payload)
-
-    @retry.retry(
-        (errors.NetworkTimeout, errors.AutoReconnect),
-        tries=5,
-        delay=2,
-        backoff=2
-    )
+        collection = self._collection(self.client, db_name, table_name)
+        if unique_key and (db_name, table_name) in self._timeseries:
+            def _existing():
+                return list(collection.find(
+                    _unique_key_filter(payloads, unique_key),
+                    {k: 1 for k in unique_key}))
+            payloads = _new_payloads(
+                payloads, unique_key, self.retry_policy.call(_existing))
+            if not payloads:
+                return 0
+        try:
+            result = self.retry_policy.call(
+                collection.insert_many, payloads, ordered=False)
+            return len(result.inserted_ids)
+        except errors.BulkWriteError as e:
+            return _inserted_ignoring_duplicates(e)
+
     def find(
-            self, filter: dict, limit: int, db_name: str, table_name: str) -> list[Dict[str, Any]]:
-        return [u for u in
-                self.client[db_name][table_name].find(filter).limit(limit)]
+            self,
+            filter: dict,
+            limit: int,
+            db_name: str,
+            table_name: str,
+            projection: dict = None) -> list[Dict[str, Any]]:
+        def _find():
+            return list(self.client[db_name][table_name].find(
+                filter, projection).limit(limit))
+        return self.retry_policy.call(_find)
+
+    def iter_find(
+            self,
+            filter: dict,
+            db_name: str,
+            table_name: str,
+            batch_size: int = 100,
+            sort: list = None,
+            projection: dict = None) -> Iterator[Dict[str, Any]]:
+        """iter_find streams records through a cursor.
+
+        Only batch_size records are held in memory at a time. Unlike find,
+        network errors while iterating are not retried, since the cursor
+        can't be resumed. It still fails fast while the circuit breaker is
+        open.
+        """
+        self.retry_policy.check()
+        cursor = self.client[db_name][table_name].find(
+            filter, projection).batch_size(batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        return cursor
+
+    def update(
+            self,
+            filter: dict,
+            changes: dict,
+            db_name: str,
+            table_name: str,
+            upsert: bool = False) -> None:
+        """update is a retry wrapper for update_one."""
+        self.retry_policy.call(
+            self._collection(self.client, db_name, table_name).update_one,
+            filter, changes, upsert=upsert)
+
+    def aggregate(
+            self, pipeline: list, db_name: str, table_name: str) -> list[Dict[str, Any]]:
+        return self.retry_policy.call(
+            lambda: list(self.client[db_name][table_name].aggregate(pipeline)))
+
+    def delete(self, filter: dict, db_name: str, table_name: str) -> int:
+        """delete is a retry wrapper for delete_many."""
+        return self.retry_policy.call(
+            self.client[db_name][table_name].delete_many, filter).deleted_count
+
+    def create_compressed(self, db_name: str, table_name: str) -> bool:
+        """create_compressed creates the collection with WiredTiger's zstd
+        block compressor, unless the collection exists.
+
+        The compressor of an existing collection can't be changed, so this
+        returns whether the existing collection uses zstd.
+        """
+        db = self.client[db_name]
+        existing = self.retry_policy.call(
+            lambda: list(db.list_collections(filter={"name": table_name})))
+        if existing:
+            config = existing[0].get("options", {}).get(
+                "storageEngine", {}).get("wiredTiger", {}).get("configString", "")
+            return "block_compressor=zstd" in config
+        logger.info(f"Creating zstd compressed collection {db_name}.{table_name}")
+        self.retry_policy.call(
+            db.create_collection, table_name,
+            storageEngine={
+                "wiredTiger": {"configString": "block_compressor=zstd"}})
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the circuit breaker state and retry counters, and the
+        connection pool stats of the process, see ClientRegistry.stats."""
+        return {**self.retry_policy.stats(), "pools": registry.stats()}
 
     def _delete_all(self, db_name: str, table_name: str) -> None:
         """_delete_all deletes an entire collection.
@@ -105,10 +744,446 @@ class MongoManager(DBManager):
         """_drop_table deletes the entire table."""
         self.client.drop_database(db_name)
 
-    def sync_indices(self, db_name: str, table_name: str, indices: list) -> None:
-        """create_index creates all indices in the indices list"""
-        self.client[db_name][table_name].create_index(indices)
-        # TODO(prashanth@): Delete stale indices
+    def sync_indices(
+            self,
+            db_name: str,
+            table_name: str,
+            indices: list,
+            droppable: List[str] = None) -> None:
+        """sync_indices reconciles the collection's indices with the specs.
+
+        Indices are matched by name. An existing index that isn't declared
+        (and is droppable), or whose keys or options differ from its spec, is
+        dropped. Declared indices that don't exist are then created. Index
+        builds don't block reads and writes on the collection (mongo >= 4.2).
+        """
+        collection = self.client[db_name][table_name]
+        declared = {spec["name"]: spec for spec in indices}
+        existing = collection.index_information()
+        for name, info in existing.items():
+            if name == "_id_":
+                continue
+            spec = declared.get(name)
+            if spec is None and droppable is not None and name not in droppable:
+                continue
+            if spec is None or not _index_matches(info, spec):
+                logger.info(f"Dropping stale index {db_name}.{table_name}.{name}")
+                collection.drop_index(name)
+                existing[name] = None
+        for name, spec in declared.items():
+            if existing.get(name) is None:
+                logger.info(f"Creating index {db_name}.{table_name}.{name}")
+                collection.create_index(
+                    spec["keys"], name=name, **spec.get("options", {}))
+
+
+class AsyncMongoManager(MongoManager):
+    """AsyncMongoManager talks to mongo through motor in the async code paths.
+
+    The bot handlers run on a single event loop, so a slow round-trip in a
+    blocking pymongo call stalls every other user. The awaitable methods of
+    this manager go through a motor client instead. The synchronous pymongo
+    client is still used for the blocking methods, eg sync_indices and the
+    scripts in hack/.
+    """
+
+    def __init__(
+            self,
+            mongo_uri="mongodb://localhost:27017",
+            client=None,
+            async_client=None,
+            retry_policy: RetryPolicy = None,
+            client_options: dict = None):
+        super().__init__(mongo_uri, client, retry_policy, client_options)
+        if async_client is None:
+            self.async_client = registry.async_client(
+                mongo_uri, **(client_options or {}))
+        else:
+            self.async_client = async_client
+
+    async def insert_async(
+            self,
+            payload: Dict[str, Any],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None) -> bool:
+        """insert_async is a retry wrapper for motor's insert_one.
+
+        See MongoManager.insert for how unique_key is handled.
+        """
+        collection = self._collection(self.async_client, db_name, table_name)
+        if not unique_key:
+            await self.retry_policy.call_async(collection.insert_one, payload)
+            return True
+        if (db_name, table_name) in self._timeseries:
+            async def _insert_new():
+                if await collection.find_one(
+                        {k: payload.get(k) for k in unique_key}, {"_id": 1}):
+                    return False
+                await collection.insert_one(payload)
+                return True
+            return await self.retry_policy.call_async(_insert_new)
+        try:
+            result = await self.retry_policy.call_async(
+                collection.update_one,
+                {k: payload.get(k) for k in unique_key},
+                {"$setOnInsert": payload},
+                upsert=True)
+        except errors.DuplicateKeyError:
+            return False
+        if not result.acknowledged:
+            return True
+        return result.upserted_id is not None
+
+    async def insert_many_async(
+            self,
+            payloads: List[Dict[str, Any]],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None) -> int:
+        """insert_many_async is a retry wrapper for motor's insert_many.
+
+        See MongoManager.insert_many for how duplicates are handled.
+        """
+        collection = self._collection(self.async_client, db_name, table_name)
+        if unique_key and (db_name, table_name) in self._timeseries:
+            async def _existing():
+                return await collection.find(
+                    _unique_key_filter(payloads, unique_key),
+                    {k: 1 for k in unique_key}).to_list(length=None)
+            payloads = _new_payloads(
+                payloads, unique_key,
+                await self.retry_policy.call_async(_existing))
+            if not payloads:
+                return 0
+        try:
+            result = await self.retry_policy.call_async(
+                collection.insert_many, payloads, ordered=False)
+            return len(result.inserted_ids)
+        except errors.BulkWriteError as e:
+            return _inserted_ignoring_duplicates(e)
+
+    async def update_async(
+            self,
+            filter: dict,
+            changes: dict,
+            db_name: str,
+            table_name: str,
+            upsert: bool = False) -> None:
+        """update_async is a retry wrapper for motor's update_one."""
+        await self.retry_policy.call_async(
+            self._collection(self.async_client, db_name, table_name).update_one,
+            filter, changes, upsert=upsert)
+
+    async def aggregate_async(
+            self, pipeline: list, db_name: str, table_name: str) -> list[Dict[str, Any]]:
+        async def _aggregate():
+            cursor = self.async_client[db_name][table_name].aggregate(pipeline)
+            return await cursor.to_list(length=None)
+        return await self.retry_policy.call_async(_aggregate)
+
+    async def find_async(
+            self,
+            filter: dict,
+            limit: int,
+            db_name: str,
+            table_name: str,
+            projection: dict = None) -> list[Dict[str, Any]]:
+        # Motor cursors can't be reused after a failure, so a fresh one is
+        # created on every attempt.
+        async def _find():
+            cursor = self.async_client[db_name][table_name].find(
+                filter, projection).limit(limit)
+            return await cursor.to_list(length=None)
+        return await self.retry_policy.call_async(_find)
+
+
+class WriteBuffer:
+    """WriteBuffer batches inserts and writes them with insert_many.
+
+    Payloads are held in memory until either max_size of them are pending, or
+    the oldest one has waited max_delay seconds, at which point all of them
+    are flushed. The delay is enforced by a background thread, call close()
+    to flush the remainder and stop it.
+
+    Unflushed payloads can be read back through pending(), so readers see
+    their own writes before they reach the database.
+    """
+
+    def __init__(
+            self,
+            db_manager: DBManager,
+            max_size: int = 100,
+            max_delay: float = 1.0):
+        self._db_manager = db_manager
+        self.max_size = max_size
+        self.max_delay = max_delay
+
+        # (db_name, table_name) -> list of payloads, in insertion order.
+        self._pending = {}
+        # Batches that are being written. They stay visible to pending() until
+        # the write returns, so a concurrent reader never misses them.
+        self._inflight = []
+        self._unique_keys = {}
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def add(
+            self,
+            payload: Dict[str, Any],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None) -> bool:
+        """Buffer the payload. Returns true if the buffer should be flushed.
+
+        The payload is given an _id here so that it can be de-duplicated
+        against the database in TelegramStore reads. unique_key is passed
+        through to insert_many, see DBManager.insert.
+        """
+        payload.setdefault("_id", ObjectId())
+        with self._lock:
+            self._unique_keys[(db_name, table_name)] = unique_key
+            self._pending.setdefault((db_name, table_name), []).append(payload)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            return self._size() >= self.max_size
+
+    def pending(
+            self,
+            filter: dict,
+            db_name: str,
+            table_name: str,
+            projection: dict = None) -> List[Dict[str, Any]]:
+        """Returns the unflushed payloads of db_name:table_name matching filter."""
+        with self._lock:
+            batches = [b.get((db_name, table_name), []) for b in self._inflight]
+            batches.append(self._pending.get((db_name, table_name), []))
+            return [_project(p, projection)
+                    for b in batches for p in b if _matches(p, filter)]
+
+    def flush(self) -> None:
+        """Write out everything that is pending."""
+        batch = self._take()
+        try:
+            for (db_name, table_name), payloads in batch.items():
+                self._db_manager.insert_many(
+                    payloads, db_name, table_name,
+                    self._unique_keys.get((db_name, table_name)))
+        except Exception:
+            self._restore(batch)
+            raise
+        self._release(batch)
+
+    async def flush_async(self) -> None:
+        """Awaitable version of flush."""
+        batch = self._take()
+        try:
+            for (db_name, table_name), payloads in batch.items():
+                await self._db_manager.insert_many_async(
+                    payloads, db_name, table_name,
+                    self._unique_keys.get((db_name, table_name)))
+        except Exception:
+            self._restore(batch)
+            raise
+        self._release(batch)
+
+    def close(self) -> None:
+        """Stop the background flusher and flush the remainder."""
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+
+    def _size(self) -> int:
+        return sum(len(p) for p in self._pending.values())
+
+    def _take(self) -> dict:
+        with self._lock:
+            batch, self._pending, self._oldest = self._pending, {}, None
+            self._inflight.append(batch)
+            return batch
+
+    def _release(self, batch: dict) -> None:
+        with self._lock:
+            self._inflight.remove(batch)
+
+    def _restore(self, batch: dict) -> None:
+        """Put a failed batch back at the head of the buffer."""
+        with self._lock:
+            self._inflight.remove(batch)
+            for key, payloads in self._pending.items():
+                batch.setdefault(key, []).extend(payloads)
+            self._pending = batch
+            self._oldest = time.monotonic()
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.max_delay / 2):
+            with self._lock:
+                due = (self._oldest is not None and
+                       time.monotonic() - self._oldest >= self.max_delay)
+            if not due:
+                continue
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush write buffer, will retry: {e}")
+
+
+# The mongo error code for a unique index violation.
+DUPLICATE_KEY_ERROR = 11000
+
+
+def _inserted_ignoring_duplicates(e: errors.BulkWriteError) -> int:
+    """Returns the inserted count of an unordered bulk insert.
+
+    Raises e if any write failed for a reason other than a duplicate key.
+    """
+    if any(err["code"] != DUPLICATE_KEY_ERROR for err in e.details["writeErrors"]):
+        raise e
+    return e.details["nInserted"]
+
+
+def _unique_key_filter(payloads: List[Dict[str, Any]], unique_key: List[str]) -> dict:
+    """Returns a filter for the records that may share a payload's unique_key."""
+    return {unique_key[0]: {"$in": list(dict.fromkeys(
+        p.get(unique_key[0]) for p in payloads))}}
+
+
+def _new_payloads(
+        payloads: List[Dict[str, Any]],
+        unique_key: List[str],
+        existing: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Drops the payloads whose unique_key is in existing, or earlier in the
+    batch."""
+    seen = {tuple(_get_field(r, k) for k in unique_key) for r in existing}
+    new = []
+    for p in payloads:
+        key = tuple(p.get(k) for k in unique_key)
+        if key not in seen:
+            seen.add(key)
+            new.append(p)
+    return new
+
+
+def _index_matches(info: Dict[str, Any], spec: Dict[str, Any]) -> bool:
+    """Returns true if an existing index, from index_information, matches spec."""
+    if [tuple(k) for k in info["key"]] != [tuple(k) for k in spec["keys"]]:
+        return False
+    for option, value in spec.get("options", {}).items():
+        if info.get(option) != value:
+            return False
+    return info.get("unique", False) == spec.get("options", {}).get("unique", False)
+
+
+def _get_field(doc: Dict[str, Any], key: str) -> Any:
+    """Resolves a dotted key, eg "message.from.id", in doc."""
+    for part in key.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+
+def _set_field(doc: Dict[str, Any], key: str, value: Any) -> None:
+    """Sets a dotted key in doc, creating the intermediate documents."""
+    parts = key.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _apply_update(
+        doc: Dict[str, Any], changes: dict, inserting: bool) -> Dict[str, Any]:
+    """Applies mongo style update operators to a document in memory.
+
+    This only supports the operators DBManager.update requires: $inc, $set,
+    $setOnInsert, $min and $max. $setOnInsert is only applied if inserting.
+    """
+    for op, fields in changes.items():
+        if op == "$setOnInsert" and not inserting:
+            continue
+        for key, value in fields.items():
+            current = _get_field(doc, key)
+            if op in ("$set", "$setOnInsert"):
+                _set_field(doc, key, value)
+            elif op == "$inc":
+                _set_field(doc, key, (current or 0) + value)
+            elif op == "$min":
+                if current is None or value < current:
+                    _set_field(doc, key, value)
+            elif op == "$max":
+                if current is None or value > current:
+                    _set_field(doc, key, value)
+            else:
+                raise ValueError(f"Unsupported update operator {op}")
+    return doc
+
+
+def _upsert_base(filter: dict) -> Dict[str, Any]:
+    """Returns the document an upsert starts from: the filter's equalities."""
+    doc = {}
+    for key, condition in filter.items():
+        if not isinstance(condition, dict):
+            _set_field(doc, key, condition)
+    return doc
+
+
+def _project(doc: Dict[str, Any], projection: dict) -> Dict[str, Any]:
+    """Applies a mongo style inclusion projection to a document in memory."""
+    if not projection:
+        return doc
+    projected = {"_id": doc["_id"]} if "_id" in doc else {}
+    for key in projection:
+        value = _get_field(doc, key)
+        if value is None:
+            continue
+        parts = key.split(".")
+        target = projected
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return projected
+
+
+def _matches(doc: Dict[str, Any], filter: dict) -> bool:
+    """Evaluates a mongo style filter against a document in memory.
+
+    This only supports the filter shapes TelegramStore uses: equality on
+    (dotted) keys and the $regex, $in, $exists and range operators.
+    """
+    for key, condition in filter.items():
+        value = _get_field(doc, key)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for op, arg in condition.items():
+            if op == "$regex":
+                if not isinstance(value, str) or not re.search(arg, value):
+                    return False
+            elif op == "$in":
+                if value not in arg:
+                    return False
+            elif op == "$exists":
+                if (value is not None) != bool(arg):
+                    return False
+            elif op in ("$gt", "$gte", "$lt", "$lte"):
+                if value is None:
+                    return False
+                if op == "$gt" and not value > arg:
+                    return False
+                if op == "$gte" and not value >= arg:
+                    return False
+                if op == "$lt" and not value < arg:
+                    return False
+                if op == "$lte" and not value <= arg:
+                    return False
+            else:
+                raise ValueError(f"Unsupported filter operator {op}")
+    return True
 
 
 class TelegramStore:
@@ -118,17 +1193,256 @@ class TelegramStore:
     """
     update_table_name = "updates"
     metadata_table_name = "metadata"
-    indices = [("user_id", ASCENDING)]
+    rollup_table_name = "rollups"
+    user_data_table_name = "user_data"
+    # One document per named marker, eg ROLLUPS_BUILT, see mark.
+    state_table_name = "store_state"
+
+    # Set once the rollups hold every priced metadata, see _ensure_rollups.
+    ROLLUPS_BUILT = "rollups_built"
+
+    # The fields that identify a record. Telegram can deliver, and a retried
+    # write can store, the same update twice. Inserts are no-ops for records
+    # that already exist, so that duplicates don't inflate the summaries.
+    unique_keys = {
+        update_table_name: ["update_id"],
+        metadata_table_name: ["update_id", "selection_path"],
+    }
 
-    # Singleton attributes
+    # The indices of every collection. On startup the indices in the db are
+    # reconciled against these, see DBManager.sync_indices. "serves" lists
+    # the queries that rely on the index, see index_report.
+    index_specs = {
+        update_table_name: [
+            {
+                "name": "message_from_id",
+                "keys": [("message.from.id", ASCENDING)],
+                "serves": ["get_updates({'message.from.id': ...}), the OM summary"],
+            },
+            {
+                "name": "update_id",
+                "keys": [("update_id", ASCENDING)],
+                "options": {"unique": True},
+                "serves": [
+                    "get_updates_by_metadata, the $in over update ids",
+                    "insert_update, the upsert that skips duplicate updates",
+                ],
+            },
+        ],
+        metadata_table_name: [
+            {
+                "name": "user_id_timestamp",
+                "keys": [("user_id", ASCENDING), ("timestamp", ASCENDING)],
+                "serves": [
+                    "get_metadata",
+                    "get_metadata_summary, the $match on user_id",
+                    "get_updates_by_metadata, via get_metadata",
+                ],
+            },
+            {
+                "name": "update_id_selection_path",
+                "keys": [("update_id", ASCENDING), ("selection_path", ASCENDING)],
+                "options": {"unique": True},
+                "serves": [
+                    "insert_metadata, the upsert that skips duplicate metadata"],
+            },
+        ],
+        rollup_table_name: [
+            {
+                "name": "user_id_category_description",
+                "keys": [
+                    ("user_id", ASCENDING),
+                    ("category", ASCENDING),
+                    ("description", ASCENDING),
+                ],
+                "options": {"unique": True},
+                "serves": [
+                    "get_rollups",
+                    "insert_metadata, the $inc upsert of a priced entry",
+                ],
+            },
+        ],
+        user_data_table_name: [
+            {
+                "name": "user_id",
+                "keys": [("user_id", ASCENDING)],
+                "options": {"unique": True},
+                "serves": [
+                    "get_user_data_async",
+                    "update_user_data_async, the $set upsert",
+                ],
+            },
+        ],
+        state_table_name: [
+            {
+                "name": "name",
+                "keys": [("name", ASCENDING)],
+                "options": {"unique": True},
+                "serves": ["is_marked", "mark, the $set upsert"],
+            },
+        ],
+    }
+
+    # The indices that earlier versions created and that are dropped on
+    # sync, eg the user_id index of hack/setup_db.py. Only these undeclared
+    # indices are dropped: the indices of options a store wasn't created
+    # with, eg the TTL index of update_ttl_days, are left to the stores
+    # that were, and the indices this code doesn't know of to the operator.
+    retired_indices = {
+        update_table_name: ["user_id_1"],
+    }
+
+    # With timeseries_metadata, metadata is a time-series collection with
+    # timestamp as the time field and {user_id, category} as the meta field.
+    # Queries by user go through the meta field, and time-series collections
+    # can't have unique indices, so these replace index_specs[metadata].
+    metadata_meta_field = "meta"
+    timeseries_index_specs = {
+        metadata_table_name: [
+            {
+                "name": "meta_user_id_timestamp",
+                "keys": [("meta.user_id", ASCENDING), ("timestamp", ASCENDING)],
+                "serves": [
+                    "get_metadata",
+                    "get_metadata_summary, the $match on meta.user_id",
+                ],
+            },
+            {
+                "name": "update_id_selection_path",
+                "keys": [("update_id", ASCENDING), ("selection_path", ASCENDING)],
+                "serves": [
+                    "insert_metadata, the lookup that skips duplicate metadata"],
+            },
+        ],
+    }
+
+    # Named durability profiles, as mongo write concerns. unacknowledged
+    # writes don't wait for mongo at all, relaxed waits for the primary to
+    # apply the write in memory, journaled also for its on-disk journal, and
+    # majority for a majority of the replica set's journals.
+    write_concerns = {
+        "unacknowledged": {"w": 0},
+        "relaxed": {"w": 1, "j": False},
+        "journaled": {"w": 1, "j": True},
+        "majority": {"w": "majority", "j": True},
+    }
+
+    # The default durability profile of every collection. A lost raw update
+    # only loses detail that the summaries don't read, and lost user_data
+    # only a half finished selection, while lost metadata or rollups change
+    # a user's totals.
+    write_profiles = {
+        update_table_name: "relaxed",
+        metadata_table_name: "journaled",
+        rollup_table_name: "journaled",
+        user_data_table_name: "relaxed",
+    }
+
+    # With update_ttl_days, updates are stamped with stored_at and mongo
+    # deletes them update_ttl_days later, through this TTL index. Other
+    # managers keep the index but don't expire anything.
+    update_ttl_field = "stored_at"
+
+    @classmethod
+    def _update_ttl_index_spec(cls, days: int) -> Dict[str, Any]:
+        return {
+            "name": f"{cls.update_ttl_field}_ttl",
+            "keys": [(cls.update_ttl_field, ASCENDING)],
+            "options": {"expireAfterSeconds": days * 24 * 60 * 60},
+            "serves": ["the expiry of updates, with update_ttl_days"],
+        }
+
+    # The fields of an update that are stored, see compact_update. True keeps
+    # the whole value, False drops it, and a dict keeps the fields it lists,
+    # compacted in turn. A dict with "*": True also keeps the fields it
+    # doesn't list as they are. These are the fields the handlers and
+    # summaries read, plus the ones Update.de_json needs to rebuild an
+    # Update, so stored updates stay valid Update dicts. Chat details
+    # duplicated from the user, entities and the text and inline keyboard of
+    # the message a button was attached to are dropped. Messages keep any
+    # other field, eg the photo, caption and location OM stores updates for.
+    _compact_user = {
+        "id": True,
+        "is_bot": True,
+        "first_name": True,
+        "last_name": True,
+        "username": True,
+        "language_code": True,
+    }
+    _compact_chat = {"id": True, "type": True}
+    compact_schema = {
+        "update_id": True,
+        "message": {
+            "*": True,
+            "message_id": True,
+            "date": True,
+            "text": True,
+            "photo": True,
+            "caption": True,
+            "location": True,
+            "chat": _compact_chat,
+            "from": _compact_user,
+            "entities": False,
+            "caption_entities": False,
+        },
+        "callback_query": {
+            "id": True,
+            "chat_instance": True,
+            "data": True,
+            "from": _compact_user,
+            "message": {
+                "message_id": True,
+                "date": True,
+                "chat": _compact_chat,
+            },
+        },
+    }
+
+    # Named projections, for readers that only need a few fields. Pass the
+    # name as the projection argument of get_updates or get_metadata.
+    OM_SUMMARY = "om_summary"
+    LIPOK_SUMMARY = "lipok_summary"
+    projections = {
+        # The fields updates_to_summary reads, plus the ones Update.de_json
+        # needs to rebuild a Message.
+        OM_SUMMARY: {
+            "update_id": 1,
+            "message.message_id": 1,
+            "message.chat.id": 1,
+            "message.chat.type": 1,
+            "message.text": 1,
+            "message.date": 1,
+            "message.from": 1,
+        },
+        # The fields metadata_to_summary reads.
+        LIPOK_SUMMARY: {
+            "selection_path": 1,
+            "timestamp": 1,
+            "user_name": 1,
+        },
+    }
+
+    # Singleton attributes. _instance is the store of the first bot. Every
+    # bot of the process has its own store in _instances, by db name, and
+    # TelegramStore() returns the store of the bot whose handler is
+    # running, see use().
     _instance = None
     _db_manager = None
+    _instances: Dict[str, "TelegramStore"] = {}
+    _current = contextvars.ContextVar("telegram_store", default=None)
 
     def __new__(
             cls,
             db_manager: DBManager = None,
             bot: Bot = None,
             bot_name: str = "",
+            write_buffer: WriteBuffer = None,
+            journal=None,
+            timeseries_metadata: bool = False,
+            update_ttl_days: int = 0,
+            compact_updates: bool = True,
+            write_profiles: Dict[str, str] = None,
+            maintenance: bool = False,
     ):
         """__new__ is python's way of enabling singletons.
 
@@ -142,6 +1456,12 @@ class TelegramStore:
 
         Will return a list of Telegram Update objects. 
 
+        A process that runs several bots creates one store per bot_name, by
+        invoking TelegramStore with a db manager and each bot_name. Without
+        a db manager, TelegramStore(bot_name=...) returns the store of that
+        bot, and TelegramStore() the store set with use(), or else the first
+        store.
+
         Arguments:
             db_manager: Required on first invocation. A pointer to the db. 
 
@@ -156,23 +1476,246 @@ class TelegramStore:
             bot_name: A user supplied name used to namespace the db tables for 
             this bot.
 
+            write_buffer: Optional. If set, updates and metadata are batched
+            in this buffer instead of being written one at a time. Reads
+            through the store still see the unflushed writes. The buffer must
+            wrap the same db_manager.
+
+            journal: Optional store.journal.Journal. If set, updates and
+            metadata are appended to this on-disk journal and replayed into
+            the database in the background, so that inserts don't wait on,
+            or fail with, the database. It supersedes write_buffer. Reads
+            through the store still see the unreplayed writes. The journal
+            must wrap the same db_manager.
+
+            timeseries_metadata: Optional. Store metadata in a time-series
+            collection, see timeseries_index_specs. The collection is created
+            if it doesn't exist. An existing plain collection must first be
+            migrated with hack/migrate_timeseries.py.
+
+            update_ttl_days: Optional. If set, raw updates are deleted this
+            many days after they are stored, see update_ttl_field. For
+            deployments that don't need the raw updates at all, the summaries
+            are computed from metadata. Updates stored before this was set
+            never expire, archive them with hack/archive_updates.py.
+            Unsetting it leaves the TTL index in place, see retired_indices,
+            drop the stored_at_ttl index to stop expiring updates.
+
+            compact_updates: Optional. Store updates in the compact_schema,
+            rather than the full Update.to_dict(). On by default.
+
+            write_profiles: Optional. Overrides the durability profile of
+            some collections, eg {"updates": "unacknowledged"}, see
+            write_profiles and write_concerns.
+
+            maintenance: Optional. For the scripts in hack/, which don't know
+            the options the bot runs with, eg update_ttl_days. Skips the
+            startup rollup rebuild and index sync, which are left to the
+            bot's store, and sets rollups_built to False.
+
         Returns: 
             Must return the _instance created via the super call. 
         """
         if cls._instance is None:
-            if db_manager is None:
+            # Tests reset the singleton through _instance.
+            cls._instances = {}
+        db_name = cls.get_db_name(bot_name)
+        if db_manager is None:
+            if bot_name:
+                if db_name not in cls._instances:
+                    raise ValueError(f"No store for bot {bot_name}.")
+                return cls._instances[db_name]
+            if cls._current.get() is not None:
+                return cls._current.get()
+            if cls._instance is None:
                 raise ValueError("Need a db manager to access the database.")
-            cls._instance = super(TelegramStore, cls).__new__(cls)
-            cls._instance._initialize(db_manager, bot, bot_name)
-        return cls._instance
+            return cls._instance
+        if db_name not in cls._instances:
+            instance = super(TelegramStore, cls).__new__(cls)
+            instance._initialize(
+                db_manager, bot, bot_name, write_buffer, journal,
+                timeseries_metadata, update_ttl_days, compact_updates,
+                write_profiles, maintenance)
+            cls._instances[db_name] = instance
+            if cls._instance is None:
+                cls._instance = instance
+        return cls._instances[db_name]
 
-    def _initialize(self, db_manager: DBManager, bot: Bot, bot_name: str):
+    @classmethod
+    def use(cls, store: "TelegramStore") -> None:
+        """Makes TelegramStore() return store in the current context, ie in
+        the running asyncio task, and in the tasks and worker threads it
+        starts from now on. A process that runs several bots calls this in
+        the task that runs each bot."""
+        cls._current.set(store)
+
+    def _initialize(
+            self,
+            db_manager: DBManager,
+            bot: Bot,
+            bot_name: str,
+            write_buffer: WriteBuffer,
+            journal=None,
+            timeseries_metadata: bool = False,
+            update_ttl_days: int = 0,
+            compact_updates: bool = True,
+            write_profiles: Dict[str, str] = None,
+            maintenance: bool = False):
         if self._db_manager is None:
             self.db_name = TelegramStore.get_db_name(bot_name)
             self._db_manager = db_manager
             self._bot = bot
-            self._db_manager.sync_indices(
-                self.db_name, self.update_table_name, self.indices)
+            self._write_buffer = write_buffer
+            self._journal = journal
+            self.timeseries_metadata = timeseries_metadata
+            self.update_ttl_days = update_ttl_days
+            self.compact_updates = compact_updates
+            self.write_profiles = {**self.write_profiles, **(write_profiles or {})}
+            for table_name, profile in self.write_profiles.items():
+                db_manager.set_write_concern(
+                    self.db_name, table_name, self.write_concerns[profile])
+            if timeseries_metadata:
+                # This can't wait for the background sync, the first insert
+                # would create a plain collection.
+                self._setup_timeseries()
+            self._index_sync = None
+            if maintenance:
+                self.rollups_built = False
+                return
+            # Whether get_rollups has every user's totals. This runs before
+            # the index sync, $out fails if the indices of the rollups change
+            # while it runs.
+            self.rollups_built = self._ensure_rollups()
+            # Index builds can take a while on large collections, so a bot's
+            # store builds them in the background instead of delaying its
+            # startup. The thread isn't a daemon, so that an exiting bot
+            # doesn't stop it between dropping and creating an index. Other
+            # stores, eg of tests, sync before returning.
+            if bot is not None:
+                self._index_sync = threading.Thread(target=self.sync_indices)
+                self._index_sync.start()
+            else:
+                self.sync_indices()
+
+    def _ensure_rollups(self) -> bool:
+        """Rebuilds the rollups once, if the metadata predates them.
+
+        Rollups are only maintained by insert_metadata, so the rollups of a
+        db upgraded from a version without them miss every earlier entry.
+        They are rebuilt from the metadata the first time the store starts,
+        before the bot handles any update, and marked as built.
+
+        Returns true if the rollups are built. If they can't be, eg because
+        the db is down, readers must summarize the metadata instead, see
+        LipokBotUpdate.get_user_totals.
+        """
+        try:
+            if self.is_marked(self.ROLLUPS_BUILT):
+                return True
+            if self._db_manager.find(
+                    {}, 1, self.db_name, self.metadata_table_name, {"_id": 1}):
+                logger.info(
+                    f"Rebuilding {self.db_name}.{self.rollup_table_name} from "
+                    f"metadata that predates it")
+                self.rebuild_rollups()
+            else:
+                self.mark(self.ROLLUPS_BUILT)
+            return True
+        except Exception as e:
+            logger.error(
+                f"Failed to build {self.db_name}.{self.rollup_table_name}, "
+                f"totals are summarized from the metadata until they are "
+                f"built, eg with hack/rebuild_rollups.py: {e}")
+            return False
+
+    def is_marked(self, name: str) -> bool:
+        """Returns true if the marker name was set with mark."""
+        return bool(self._db_manager.find(
+            {"name": name}, 1, self.db_name, self.state_table_name))
+
+    def mark(self, name: str) -> None:
+        """Sets the marker name, eg ROLLUPS_BUILT."""
+        self._db_manager.update(
+            {"name": name}, {"$set": {"at": datetime.now(timezone.utc)}},
+            self.db_name, self.state_table_name, upsert=True)
+
+    def _setup_timeseries(self) -> None:
+        if not self._db_manager.create_timeseries(
+                self.db_name, self.metadata_table_name,
+                time_field="timestamp", meta_field=self.metadata_meta_field):
+            logger.warning(
+                f"{self.db_name}.{self.metadata_table_name} is not a time-series "
+                f"collection, run hack/migrate_timeseries.py to convert it")
+
+    def _index_specs(self) -> Dict[str, list]:
+        """Returns index_specs, with the time-series and TTL specs if
+        enabled."""
+        specs = dict(self.index_specs)
+        if self.timeseries_metadata:
+            specs.update(self.timeseries_index_specs)
+        if self.update_ttl_days:
+            specs[self.update_table_name] = [
+                *specs[self.update_table_name],
+                self._update_ttl_index_spec(self.update_ttl_days)]
+        return specs
+
+    @property
+    def _metadata_user_key(self) -> str:
+        """The field get_metadata queries by."""
+        if self.timeseries_metadata:
+            return f"{self.metadata_meta_field}.user_id"
+        return "user_id"
+
+    def _with_meta(self, metadata: dict) -> dict:
+        """Adds the time-series meta field to metadata, if enabled."""
+        if self.timeseries_metadata:
+            metadata[self.metadata_meta_field] = {
+                "user_id": metadata.get("user_id"),
+                "category": metadata.get("category"),
+            }
+        return metadata
+
+    def sync_indices(self) -> None:
+        """Reconciles the indices of every collection with index_specs.
+
+        Undeclared indices are only dropped if they are retired_indices.
+        """
+        for table_name, specs in self._index_specs().items():
+            try:
+                self._db_manager.sync_indices(
+                    self.db_name, table_name, specs,
+                    droppable=self.retired_indices.get(table_name, []))
+            except Exception as e:
+                logger.error(
+                    f"Failed to sync indices of {self.db_name}.{table_name}: {e}")
+
+    def wait_for_indices(self, timeout: float = None) -> None:
+        """Blocks until the startup index sync of a bot's store is done."""
+        if self._index_sync is not None:
+            self._index_sync.join(timeout)
+
+    @classmethod
+    def index_report(cls) -> str:
+        """Returns a human readable report of the declared indices.
+
+        For each collection, lists every index with its keys and the
+        TelegramStore queries it serves.
+        """
+        lines = []
+        for table_name, specs in [
+                *cls.index_specs.items(),
+                *[(f"{t} (time-series)", s)
+                  for t, s in cls.timeseries_index_specs.items()],
+                (f"{cls.update_table_name} (update_ttl_days=1)",
+                 [cls._update_ttl_index_spec(1)])]:
+            lines.append(f"{table_name}:")
+            for spec in specs:
+                keys = ", ".join(f"{k} {d}" for k, d in spec["keys"])
+                options = f" {spec['options']}" if spec.get("options") else ""
+                lines.append(f"  {spec['name']} ({keys}){options}")
+                for query in spec["serves"]:
+                    lines.append(f"    serves: {query}")
+        return "\n".join(lines)
 
     @staticmethod
     def get_db_name(bot_name: str) -> str:
@@ -182,24 +1725,232 @@ class TelegramStore:
         """
         return ("%s_%s" % (bot_name, "telegram_bot")).lower()
 
+    def close(self) -> None:
+        """Flushes any buffered writes, and waits for the startup index sync.
+        Call this before the process exits."""
+        self.wait_for_indices()
+        if self._write_buffer is not None:
+            self._write_buffer.close()
+        if self._journal is not None:
+            self._journal.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the db manager's stats, eg the circuit breaker state, and
+        the journal depth."""
+        return {**self._db_manager.stats(), "journal_depth": self.journal_depth()}
+
+    def journal_depth(self) -> int:
+        """Returns the number of journaled writes not yet in the database."""
+        if self._journal is None:
+            return 0
+        return self._journal.depth()
+
+    def _insert(
+            self,
+            payload: Dict[str, Any],
+            table_name: str,
+            buffered: bool = True) -> bool:
+        """Inserts the payload, skipping duplicates (see unique_keys).
+
+        Returns False if the payload was a duplicate. Buffered and journaled
+        payloads are always reported as inserted, since duplicates are only
+        detected when they are written out. Set buffered=False to bypass the
+        buffer, but not the journal.
+        """
+        unique_key = self.unique_keys.get(table_name)
+        if self._journal is not None:
+            self._journal.add(payload, self.db_name, table_name, unique_key)
+            return True
+        if self._write_buffer is None or not buffered:
+            return self._db_manager.insert(
+                payload, self.db_name, table_name, unique_key)
+        if self._write_buffer.add(payload, self.db_name, table_name, unique_key):
+            self._write_buffer.flush()
+        return True
+
+    async def _insert_async(
+            self,
+            payload: Dict[str, Any],
+            table_name: str,
+            buffered: bool = True) -> bool:
+        unique_key = self.unique_keys.get(table_name)
+        if self._journal is not None:
+            await self._journal.add_async(
+                payload, self.db_name, table_name, unique_key)
+            return True
+        if self._write_buffer is None or not buffered:
+            return await self._db_manager.insert_async(
+                payload, self.db_name, table_name, unique_key)
+        if self._write_buffer.add(payload, self.db_name, table_name, unique_key):
+            await self._write_buffer.flush_async()
+        return True
+
+    def _pending(
+            self,
+            filter: dict,
+            table_name: str,
+            projection: dict = None) -> List[Dict[str, Any]]:
+        """Returns the buffered and journaled payloads matching filter."""
+        pending = []
+        for writer in (self._write_buffer, self._journal):
+            if writer is not None:
+                pending.extend(writer.pending(
+                    filter, self.db_name, table_name, projection))
+        return pending
+
+    def _merge_pending(
+            self,
+            pending: List[Dict[str, Any]],
+            found: List[Dict[str, Any]],
+            limit: int) -> List[Dict[str, Any]]:
+        """Merges buffered payloads into the results of a find.
+
+        pending must be read before the find. A payload flushed in between
+        shows up in both lists, and is de-duplicated on its _id.
+        """
+        if not pending:
+            return found
+        seen = {doc.get("_id") for doc in found}
+        merged = found + [p for p in pending if p["_id"] not in seen]
+        return merged[:limit] if limit > 0 else merged
+
+    def _find(
+            self,
+            filter: dict,
+            limit: int,
+            table_name: str,
+            projection: str = None) -> List[Dict[str, Any]]:
+        fields = self.projections[projection] if projection else None
+        pending = self._pending(filter, table_name, fields)
+        found = self._db_manager.find(
+            filter, limit, self.db_name, table_name, fields)
+        return self._merge_pending(pending, found, limit)
+
+    async def _find_async(
+            self,
+            filter: dict,
+            limit: int,
+            table_name: str,
+            projection: str = None) -> List[Dict[str, Any]]:
+        fields = self.projections[projection] if projection else None
+        pending = self._pending(filter, table_name, fields)
+        found = await self._db_manager.find_async(
+            filter, limit, self.db_name, table_name, fields)
+        return self._merge_pending(pending, found, limit)
+
+    def _find_in(
+            self, key: str, values: list, table_name: str) -> List[Dict[str, Any]]:
+        pending = self._pending({key: {"$in": values}}, table_name)
+        found = self._db_manager.find_in(
+            key, values, self.db_name, table_name)
+        return self._merge_pending(pending, found, 0)
+
+    async def _find_in_async(
+            self, key: str, values: list, table_name: str) -> List[Dict[str, Any]]:
+        pending = self._pending({key: {"$in": values}}, table_name)
+        found = await self._db_manager.find_in_async(
+            key, values, self.db_name, table_name)
+        return self._merge_pending(pending, found, 0)
+
+    @classmethod
+    def compact_update(cls, update: Dict[str, Any]) -> Dict[str, Any]:
+        """Returns the fields of update.to_dict() in compact_schema.
+
+        Updates of a type compact_schema doesn't describe, eg an
+        edited_message, are returned as is. Compacting a compact update is a
+        no-op.
+        """
+        # The fields the store adds to an update, kept as is.
+        stored = {"_id", cls.update_ttl_field}
+        if any(k not in cls.compact_schema for k in update if k not in stored):
+            return update
+
+        def _prune(doc, schema):
+            compact = {}
+            for k, v in doc.items():
+                field = schema.get(k, schema.get("*", False))
+                if field is True:
+                    compact[k] = v
+                elif field and isinstance(v, dict):
+                    compact[k] = _prune(v, field)
+            return compact
+        compact = _prune(update, cls.compact_schema)
+        compact.update({k: v for k, v in update.items() if k in stored})
+        return compact
+
+    def _update_payload(self, telegram_update: Update) -> Dict[str, Any]:
+        payload = telegram_update.to_dict()
+        if self.compact_updates:
+            payload = self.compact_update(payload)
+        if self.update_ttl_days:
+            payload[self.update_ttl_field] = datetime.now(timezone.utc)
+        return payload
+
     def insert_update(self, telegram_update: Update) -> None:
-        self._db_manager.insert(
-            telegram_update.to_dict(), self.db_name, self.update_table_name)
+        """Stores the update, unless an update with its update_id exists."""
+        self._insert(
+            self._update_payload(telegram_update), self.update_table_name)
 
-    def get_updates(self, filter={}, limit=0) -> list[Update]:
+    def get_updates(
+            self,
+            filter={},
+            limit=0,
+            batch_size=100,
+            sort=None,
+            projection=None) -> list[Update] | Iterator[Update]:
         """Returns updates. 
 
         Args:
             filter: the query filter. 
             limit: if set to a positive integer, limits the returned results.
                 if set to 0, returns all results, but pre-fetches them.  
-                if set to -1, returns all results, but only fetches them one at a time. 
+                if set to -1, returns a generator over all results, that
+                fetches batch_size of them at a time. 
+            batch_size: only used with limit=-1.
+            sort: only used with limit=-1. A list of (key, direction) pairs,
+                eg [("message.date", ASCENDING)]. Buffered, unflushed updates
+                are yielded last, after the sorted results.
+            projection: optional name of one of the projections, eg
+                TelegramStore.OM_SUMMARY. The returned updates only carry
+                those fields.
 
         Return: 
             All updates under the filter/limit constraint. 
         """
-        update_dicts = self._db_manager.find(
-            filter, limit, self.db_name, self.update_table_name)
+        if limit == -1:
+            return self._iter_updates(filter, batch_size, sort, projection)
+        update_dicts = self._find(
+            filter, limit, self.update_table_name, projection)
+        return [Update.de_json(u, self._bot) for u in update_dicts]
+
+    def _iter_updates(
+            self,
+            filter: dict,
+            batch_size: int,
+            sort: list,
+            projection: str) -> Iterator[Update]:
+        fields = self.projections[projection] if projection else None
+        pending = self._pending(filter, self.update_table_name, fields)
+        pending_ids = {p["_id"] for p in pending}
+        for u in self._db_manager.iter_find(
+                filter, self.db_name, self.update_table_name,
+                batch_size=batch_size, sort=sort, projection=fields):
+            pending_ids.discard(u["_id"])
+            yield Update.de_json(u, self._bot)
+        for u in pending:
+            if u["_id"] in pending_ids:
+                yield Update.de_json(u, self._bot)
+
+    async def insert_update_async(self, telegram_update: Update) -> None:
+        """Awaitable version of insert_update."""
+        await self._insert_async(
+            self._update_payload(telegram_update), self.update_table_name)
+
+    async def get_updates_async(
+            self, filter={}, limit=0, projection=None) -> list[Update]:
+        """Awaitable version of get_updates, without streaming."""
+        update_dicts = await self._find_async(
+            filter, limit, self.update_table_name, projection)
         return [Update.de_json(u, self._bot) for u in update_dicts]
 
     def insert_metadata(self, metadata: dict) -> None:
@@ -209,57 +1960,413 @@ class TelegramStore:
             metadata: The metadata to insert, eg: 
             {
                 "update_id": 123,
-                "selection_path": "button1:button2",
+                "selection_path": "123:/start:food:rice:within:0-50",
                 "timestamp": datetime.datetime.now(),
                 "user_id": 123,
                 "user_name": "user1",
                 "user_username": "user1",
                 "user_language_code": "en",
+                "category": "food",
+                "subcategory": "rice",
+                "source": "within",
+                "price_low": 0,
+                "price_high": 50,
+                "is_custom": False,
             }
+
+            Priced metadata, i.e with a category, subcategory and price_high,
+            is also added to the user's rollups. Priced metadata bypasses the
+            write buffer, so that it is only added to the rollups if it isn't
+            a duplicate. With a journal, the rollup is journaled along with
+            the metadata and applied on replay.
         """
-        self._db_manager.insert(metadata, self.db_name,
-                                self.metadata_table_name)
+        rollup = self._rollup_update(self._with_meta(metadata))
+        if self._journal_metadata(metadata, rollup):
+            return
+        inserted = self._insert(
+            metadata, self.metadata_table_name, buffered=rollup is None)
+        if rollup is not None and inserted:
+            self._db_manager.update(
+                *rollup, self.db_name, self.rollup_table_name, upsert=True)
 
-    def get_metadata(self, selection_path_pattern: str, limit: int = 0) -> List[Dict[str, Any]]:
-        """Get metadata by selection path pattern.
+    def get_metadata(
+            self,
+            user_id: int,
+            limit: int = 0,
+            projection: str = None) -> List[Dict[str, Any]]:
+        """Get the metadata of a user.
+
+        This is served by the (user_id, timestamp) index, or the
+        (meta.user_id, timestamp) index of a time-series collection.
 
         Args:
-            selection_path_pattern: The selection path pattern to filter by.
+            user_id: The telegram id of the user.
+            limit: if set to a positive integer, limits the returned results.
+            projection: optional name of one of the projections, eg
+                TelegramStore.LIPOK_SUMMARY.
 
         Returns:
-            A list of updates that match the selection path pattern.
+            A list of the user's metadata documents.
         """
-        return self._db_manager.find(
-            {"selection_path": {"$regex": selection_path_pattern}},
+        return self._find(
+            {self._metadata_user_key: user_id},
             limit=limit,
-            db_name=self.db_name,
-            table_name=self.metadata_table_name
+            table_name=self.metadata_table_name,
+            projection=projection
         )
 
-    def get_updates_by_metadata(self, selection_path_pattern: str) -> List[Update]:
-        """Get updates by metadata.
+    async def insert_metadata_async(self, metadata: dict) -> None:
+        """Awaitable version of insert_metadata."""
+        rollup = self._rollup_update(self._with_meta(metadata))
+        if self._journal is not None:
+            await self._journal.add_async(
+                metadata, self.db_name, self.metadata_table_name,
+                self.unique_keys[self.metadata_table_name],
+                then=self._journal_then(rollup))
+            return
+        inserted = await self._insert_async(
+            metadata, self.metadata_table_name, buffered=rollup is None)
+        if rollup is not None and inserted:
+            await self._db_manager.update_async(
+                *rollup, self.db_name, self.rollup_table_name, upsert=True)
+
+    def _journal_metadata(self, metadata: dict, rollup: tuple | None) -> bool:
+        """Journals the metadata and its rollup, if there is a journal."""
+        if self._journal is None:
+            return False
+        self._journal.add(
+            metadata, self.db_name, self.metadata_table_name,
+            self.unique_keys[self.metadata_table_name],
+            then=self._journal_then(rollup))
+        return True
+
+    def _journal_then(self, rollup: tuple | None) -> tuple | None:
+        """Returns the journal's then for a rollup, see Journal.add."""
+        if rollup is None:
+            return None
+        return (self.rollup_table_name, *rollup)
+
+    @staticmethod
+    def _rollup_update(metadata: dict) -> tuple[dict, dict] | None:
+        """Returns the (filter, changes) that add metadata to its rollup.
+
+        Rollups are keyed by (user_id, category, description), where the
+        description is the subcategory. Like metadata_to_summary, a price
+        range counts as its upper bound, and the user_name is the one of the
+        earliest entry, which is the first one upserted. Returns None for
+        unpriced metadata.
+        """
+        cost = metadata.get("price_high")
+        if (cost is None or not metadata.get("category") or
+                not metadata.get("subcategory")):
+            return None
+        return (
+            {
+                "user_id": metadata["user_id"],
+                "category": metadata["category"],
+                "description": metadata["subcategory"],
+            },
+            {
+                "$inc": {"total": cost, "count": 1},
+                "$min": {"first_timestamp": metadata["timestamp"]},
+                "$max": {"last_timestamp": metadata["timestamp"]},
+                "$setOnInsert": {"user_name": metadata.get("user_name")},
+            },
+        )
+
+    def get_rollups(self, user_id: int) -> Dict[str, Any] | None:
+        """Returns a user's spending totals from the rollups.
+
+        Unlike summarizing the metadata, this reads one document per
+        (category, description) the user has spent on, regardless of how
+        long their history is.
 
         Args:
-            selection_path_pattern: The selection path pattern to filter by.
+            user_id: The telegram id of the user.
 
         Returns:
-            A list of updates that match the selection path pattern.
+            None if the user has no priced metadata, else eg:
+            {
+                "user_name": "user1",
+                "start": datetime of the first priced entry,
+                "end": datetime of the last priced entry,
+                "category_totals": {"food": 150},
+                "description_totals": {"food": {"rice": 100, "wheat": 50}},
+            }
         """
-        metadata_docs = self.get_metadata(selection_path_pattern)
-        if not metadata_docs:
-            return []
+        return self._fold_rollups(self._db_manager.find(
+            {"user_id": user_id}, 0, self.db_name, self.rollup_table_name))
 
+    async def get_rollups_async(self, user_id: int) -> Dict[str, Any] | None:
+        """Awaitable version of get_rollups."""
+        return self._fold_rollups(await self._db_manager.find_async(
+            {"user_id": user_id}, 0, self.db_name, self.rollup_table_name))
+
+    async def get_user_data_async(self, user_id: int) -> Dict[str, Any]:
+        """Returns the persisted context.user_data of a user, or {}. See
+        store.persistence."""
+        records = await self._db_manager.find_async(
+            {"user_id": user_id}, 1, self.db_name, self.user_data_table_name)
+        return records[0]["data"] if records else {}
+
+    async def update_user_data_async(
+            self, user_id: int, data: Dict[str, Any]) -> None:
+        """Replaces the persisted context.user_data of a user."""
+        await self._db_manager.update_async(
+            {"user_id": user_id},
+            {"$set": {"data": data, "updated_at": datetime.now(timezone.utc)}},
+            self.db_name, self.user_data_table_name, upsert=True)
+
+    @staticmethod
+    def _fold_rollups(rollups: List[Dict[str, Any]]) -> Dict[str, Any] | None:
+        if not rollups:
+            return None
+        category_totals = {}
+        description_totals = {}
+        for r in rollups:
+            category_totals[r["category"]] = (
+                category_totals.get(r["category"], 0) + r["total"])
+            description_totals.setdefault(
+                r["category"], {})[r["description"]] = r["total"]
+        return {
+            "user_name": min(rollups, key=lambda r: r["first_timestamp"])["user_name"],
+            "start": min(r["first_timestamp"] for r in rollups),
+            "end": max(r["last_timestamp"] for r in rollups),
+            "category_totals": category_totals,
+            "description_totals": description_totals,
+        }
+
+    def _metadata_summary_pipeline(
+            self,
+            user_id: int,
+            start: datetime = None,
+            end: datetime = None) -> list:
+        """Mirrors summary.metadata_to_totals as a mongo aggregation.
+
+        The raw selection path is split on the server, so this also works
+        for metadata written before the parsed fields existed. A path counts
+        towards the totals if it has at least 5 elements and ends in a price
+        or price range, the upper bound of which is the cost.
+        """
+        last = {"$arrayElemAt": ["$_path", -1]}
+        prices = {"$split": ["$_last", "-"]}
+        match = {self._metadata_user_key: user_id}
+        if start is not None or end is not None:
+            match["timestamp"] = {}
+            if start is not None:
+                match["timestamp"]["$gte"] = start
+            if end is not None:
+                match["timestamp"]["$lt"] = end
+        return [
+            {"$match": match},
+            {"$addFields": {"_path": {"$split": ["$selection_path", ":"]}}},
+            {"$addFields": {"_last": last}},
+            {"$facet": {
+                "span": [
+                    {"$sort": {"timestamp": ASCENDING}},
+                    {"$group": {
+                        "_id": None,
+                        "start": {"$min": "$timestamp"},
+                        "end": {"$max": "$timestamp"},
+                        "user_name": {"$first": "$user_name"},
+                    }},
+                ],
+                "totals": [
+                    {"$match": {"$expr": {"$and": [
+                        {"$gte": [{"$size": "$_path"}, 5]},
+                        {"$regexMatch": {
+                            "input": "$_last", "regex": f"^{PRICE_PATTERN}$"}},
+                    ]}}},
+                    {"$group": {
+                        "_id": {
+                            "category": {"$arrayElemAt": ["$_path", 2]},
+                            "description": {"$arrayElemAt": ["$_path", 3]},
+                        },
+                        "total": {"$sum": {"$max": [
+                            {"$toLong": {"$arrayElemAt": [prices, 0]}},
+                            {"$toLong": {"$arrayElemAt": [prices, -1]}},
+                        ]}},
+                    }},
+                ],
+            }},
+        ]
+
+    @staticmethod
+    def _fold_metadata_summary(result: List[Dict[str, Any]]) -> Dict[str, Any] | None:
+        span = result[0]["span"] if result else None
+        if not span or span[0]["start"] is None:
+            return None
+        span = span[0]
+        category_totals = {}
+        description_totals = {}
+        for t in result[0]["totals"]:
+            category = t["_id"]["category"]
+            category_totals[category] = (
+                category_totals.get(category, 0) + t["total"])
+            description_totals.setdefault(
+                category, {})[t["_id"]["description"]] = t["total"]
+        return {
+            "user_name": span["user_name"],
+            "start": span["start"],
+            "end": span["end"],
+            "category_totals": category_totals,
+            "description_totals": description_totals,
+        }
+
+    def get_metadata_summary(
+            self,
+            user_id: int,
+            start: datetime = None,
+            end: datetime = None) -> Dict[str, Any] | None:
+        """Computes a user's spending totals from their metadata, in the db.
+
+        This does the same work as summary.metadata_to_totals, in a single
+        aggregation round-trip instead of downloading the user's metadata.
+        Buffered, unflushed metadata is not included.
+
+        Args:
+            user_id: The telegram id of the user.
+            start, end: optional, only metadata with start <= timestamp < end
+                is summarized.
+
+        Returns:
+            None if the user has no metadata, else the totals in the same
+            shape as get_rollups.
+
+        Raises:
+            NotImplementedError: if the db manager can't run aggregations.
+            Fall back to summary.metadata_to_totals(get_metadata(user_id)).
+        """
+        return self._fold_metadata_summary(self._db_manager.aggregate(
+            self._metadata_summary_pipeline(user_id, start, end),
+            self.db_name, self.metadata_table_name))
+
+    async def get_metadata_summary_async(
+            self,
+            user_id: int,
+            start: datetime = None,
+            end: datetime = None) -> Dict[str, Any] | None:
+        """Awaitable version of get_metadata_summary."""
+        return self._fold_metadata_summary(await self._db_manager.aggregate_async(
+            self._metadata_summary_pipeline(user_id, start, end),
+            self.db_name, self.metadata_table_name))
+
+    def rebuild_rollups(self) -> None:
+        """Recomputes every rollup from the raw metadata, and marks the
+        rollups as built.
+
+        The rollups collection is atomically replaced via $out, so readers
+        see either the old or the new rollups. Managers that can't run
+        aggregations rebuild the rollups one by one instead.
+
+        Rollups that insert_metadata updates while this runs are overwritten
+        with the rebuilt ones, so stop the bots that write to this db first.
+        The store runs this on startup, before its bot handles any update,
+        see _ensure_rollups.
+        """
+        try:
+            self._aggregate_rollups()
+        except NotImplementedError:
+            self._fold_metadata_into_rollups()
+        self.mark(self.ROLLUPS_BUILT)
+
+    def _fold_metadata_into_rollups(self) -> None:
+        """Recomputes every rollup in python, see rebuild_rollups."""
+        rollups = {}
+        for doc in self._db_manager.iter_find(
+                {}, self.db_name, self.metadata_table_name,
+                sort=[("timestamp", ASCENDING)]):
+            update = self._rollup_update(doc)
+            if update is None:
+                continue
+            filter, changes = update
+            key = tuple(filter.values())
+            inserting = key not in rollups
+            if inserting:
+                rollups[key] = _upsert_base(filter)
+            _apply_update(rollups[key], changes, inserting)
+        self._db_manager.delete({}, self.db_name, self.rollup_table_name)
+        self._db_manager.insert_many(
+            list(rollups.values()), self.db_name, self.rollup_table_name)
+
+    def _aggregate_rollups(self) -> None:
+        self._db_manager.aggregate([
+            {"$match": {
+                "price_high": {"$ne": None},
+                "category": {"$ne": None},
+                "subcategory": {"$ne": None},
+            }},
+            {"$sort": {"timestamp": ASCENDING}},
+            {"$group": {
+                "_id": {
+                    "user_id": "$user_id",
+                    "category": "$category",
+                    "description": "$subcategory",
+                },
+                "total": {"$sum": "$price_high"},
+                "count": {"$sum": 1},
+                "first_timestamp": {"$min": "$timestamp"},
+                "last_timestamp": {"$max": "$timestamp"},
+                "user_name": {"$first": "$user_name"},
+            }},
+            {"$project": {
+                "_id": 0,
+                "user_id": "$_id.user_id",
+                "category": "$_id.category",
+                "description": "$_id.description",
+                "total": 1,
+                "count": 1,
+                "first_timestamp": 1,
+                "last_timestamp": 1,
+                "user_name": 1,
+            }},
+            {"$out": self.rollup_table_name},
+        ], self.db_name, self.metadata_table_name)
+
+    async def get_metadata_async(
+            self,
+            user_id: int,
+            limit: int = 0,
+            projection: str = None) -> List[Dict[str, Any]]:
+        """Awaitable version of get_metadata."""
+        return await self._find_async(
+            {self._metadata_user_key: user_id},
+            limit=limit,
+            table_name=self.metadata_table_name,
+            projection=projection
+        )
+
+    def get_updates_by_metadata(self, user_id: int) -> List[Update]:
+        """Get the updates referenced by a user's metadata.
+
+        Args:
+            user_id: The telegram id of the user.
+
+        Returns:
+            A list of updates for the user's metadata documents.
+        """
+        metadata_docs = self.get_metadata(user_id)
         update_ids = [doc["update_id"] for doc in metadata_docs]
+        return self._updates_in_order(
+            update_ids, self._find_in("update_id", update_ids,
+                                      self.update_table_name))
 
-        updates = []
-        for update_id in update_ids:
-            update_dict = self._db_manager.find_one(
-                {"update_id": update_id},
-                self.db_name,
-                self.update_table_name
-            )
-            if update_dict:
-                update = Update.de_json(update_dict, self._bot)
-                updates.append(update)
-
-        return updates
+    async def get_updates_by_metadata_async(self, user_id: int) -> List[Update]:
+        """Awaitable version of get_updates_by_metadata."""
+        metadata_docs = await self.get_metadata_async(user_id)
+        update_ids = [doc["update_id"] for doc in metadata_docs]
+        return self._updates_in_order(
+            update_ids, await self._find_in_async(
+                "update_id", update_ids, self.update_table_name))
+
+    def _updates_in_order(
+            self,
+            update_ids: list,
+            update_dicts: List[Dict[str, Any]]) -> List[Update]:
+        """Returns one Update per update_id, in the order of update_ids.
+
+        Update ids without a stored update are skipped.
+        """
+        by_id = {u["update_id"]: u for u in update_dicts}
+        return [Update.de_json(by_id[i], self._bot)
+                for i in update_ids if i in by_id]
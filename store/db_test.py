@@ -20,4 +20,668 @@
 #     "category": "food",
 #     "cost": 100.0,
 #     "user_id": 123, 
-# }
\ No newline at end of file
+# }
+
+import asyncio
+import unittest
+import mongomock
+from unittest import mock
+from pymongo import ASCENDING, errors
+from datetime import datetime
+from telegram import (
+    Update, Message, Chat, User, CallbackQuery, InlineKeyboardButton,
+    InlineKeyboardMarkup, MessageEntity, PhotoSize, Location)
+from store.db import (
+    MongoManager, AsyncMongoManager, TelegramStore, WriteBuffer, RetryPolicy,
+    CircuitBreaker, CircuitOpenError)
+from summary import metadata_to_totals, updates_to_summary
+from bots.lipok import LipokBotUpdate
+
+TEST_USER_ID = 123456
+TEST_USER_NAME = "TestUser"
+
+
+class TestTelegramStore(unittest.IsolatedAsyncioTestCase):
+
+    def _update(self, msg="/start", user_id=TEST_USER_ID, update_id=1):
+        u = User(id=user_id, first_name=TEST_USER_NAME, is_bot=False)
+        return Update(
+            update_id=update_id,
+            message=Message(
+                message_id=update_id,
+                date=datetime.now(),
+                chat=Chat(id=user_id, type="private"),
+                text=msg,
+                from_user=u,
+            ),
+        )
+
+    def _metadata(self, selection_path, user_id=TEST_USER_ID, update_id=1):
+        path = f"{user_id}:{selection_path}"
+        elements = path.split(":")
+        prices = None
+        if len(elements) > 5 and elements[-1].replace("-", "").isdigit():
+            prices = elements[-1].split("-")
+        return {
+            "update_id": update_id,
+            "selection_path": path,
+            "timestamp": datetime.now(),
+            "user_id": user_id,
+            "user_name": TEST_USER_NAME,
+            "category": elements[2] if len(elements) > 2 else None,
+            "subcategory": elements[3] if len(elements) > 3 else None,
+            "price_high": int(prices[-1]) if prices else None,
+        }
+
+    def setUp(self):
+        # TelegramStore is a singleton, reset it so every test gets a fresh
+        # db manager.
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        self.client = mongomock.MongoClient()
+        self.ts = TelegramStore(MongoManager(client=self.client), bot_name="test")
+        self.ts.wait_for_indices()
+
+    async def test_async_round_trip(self):
+        update = self._update("hello")
+        await self.ts.insert_update_async(update)
+        updates = await self.ts.get_updates_async(
+            filter={"message.from.id": TEST_USER_ID})
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0].message.text, "hello")
+
+        await self.ts.insert_metadata_async(
+            self._metadata("/start:food:rice:within:0-50"))
+        metadata = await self.ts.get_metadata_async(TEST_USER_ID)
+        self.assertEqual(len(metadata), 1)
+
+    def test_get_updates_streaming(self):
+        for update_id in [2, 3, 1]:
+            self.ts.insert_update(self._update(str(update_id), update_id=update_id))
+        updates = self.ts.get_updates(
+            limit=-1, batch_size=1, sort=[("update_id", ASCENDING)])
+        self.assertNotIsInstance(updates, list)
+        self.assertEqual([u.update_id for u in updates], [1, 2, 3])
+
+    def test_projections(self):
+        self.ts.insert_update(self._update("hello"))
+        updates = self.ts.get_updates(projection=TelegramStore.OM_SUMMARY)
+        self.assertEqual(updates[0].message.text, "hello")
+        self.assertEqual(updates[0].message.from_user.id, TEST_USER_ID)
+
+        self.ts.insert_metadata(self._metadata("/start"))
+        metadata = self.ts.get_metadata(
+            TEST_USER_ID, projection=TelegramStore.LIPOK_SUMMARY)
+        self.assertEqual(
+            set(metadata[0]), {"_id", "selection_path", "timestamp", "user_name"})
+
+    def test_get_updates_by_metadata(self):
+        # Metadata references updates out of insertion order, and one update
+        # has no metadata.
+        for update_id in [1, 2, 3]:
+            self.ts.insert_update(self._update(str(update_id), update_id=update_id))
+        for update_id in [3, 1]:
+            self.ts.insert_metadata(
+                self._metadata("/start", update_id=update_id))
+
+        updates = self.ts.get_updates_by_metadata(TEST_USER_ID)
+        self.assertEqual([u.update_id for u in updates], [3, 1])
+        self.assertEqual(self.ts.get_updates_by_metadata(56), [])
+
+    def test_rollups(self):
+        paths = [
+            "/start",
+            "/start:food:rice:within:0-50",
+            "/start:food:rice:outside:50-100",
+            "/start:food:wheat:within:custom:20",
+            "/start:fuel:gas:within:100-200",
+        ]
+        for i, path in enumerate(paths):
+            metadata = self._metadata(path, update_id=i)
+            if i == len(paths) - 1:
+                # The user renamed themselves, summaries greet them by the
+                # name of their earliest entry.
+                metadata["user_name"] = "ramu"
+            self.ts.insert_metadata(metadata)
+
+        rollups = self.ts.get_rollups(TEST_USER_ID)
+        self.assertEqual(rollups["user_name"], TEST_USER_NAME)
+        self.assertEqual(
+            self.ts.get_metadata_summary(TEST_USER_ID)["user_name"],
+            TEST_USER_NAME)
+        self.assertEqual(
+            metadata_to_totals(self.ts.get_metadata(TEST_USER_ID))["user_name"],
+            TEST_USER_NAME)
+        self.assertEqual(rollups["category_totals"], {"food": 170, "fuel": 200})
+        self.assertEqual(rollups["description_totals"], {
+            "food": {"rice": 150, "wheat": 20}, "fuel": {"gas": 200}})
+        self.assertIsNone(self.ts.get_rollups(56))
+
+        self.ts.rebuild_rollups()
+        rebuilt = self.ts.get_rollups(TEST_USER_ID)
+        self.assertEqual(rebuilt["user_name"], TEST_USER_NAME)
+        self.assertEqual(rebuilt["category_totals"], rollups["category_totals"])
+        self.assertEqual(
+            rebuilt["description_totals"], rollups["description_totals"])
+
+    def test_rollups_of_metadata_that_predates_them(self):
+        # A db written before rollups existed has metadata, but no rollups.
+        client = mongomock.MongoClient()
+        metadata = client[self.ts.db_name][self.ts.metadata_table_name]
+        for i, path in enumerate([
+                "/start:food:rice:within:100-200",
+                "/start:food:wheat:within:50-100"]):
+            metadata.insert_one(self._metadata(path, update_id=i))
+
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        ts = TelegramStore(MongoManager(client=client), bot_name="test")
+        ts.wait_for_indices()
+        self.assertTrue(ts.rollups_built)
+        self.assertTrue(ts.is_marked(TelegramStore.ROLLUPS_BUILT))
+        ts.insert_metadata(
+            self._metadata("/start:fuel:gas:within:0-50", update_id=10))
+        self.assertEqual(ts.get_rollups(TEST_USER_ID)["category_totals"],
+                         {"food": 300, "fuel": 50})
+
+    def test_large_prices(self):
+        # Above int32, and a price with more digits than PRICE_PATTERN allows.
+        paths = [
+            "/start:food:rice:within:custom:3000000000",
+            "/start:food:rice:within:0-50",
+            "/start:fuel:gas:within:custom:1000000000000",
+        ]
+        for i, path in enumerate(paths):
+            metadata = self._metadata(path, update_id=i)
+            metadata.update(
+                LipokBotUpdate.parse_selection_path(metadata["selection_path"]))
+            self.ts.insert_metadata(metadata)
+
+        expected = metadata_to_totals(self.ts.get_metadata(TEST_USER_ID))
+        self.assertEqual(expected["category_totals"], {"food": 3000000050})
+        self.assertEqual(self.ts.get_metadata_summary(TEST_USER_ID), expected)
+        self.assertEqual(
+            self.ts.get_rollups(TEST_USER_ID)["category_totals"],
+            expected["category_totals"])
+
+    def test_metadata_summary_matches_python(self):
+        paths = [
+            "/start",
+            "/start:food:rice:within:0-50",
+            "/start:food:rice:outside:custom:abc",
+            "/start:food:wheat:within:custom:20",
+            "/start:food:wheat:within:custom",
+            "/start:fuel:gas:within:100-200",
+            "/start:summary",
+            # int() accepts these, PRICE_PATTERN doesn't.
+            "/start:food:rice:within:custom:50 ",
+            "/start:food:rice:within:custom:+5",
+            "/start:food:rice:within:custom:1_000",
+        ]
+        for i, path in enumerate(paths):
+            self.ts.insert_metadata(self._metadata(path, update_id=i))
+
+        expected = metadata_to_totals(self.ts.get_metadata(TEST_USER_ID))
+        self.assertEqual(self.ts.get_metadata_summary(TEST_USER_ID), expected)
+        self.assertEqual(expected["category_totals"], {"food": 70, "fuel": 200})
+        self.assertIsNone(self.ts.get_metadata_summary(56))
+
+        # The date range only covers the last metadata.
+        last = self.ts.get_metadata(TEST_USER_ID)[-1]["timestamp"]
+        self.assertIsNone(
+            self.ts.get_metadata_summary(TEST_USER_ID, end=datetime(2000, 1, 1)))
+        self.assertEqual(
+            self.ts.get_metadata_summary(TEST_USER_ID, start=last)["start"],
+            last)
+
+    def test_timeseries_inserts_skip_duplicates(self):
+        # mongomock can't create time-series collections, mark it as one.
+        manager = self.ts._db_manager
+        table = self.ts.metadata_table_name
+        manager._timeseries.add((self.ts.db_name, table))
+        key = TelegramStore.unique_keys[table]
+        manager._delete_all(self.ts.db_name, table)
+
+        self.assertTrue(manager.insert(
+            self._metadata("/start", update_id=1), self.ts.db_name, table, key))
+        self.assertFalse(manager.insert(
+            self._metadata("/start", update_id=1), self.ts.db_name, table, key))
+        batch = [self._metadata("/start", update_id=i) for i in [1, 2, 2, 3]]
+        self.assertEqual(
+            manager.insert_many(batch, self.ts.db_name, table, key), 2)
+        self.assertEqual(len(self.ts.get_metadata(TEST_USER_ID)), 3)
+
+    def test_duplicates_are_ignored(self):
+        update = self._update("hello")
+        self.ts.insert_update(update)
+        self.ts.insert_update(update)
+        self.assertEqual(len(self.ts.get_updates()), 1)
+
+        priced = self._metadata("/start:food:rice:within:0-50")
+        for _ in range(2):
+            self.ts.insert_metadata(dict(priced))
+        # Same update, different selection path.
+        self.ts.insert_metadata(self._metadata("/start"))
+        self.assertEqual(len(self.ts.get_metadata(TEST_USER_ID)), 2)
+        self.assertEqual(
+            self.ts.get_rollups(TEST_USER_ID)["category_totals"], {"food": 50})
+
+    def test_sync_indices(self):
+        updates = self.client[self.ts.db_name][self.ts.update_table_name]
+        self.assertEqual(
+            set(updates.index_information()),
+            {"_id_", "message_from_id", "update_id"})
+
+        # The old user_id index is dropped, a changed spec is recreated.
+        updates.create_index([("user_id", ASCENDING)])
+        updates.drop_index("update_id")
+        updates.create_index([("update_id", -1)], name="update_id")
+        self.ts.sync_indices()
+        info = updates.index_information()
+        self.assertNotIn("user_id_1", info)
+        self.assertEqual(info["update_id"]["key"], [("update_id", ASCENDING)])
+
+    def test_compact_updates(self):
+        user = User(id=TEST_USER_ID, first_name=TEST_USER_NAME, is_bot=False)
+        chat = Chat(id=TEST_USER_ID, type="private", first_name=TEST_USER_NAME)
+        keyboard = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("0-50", callback_data="price:0-50")]])
+        self.ts.insert_update(Update(
+            update_id=1,
+            callback_query=CallbackQuery(
+                id="1", from_user=user, chat_instance="1", data="price:0-50",
+                message=Message(
+                    message_id=1, date=datetime.now(), chat=chat,
+                    text="Select a price", reply_markup=keyboard))))
+        self.ts.insert_update(Update(
+            update_id=2,
+            message=Message(
+                message_id=2, date=datetime.now(), chat=chat, text="/start",
+                from_user=user, entities=[MessageEntity("bot_command", 0, 6)])))
+
+        stored = self.client[self.ts.db_name][self.ts.update_table_name]
+        button = stored.find_one({"update_id": 1})
+        self.assertNotIn("reply_markup", button["callback_query"]["message"])
+        self.assertNotIn("text", button["callback_query"]["message"])
+        text = stored.find_one({"update_id": 2})
+        self.assertNotIn("entities", text["message"])
+        self.assertEqual(text["message"]["chat"], {"id": TEST_USER_ID, "type": "private"})
+
+        button, text = sorted(self.ts.get_updates(), key=lambda u: u.update_id)
+        self.assertEqual(button.callback_query.data, "price:0-50")
+        self.assertEqual(button.effective_user.id, TEST_USER_ID)
+        self.assertEqual(
+            updates_to_summary(
+                self.ts.get_updates({"message.from.id": TEST_USER_ID})).user_name,
+            text.message.from_user.name)
+        self.assertEqual(TelegramStore.compact_update(text.to_dict()),
+                         TelegramStore.compact_update(
+                             TelegramStore.compact_update(text.to_dict())))
+
+    def test_compact_media_updates(self):
+        user = User(id=TEST_USER_ID, first_name=TEST_USER_NAME, is_bot=False)
+        chat = Chat(id=TEST_USER_ID, type="private", first_name=TEST_USER_NAME)
+        photo = Update(
+            update_id=1,
+            message=Message(
+                message_id=1, date=datetime.now(), chat=chat, from_user=user,
+                caption="receipt",
+                caption_entities=[MessageEntity("bold", 0, 7)],
+                photo=[PhotoSize("small", "s1", 90, 90),
+                       PhotoSize("large", "s2", 800, 800, file_size=1024)]))
+        location = Update(
+            update_id=2,
+            message=Message(
+                message_id=2, date=datetime.now(), chat=chat, from_user=user,
+                location=Location(longitude=77.639163, latitude=12.977179)))
+        self.ts.insert_update(photo)
+        self.ts.insert_update(location)
+
+        stored = self.client[self.ts.db_name][self.ts.update_table_name]
+        self.assertNotIn(
+            "caption_entities", stored.find_one({"update_id": 1})["message"])
+        photo_back, location_back = sorted(
+            self.ts.get_updates(), key=lambda u: u.update_id)
+        self.assertEqual(photo_back.message.caption, "receipt")
+        self.assertEqual(photo_back.message.photo, photo.message.photo)
+        self.assertEqual(photo_back.message.photo[-1].file_id, "large")
+        self.assertEqual(
+            location_back.message.location, location.message.location)
+        self.assertEqual(location_back.message.location.latitude, 12.977179)
+
+    def test_write_profiles(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        manager = MongoManager(client=self.client)
+        ts = TelegramStore(
+            manager, bot_name="test",
+            write_profiles={TelegramStore.update_table_name: "unacknowledged"})
+        ts.wait_for_indices()
+
+        def concern(table_name):
+            return manager._collection(
+                self.client, ts.db_name, table_name).write_concern.document
+        self.assertEqual(concern(ts.update_table_name), {"w": 0})
+        self.assertEqual(concern(ts.metadata_table_name), {"w": 1, "j": True})
+        self.assertEqual(concern(ts.rollup_table_name), {"w": 1, "j": True})
+
+        ts.insert_update(self._update("hello"))
+        ts.insert_metadata(self._metadata("/start:food:rice:within:0-50"))
+        self.assertEqual(len(ts.get_updates()), 1)
+        self.assertEqual(len(ts.get_metadata(TEST_USER_ID)), 1)
+
+    def test_update_ttl(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        ts = TelegramStore(
+            MongoManager(client=self.client), bot_name="test", update_ttl_days=30)
+        ts.wait_for_indices()
+        ts.insert_update(self._update("hello"))
+
+        updates = self.client[ts.db_name][ts.update_table_name]
+        self.assertEqual(
+            updates.index_information()["stored_at_ttl"]["expireAfterSeconds"],
+            30 * 24 * 60 * 60)
+        self.assertIsNotNone(updates.find_one()["stored_at"])
+        self.assertEqual(ts.get_updates()[0].message.text, "hello")
+
+        # A store without update_ttl_days, eg of another process, leaves the
+        # TTL index to the stores that declare it.
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        TelegramStore(MongoManager(client=self.client), bot_name="test")
+        self.assertIn("stored_at_ttl", updates.index_information())
+
+    def test_maintenance_store(self):
+        client = mongomock.MongoClient()
+        db = client[self.ts.db_name]
+        db[self.ts.metadata_table_name].insert_one(
+            self._metadata("/start:food:rice:within:100-200"))
+        db[self.ts.update_table_name].create_index(
+            [("stored_at", ASCENDING)], name="stored_at_ttl",
+            expireAfterSeconds=60)
+
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        # A script's store neither rebuilds the rollups nor syncs indices,
+        # they are the bot's.
+        ts = TelegramStore(
+            MongoManager(client=client), bot_name="test", maintenance=True)
+        self.assertFalse(ts.rollups_built)
+        self.assertFalse(ts.is_marked(TelegramStore.ROLLUPS_BUILT))
+        self.assertEqual(
+            set(db[ts.update_table_name].index_information()),
+            {"_id_", "stored_at_ttl"})
+        self.assertNotIn(ts.rollup_table_name, db.list_collection_names())
+
+    def test_index_sync_of_a_bot(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        ts = TelegramStore(MongoManager(client=self.client), bot=mock.Mock(),
+                           bot_name="bot")
+        # A bot's store syncs in the background, in a thread that an exiting
+        # process waits for.
+        self.assertFalse(ts._index_sync.daemon)
+        ts.close()
+        self.assertFalse(ts._index_sync.is_alive())
+        self.assertIn(
+            "update_id",
+            self.client[ts.db_name][ts.update_table_name].index_information())
+
+    async def test_stores_per_bot(self):
+        # A second bot on the same client, eg in a process running both.
+        other = TelegramStore(MongoManager(client=self.client), bot_name="other")
+        other.wait_for_indices()
+        self.assertIsNot(other, self.ts)
+        self.assertIs(TelegramStore(bot_name="other"), other)
+        self.assertIs(TelegramStore(), self.ts)
+        with self.assertRaises(ValueError):
+            TelegramStore(bot_name="missing")
+
+        async def handle(store, msg):
+            # Handlers get the store of the bot whose task they run in.
+            TelegramStore.use(store)
+            await asyncio.sleep(0)
+            await TelegramStore().insert_update_async(self._update(msg))
+
+        await asyncio.gather(handle(self.ts, "test"), handle(other, "other"))
+        self.assertEqual(
+            [u.message.text for u in self.ts.get_updates()], ["test"])
+        self.assertEqual(
+            [u.message.text for u in other.get_updates()], ["other"])
+        self.assertIs(TelegramStore(), self.ts)
+
+    def test_get_metadata_matches_exact_user(self):
+        # 56 is a suffix of TEST_USER_ID, the old regex filter matched both.
+        self.ts.insert_metadata(self._metadata("/start", user_id=TEST_USER_ID))
+        self.ts.insert_metadata(self._metadata("/start", user_id=56))
+        self.assertEqual(len(self.ts.get_metadata(56)), 1)
+        self.assertEqual(len(self.ts.get_metadata(TEST_USER_ID)), 1)
+
+
+
+class FakeMotorCursor:
+    """The part of motor's cursors AsyncMongoManager uses."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def limit(self, limit):
+        self._cursor = self._cursor.limit(limit)
+        return self
+
+    async def to_list(self, length=None):
+        return list(self._cursor)
+
+
+class FakeMotorCollection:
+    """A motor collection over a mongomock collection. Every call is
+    recorded, and the first client.failures calls fail."""
+
+    def __init__(self, client, collection):
+        self._client = client
+        self._collection = collection
+
+    def with_options(self, **options):
+        return FakeMotorCollection(
+            self._client, self._collection.with_options(**options))
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+        if name in ("find", "aggregate"):
+            def cursor(*args, **kwargs):
+                self._client.calls.append(name)
+                return FakeMotorCursor(method(*args, **kwargs))
+            return cursor
+
+        async def call(*args, **kwargs):
+            self._client.calls.append(name)
+            if self._client.failures:
+                self._client.failures -= 1
+                raise errors.AutoReconnect("mongod is down")
+            return method(*args, **kwargs)
+        return call
+
+
+class FakeMotorClient:
+
+    def __init__(self, client):
+        self.delegate = client
+        self.calls = []
+        self.failures = 0
+
+    def __getitem__(self, db_name):
+        client = self
+
+        class Database:
+            def __getitem__(self, table_name):
+                return FakeMotorCollection(
+                    client, client.delegate[db_name][table_name])
+        return Database()
+
+
+class TestAsyncMongoManager(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        client = mongomock.MongoClient()
+        self.motor = FakeMotorClient(client)
+        self.manager = AsyncMongoManager(
+            client=client, async_client=self.motor,
+            retry_policy=RetryPolicy(base_delay=0.001, max_delay=0.001))
+        self.ts = TelegramStore(self.manager, bot_name="test")
+        self.ts.wait_for_indices()
+        # The awaitable methods must not use the blocking pymongo client.
+        self.manager.client = None
+
+    def _update(self, update_id):
+        user = User(id=TEST_USER_ID, first_name=TEST_USER_NAME, is_bot=False)
+        return Update(update_id=update_id, message=Message(
+            message_id=update_id, date=datetime.now(),
+            chat=Chat(id=TEST_USER_ID, type="private"), text="rice",
+            from_user=user))
+
+    _metadata = TestTelegramStore._metadata
+
+    async def test_round_trip(self):
+        for _ in range(2):
+            await self.ts.insert_update_async(self._update(1))
+            await self.ts.insert_metadata_async(self._metadata(
+                "/start:food:rice:within:0-50", update_id=1))
+        await self.ts.insert_metadata_async(self._metadata("/start", update_id=1))
+
+        self.assertEqual(len(await self.ts.get_updates_async()), 1)
+        self.assertEqual(
+            len(await self.ts.get_metadata_async(TEST_USER_ID)), 2)
+        updates = await self.ts.get_updates_by_metadata_async(TEST_USER_ID)
+        self.assertEqual([u.update_id for u in updates], [1, 1])
+        totals = {"food": 50}
+        self.assertEqual(
+            (await self.ts.get_rollups_async(TEST_USER_ID))["category_totals"],
+            totals)
+        self.assertEqual(
+            (await self.ts.get_metadata_summary_async(TEST_USER_ID))[
+                "category_totals"], totals)
+        self.assertEqual(
+            set(self.motor.calls), {"update_one", "find", "aggregate"})
+
+    async def test_retries_transient_errors(self):
+        self.motor.failures = 2
+        await self.ts.insert_update_async(self._update(1))
+        self.assertEqual(self.manager.stats()["retries"], 2)
+        self.assertEqual(len(await self.ts.get_updates_async()), 1)
+
+    async def test_insert_many_skips_duplicates(self):
+        table = self.ts.metadata_table_name
+        key = TelegramStore.unique_keys[table]
+        batch = [self._metadata("/start", update_id=i) for i in [1, 2, 2, 3]]
+        self.assertEqual(await self.manager.insert_many_async(
+            batch[:2], self.ts.db_name, table, key), 2)
+        self.assertEqual(await self.manager.insert_many_async(
+            [dict(m) for m in batch[1:]], self.ts.db_name, table, key), 1)
+
+        # Time-series collections check for existing records first.
+        self.manager._timeseries.add((self.ts.db_name, table))
+        self.assertFalse(await self.manager.insert_async(
+            self._metadata("/start", update_id=3), self.ts.db_name, table, key))
+        self.assertEqual(await self.manager.insert_many_async(
+            [self._metadata("/start", update_id=i) for i in [3, 4, 4]],
+            self.ts.db_name, table, key), 1)
+        self.assertEqual(
+            len(await self.ts.get_metadata_async(TEST_USER_ID)), 4)
+
+
+class TestWriteBuffer(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        self.manager = MongoManager(client=mongomock.MongoClient())
+        # A long delay so only the size threshold and close() flush.
+        self.buffer = WriteBuffer(self.manager, max_size=3, max_delay=60)
+        self.ts = TelegramStore(
+            self.manager, bot_name="test", write_buffer=self.buffer)
+        self.ts.wait_for_indices()
+
+    def tearDown(self):
+        self.ts.close()
+
+    def _stored(self):
+        return self.manager.find(
+            {}, 0, self.ts.db_name, self.ts.metadata_table_name)
+
+    async def test_reads_see_unflushed_writes(self):
+        for i in range(2):
+            await self.ts.insert_metadata_async(
+                {"update_id": i, "user_id": TEST_USER_ID})
+        self.assertEqual(self._stored(), [])
+        self.assertEqual(len(self.ts.get_metadata(TEST_USER_ID)), 2)
+        self.assertEqual(self.ts.get_metadata(999), [])
+
+    async def test_flush_on_size_and_close(self):
+        for i in range(4):
+            self.ts.insert_metadata({"update_id": i, "user_id": TEST_USER_ID})
+        # The 3rd insert hits max_size, the 4th is still pending.
+        self.assertEqual(len(self._stored()), 3)
+        self.assertEqual(len(self.ts.get_metadata(TEST_USER_ID)), 4)
+
+        self.ts.close()
+        self.assertEqual(len(self._stored()), 4)
+        self.assertEqual(len(self.ts.get_metadata(TEST_USER_ID)), 4)
+
+    async def test_flush_skips_duplicates(self):
+        for update_id in [1, 1, 2]:
+            await self.ts.insert_metadata_async(
+                {"update_id": update_id, "user_id": TEST_USER_ID})
+        self.assertEqual(len(self._stored()), 2)
+
+
+class TestRetryPolicy(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy(
+            tries=3, base_delay=0.001, max_delay=0.001,
+            breaker=CircuitBreaker(failure_threshold=3, reset_timeout=0.05))
+        self.attempts = 0
+
+    def _flaky(self, failures):
+        def fn():
+            self.attempts += 1
+            if self.attempts <= failures:
+                raise errors.AutoReconnect("mongod is down")
+            return "ok"
+        return fn
+
+    def test_retries_transient_errors(self):
+        self.assertEqual(self.policy.call(self._flaky(2)), "ok")
+        self.assertEqual(self.attempts, 3)
+        self.assertEqual(self.policy.stats()["retries"], 2)
+        self.assertEqual(self.policy.stats()["state"], CircuitBreaker.CLOSED)
+
+    async def test_breaker_opens_and_recovers(self):
+        async def down():
+            raise errors.AutoReconnect("mongod is down")
+        with self.assertRaises(errors.AutoReconnect):
+            await self.policy.call_async(down)
+        self.assertEqual(self.policy.stats()["state"], CircuitBreaker.OPEN)
+        # Open: fails fast without calling mongo.
+        self.assertRaises(CircuitOpenError, self.policy.call, self._flaky(0))
+        self.assertEqual(self.attempts, 0)
+
+        await asyncio.sleep(0.06)
+        self.assertEqual(self.policy.stats()["state"], CircuitBreaker.HALF_OPEN)
+        self.assertEqual(self.policy.call(self._flaky(0)), "ok")
+        self.assertEqual(self.policy.stats()["state"], CircuitBreaker.CLOSED)
+
+    def test_deadline(self):
+        policy = RetryPolicy(
+            tries=100, base_delay=0.01, max_delay=0.01, deadline=0.05,
+            breaker=CircuitBreaker(failure_threshold=1000))
+        self.assertRaises(
+            errors.AutoReconnect, policy.call, self._flaky(1000))
+        self.assertLess(self.attempts, 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
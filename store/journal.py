@@ -0,0 +1,298 @@
+"""An append-only, on-disk journal of writes to the database.
+
+Writes are acknowledged as soon as they are appended to the journal file, and
+a background thread replays them into the database in order. If the database
+is down, the writes stay in the journal, and survive a restart of the bot,
+until it comes back.
+"""
+
+import os
+import asyncio
+import logging
+import threading
+from collections import deque
+from bson import ObjectId, json_util
+from typing import Any, Dict, List
+from store.db import DBManager, _matches, _project
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """Journal is a write-ahead log for inserts.
+
+    Every entry is a json line holding one insert, and optionally an update
+    that is applied only if the insert wasn't a duplicate (this is how
+    TelegramStore journals a priced metadata and its rollup). Replay relies
+    on inserts being idempotent on their unique_key, so entries that were
+    replayed right before a crash can safely be replayed again.
+
+    Once the backlog is replayed the file is truncated. While a long backlog
+    is being replayed, the file is rewritten without the replayed entries
+    every compact_size bytes.
+
+    Like WriteBuffer, entries that haven't been replayed can be read back
+    through pending(). Call close() to stop the replayer, it replays what it
+    can before returning.
+
+    With fsync, a write is only acknowledged once it is synced to disk.
+    Writers that wait on a sync together share it (group commit), and
+    add_async waits on it in a worker thread, so that a slow disk doesn't
+    stall the event loop.
+    """
+
+    def __init__(
+            self,
+            db_manager: DBManager,
+            path: str,
+            batch_size: int = 100,
+            retry_delay: float = 1.0,
+            max_retry_delay: float = 30.0,
+            compact_size: int = 64 << 20,
+            fsync: bool = True):
+        self._db_manager = db_manager
+        self.path = path
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.compact_size = compact_size
+        self.fsync = fsync
+
+        # The entries that haven't been replayed, in order, each with the
+        # size of its line in the file.
+        self._backlog = deque()
+        # The bytes at the head of the file that have been replayed.
+        self._replayed = 0
+        # The number of entries appended, and synced to disk, see _sync.
+        self._written = 0
+        self._synced = 0
+        self._lock = threading.Lock()
+        # Held while syncing, and while the file is replaced. Taken before
+        # _lock.
+        self._sync_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._wakeup = threading.Event()
+
+        self._file = open(path, "a+b")
+        self._recover()
+        self._replayer = threading.Thread(target=self._replay_loop, daemon=True)
+        self._replayer.start()
+
+    def add(
+            self,
+            payload: Dict[str, Any],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None,
+            then: tuple = None) -> None:
+        """Appends an insert to the journal, and syncs it to disk.
+
+        The payload is given an _id here so that it can be de-duplicated
+        against the database in TelegramStore reads.
+
+        Args:
+            then: Optional (table_name, filter, changes) of an upsert to apply
+                in db_name after the payload is inserted. It is skipped if
+                the payload turns out to be a duplicate.
+        """
+        written = self._append(payload, db_name, table_name, unique_key, then)
+        if self.fsync:
+            self._sync(written)
+
+    async def add_async(
+            self,
+            payload: Dict[str, Any],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None,
+            then: tuple = None) -> None:
+        """Awaitable version of add, the sync runs in a worker thread."""
+        written = self._append(payload, db_name, table_name, unique_key, then)
+        if self.fsync:
+            await asyncio.to_thread(self._sync, written)
+
+    def _append(
+            self,
+            payload: Dict[str, Any],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str],
+            then: tuple) -> int:
+        """Appends an entry to the file, without syncing it. Returns the
+        number of entries written so far."""
+        payload.setdefault("_id", ObjectId())
+        entry = {
+            "db": db_name,
+            "table": table_name,
+            "payload": payload,
+            "unique_key": unique_key,
+        }
+        if then is not None:
+            entry["then"] = list(then)
+        line = json_util.dumps(entry).encode() + b"\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._backlog.append((entry, len(line)))
+            self._written += 1
+            written = self._written
+        self._wakeup.set()
+        return written
+
+    def _sync(self, written: int) -> None:
+        """Syncs the file to disk, unless the first written entries already
+        are. One sync covers every entry appended before it started."""
+        with self._sync_lock:
+            if self._synced >= written:
+                return
+            with self._lock:
+                file, written = self._file, self._written
+            os.fsync(file.fileno())
+            self._synced = written
+
+    def pending(
+            self,
+            filter: dict,
+            db_name: str,
+            table_name: str,
+            projection: dict = None) -> List[Dict[str, Any]]:
+        """Returns the unreplayed payloads of db_name:table_name matching filter."""
+        with self._lock:
+            return [
+                _project(e["payload"], projection) for e, _ in self._backlog
+                if e["db"] == db_name and e["table"] == table_name and
+                _matches(e["payload"], filter)]
+
+    def depth(self) -> int:
+        """Returns the number of entries waiting to be replayed."""
+        with self._lock:
+            return len(self._backlog)
+
+    def replay(self) -> int:
+        """Replays the backlog into the database, returns the replayed count.
+
+        Stops at, and raises, the first error. The failed entry stays at the
+        head of the backlog.
+        """
+        replayed = 0
+        while True:
+            batch = self._head()
+            if not batch:
+                break
+            self._apply(batch)
+            self._release(batch)
+            replayed += len(batch)
+        self._compact()
+        return replayed
+
+    def close(self) -> None:
+        """Stop the replayer and replay the remainder.
+
+        Entries that can't be replayed stay in the file, and are replayed
+        when the journal is next opened.
+        """
+        self._closed.set()
+        self._wakeup.set()
+        self._replayer.join()
+        try:
+            self.replay()
+        except Exception as e:
+            logger.error(
+                f"Failed to replay the journal, {self.depth()} writes are "
+                f"left in {self.path}: {e}")
+        self._file.close()
+
+    def _recover(self) -> None:
+        """Loads the entries left in the file by a previous run."""
+        self._file.seek(0)
+        for line in self._file:
+            if not line.endswith(b"\n"):
+                # A write torn by a crash, it was never acknowledged.
+                break
+            self._backlog.append((json_util.loads(line), len(line)))
+        self._file.truncate(sum(size for _, size in self._backlog))
+        if self._backlog:
+            logger.info(
+                f"Replaying {len(self._backlog)} journaled writes from {self.path}")
+
+    def _head(self) -> list:
+        """Returns the next entries to replay.
+
+        Consecutive plain inserts into the same table are batched, an entry
+        with a "then" update is replayed on its own.
+        """
+        with self._lock:
+            batch = []
+            for entry, size in self._backlog:
+                if batch and (
+                        "then" in entry or "then" in batch[0][0] or
+                        len(batch) >= self.batch_size or
+                        (entry["db"], entry["table"]) !=
+                        (batch[0][0]["db"], batch[0][0]["table"])):
+                    break
+                batch.append((entry, size))
+            return batch
+
+    def _apply(self, batch: list) -> None:
+        entry = batch[0][0]
+        if len(batch) > 1:
+            self._db_manager.insert_many(
+                [e["payload"] for e, _ in batch],
+                entry["db"], entry["table"], entry["unique_key"])
+            return
+        if not entry.get("inserted"):
+            entry["inserted"] = self._db_manager.insert(
+                entry["payload"], entry["db"], entry["table"], entry["unique_key"])
+        # If the update fails, the retry mustn't mistake the insert for a
+        # duplicate, hence the "inserted" flag on the entry.
+        if entry["inserted"] and "then" in entry:
+            table_name, filter, changes = entry["then"]
+            self._db_manager.update(
+                filter, changes, entry["db"], table_name, upsert=True)
+
+    def _release(self, batch: list) -> None:
+        """Drops replayed entries from the head of the backlog."""
+        with self._lock:
+            for _ in batch:
+                _, size = self._backlog.popleft()
+                self._replayed += size
+
+    def _compact(self) -> None:
+        """Drops the replayed entries from the file."""
+        with self._sync_lock, self._lock:
+            if not self._backlog:
+                self._file.truncate(0)
+                self._replayed = 0
+                return
+            if self._replayed < self.compact_size:
+                return
+            tmp = self.path + ".tmp"
+            with open(tmp, "wb") as f:
+                for entry, _ in self._backlog:
+                    f.write(json_util.dumps(entry).encode() + b"\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self._file.close()
+            self._file = open(self.path, "a+b")
+            self._replayed = 0
+            # The new file was synced as a whole.
+            self._synced = self._written
+
+    def _replay_loop(self) -> None:
+        delay = self.retry_delay
+        while True:
+            self._wakeup.wait(self.retry_delay)
+            self._wakeup.clear()
+            if self._closed.is_set():
+                return
+            try:
+                self.replay()
+                delay = self.retry_delay
+            except Exception as e:
+                logger.error(
+                    f"Failed to replay the journal, {self.depth()} writes are "
+                    f"waiting, retrying in {delay}s: {e}")
+                # New writes don't cut the backoff short, only close() does.
+                self._closed.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
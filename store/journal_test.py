@@ -0,0 +1,154 @@
+import os
+import time
+import asyncio
+import tempfile
+import unittest
+import mongomock
+from datetime import datetime
+from unittest import mock
+from pymongo import errors
+from store.db import MongoManager, TelegramStore
+from store.journal import Journal
+
+TEST_USER_ID = 123
+
+
+class FlakyMongoManager(MongoManager):
+    """A MongoManager whose writes fail while down is set."""
+
+    down = False
+
+    def insert(self, *args, **kwargs):
+        if self.down:
+            raise errors.AutoReconnect("mongod is down")
+        return super().insert(*args, **kwargs)
+
+    def insert_many(self, *args, **kwargs):
+        if self.down:
+            raise errors.AutoReconnect("mongod is down")
+        return super().insert_many(*args, **kwargs)
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "journal")
+        self.manager = FlakyMongoManager(client=mongomock.MongoClient())
+        # A long retry delay so that only replay() and close() replay.
+        self.journal = Journal(self.manager, self.path, retry_delay=60)
+        self.ts = TelegramStore(
+            self.manager, bot_name="test", journal=self.journal)
+        self.ts.wait_for_indices()
+
+    def tearDown(self):
+        self.manager.down = False
+        self.ts.close()
+        self.dir.cleanup()
+
+    def _metadata(self, update_id, price=None):
+        metadata = {
+            "update_id": update_id,
+            "selection_path": f"{TEST_USER_ID}:/start:food:rice",
+            "timestamp": datetime.now(),
+            "user_id": TEST_USER_ID,
+            "user_name": "ram",
+        }
+        if price is not None:
+            metadata.update(
+                {"category": "food", "subcategory": "rice", "price_high": price})
+        return metadata
+
+    def _stored(self):
+        return self.manager.find(
+            {}, 0, self.ts.db_name, self.ts.metadata_table_name)
+
+    def test_writes_survive_an_outage(self):
+        self.manager.down = True
+        for i in range(3):
+            self.ts.insert_metadata(self._metadata(i))
+        self.assertRaises(errors.AutoReconnect, self.journal.replay)
+        self.assertEqual(self.ts.journal_depth(), 3)
+        self.assertEqual(self._stored(), [])
+        # Reads see the journaled writes.
+        self.assertEqual(len(self.ts.get_metadata(TEST_USER_ID)), 3)
+
+        self.manager.down = False
+        self.assertEqual(self.journal.replay(), 3)
+        self.assertEqual(self.ts.journal_depth(), 0)
+        self.assertEqual(len(self._stored()), 3)
+        self.assertEqual(len(self.ts.get_metadata(TEST_USER_ID)), 3)
+        # The replayed journal is compacted.
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_recovers_after_restart(self):
+        self.manager.down = True
+        self.ts.insert_metadata(self._metadata(1, price=50))
+        self.ts.insert_metadata(self._metadata(1, price=50))
+        self.journal.close()
+
+        self.manager.down = False
+        self.journal = Journal(self.manager, self.path, retry_delay=60)
+        self.ts._journal = self.journal
+        self.assertEqual(self.journal.depth(), 2)
+        self.journal.replay()
+        self.assertEqual(len(self._stored()), 1)
+        # The duplicate isn't added to the rollups.
+        self.assertEqual(
+            self.ts.get_rollups(TEST_USER_ID)["category_totals"], {"food": 50})
+
+    def test_ignores_torn_writes(self):
+        self.manager.down = True
+        self.ts.insert_metadata(self._metadata(1))
+        self.journal.close()
+        with open(self.path, "ab") as f:
+            f.write(b'{"db": "test_telegram_bot", "tab')
+
+        self.journal = Journal(self.manager, self.path, retry_delay=60)
+        self.ts._journal = self.journal
+        self.assertEqual(self.journal.depth(), 1)
+        self.manager.down = False
+        self.journal.replay()
+        self.assertEqual(len(self._stored()), 1)
+
+    def test_syncs_off_the_event_loop(self):
+        fsyncs = []
+
+        def slow_fsync(fd):
+            fsyncs.append(fd)
+            time.sleep(0.2)
+
+        async def run():
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    ticks += 1
+                    await asyncio.sleep(0.01)
+
+            ticker = asyncio.create_task(tick())
+            await asyncio.gather(*(
+                self.ts.insert_metadata_async(self._metadata(i, price=10))
+                for i in range(10)))
+            ticker.cancel()
+            return ticks
+
+        self.manager.down = True
+        with mock.patch("store.journal.os.fsync", slow_fsync):
+            ticks = asyncio.run(run())
+        # The loop kept running while the journal synced, and the writes
+        # waiting on a sync shared the next one.
+        self.assertGreater(ticks, 10)
+        self.assertLessEqual(len(fsyncs), 2)
+        self.assertEqual(self.ts.journal_depth(), 10)
+        self.manager.down = False
+        self.journal.replay()
+        self.assertEqual(
+            self.ts.get_rollups(TEST_USER_ID)["category_totals"], {"food": 100})
+
+
+if __name__ == '__main__':
+    unittest.main()
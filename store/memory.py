@@ -0,0 +1,314 @@
+"""An indexed, in-memory backend for tests and benchmarks.
+
+mongomock scans every document on every query, which is fine for unit tests
+but not for benchmarks that load realistic volumes. MemoryManager keeps the
+indices declared in TelegramStore.index_specs as hash maps, and the last key
+of every compound index as a sorted list, so that a lookup by user, update
+id or (user, time range) doesn't scan.
+
+Usage:
+    TelegramStore(MemoryManager())
+"""
+
+import threading
+from bisect import bisect_left, bisect_right, insort
+from itertools import count, product
+from bson import ObjectId
+from typing import Any, Dict, Iterator, List
+from store.db import (
+    DBManager, _apply_update, _get_field, _matches, _project, _upsert_base)
+
+# Sorts after every (key, seq, _id) entry with the same key.
+_LAST = float("inf")
+_RANGES = {"$gt", "$gte", "$lt", "$lte"}
+
+
+def _sort_key(value: Any) -> tuple:
+    """Orders None, ie a missing field, after every value."""
+    return (value is None, value)
+
+
+def _point_values(filter: dict, key: str) -> list | None:
+    """Returns the values key must equal to match filter, if it's a point
+    query (equality or $in), otherwise None."""
+    condition = filter.get(key)
+    if condition is None:
+        return None
+    if not isinstance(condition, dict):
+        return [condition]
+    if set(condition) == {"$in"} and None not in condition["$in"]:
+        return list(dict.fromkeys(condition["$in"]))
+    return None
+
+
+class _Index:
+    """_Index is a hash index on all of keys.
+
+    A compound index also maps the values of all but the last key to a list
+    of (last key, insertion seq, _id), sorted on the last key. This serves
+    equality on the prefix, eg user_id, with an optional range on the last
+    key, eg timestamp, in order.
+    """
+
+    def __init__(self, spec: Dict[str, Any]):
+        self.spec = spec
+        self.keys = [k for k, _ in spec["keys"]]
+        self.unique = spec.get("options", {}).get("unique", False)
+        # tuple of values -> {_id: None}, an insertion ordered set.
+        self.hash = {}
+        self.prefix = {} if len(self.keys) > 1 else None
+
+    def values(self, doc: Dict[str, Any]) -> tuple:
+        return tuple(_get_field(doc, k) for k in self.keys)
+
+    def add(self, doc: Dict[str, Any], seq: int) -> None:
+        values = self.values(doc)
+        self.hash.setdefault(values, {})[doc["_id"]] = None
+        if self.prefix is not None:
+            insort(self.prefix.setdefault(values[:-1], []),
+                   (_sort_key(values[-1]), seq, doc["_id"]))
+
+    def remove(self, doc: Dict[str, Any], seq: int) -> None:
+        values = self.values(doc)
+        ids = self.hash[values]
+        del ids[doc["_id"]]
+        if not ids:
+            del self.hash[values]
+        if self.prefix is not None:
+            entries = self.prefix[values[:-1]]
+            entries.pop(bisect_left(
+                entries, (_sort_key(values[-1]), seq, doc["_id"])))
+            if not entries:
+                del self.prefix[values[:-1]]
+
+    def lookup(self, filter: dict) -> tuple[List[Any], List[str]] | None:
+        """Returns the _ids that may match filter, and the keys of filter the
+        index fully evaluated. Returns None if the index can't serve filter.
+        """
+        conditions = [_point_values(filter, k) for k in self.keys]
+        if None not in conditions:
+            return [_id for values in product(*conditions)
+                    for _id in self.hash.get(values, ())], self.keys
+        if self.prefix is None or None in conditions[:-1]:
+            return None
+        last = filter.get(self.keys[-1])
+        served = self.keys
+        if last is None:
+            served = self.keys[:-1]
+        elif not isinstance(last, dict) or not set(last) <= _RANGES:
+            # Eg a $regex, it is evaluated on the prefix's entries.
+            last, served = None, self.keys[:-1]
+        ids = []
+        for prefix in product(*conditions[:-1]):
+            entries = self.prefix.get(prefix, [])
+            lo, hi = 0, len(entries)
+            if last is not None:
+                if "$gte" in last:
+                    lo = bisect_left(entries, (_sort_key(last["$gte"]),))
+                if "$gt" in last:
+                    lo = bisect_right(entries, (_sort_key(last["$gt"]), _LAST))
+                if "$lte" in last:
+                    hi = bisect_right(entries, (_sort_key(last["$lte"]), _LAST))
+                if "$lt" in last:
+                    hi = bisect_left(entries, (_sort_key(last["$lt"]),))
+            ids.extend(_id for _, _, _id in entries[lo:hi])
+        return ids, served
+
+
+class _Table:
+
+    def __init__(self):
+        # _id -> (insertion seq, doc), in insertion order.
+        self.docs = {}
+        self.indices = {}
+        self.seq = count()
+
+    def lookup(self, filter: dict) -> tuple[List[Any], List[str]] | None:
+        """Returns candidate _ids from the most selective usable index, and
+        the keys of filter it evaluated. None means a scan."""
+        best = None
+        for index in self.indices.values():
+            found = index.lookup(filter)
+            if found is not None and (best is None or len(found[0]) < len(best[0])):
+                best = found
+        return best
+
+    def find(self, filter: dict) -> Iterator[Dict[str, Any]]:
+        found = self.lookup(filter)
+        if found is None:
+            docs = (doc for _, doc in self.docs.values())
+        else:
+            ids, served = found
+            docs = (self.docs[_id][1] for _id in ids)
+            filter = {k: v for k, v in filter.items() if k not in served}
+            if not filter:
+                return docs
+        return (doc for doc in docs if _matches(doc, filter))
+
+    def duplicate(self, doc: Dict[str, Any], unique_key: List[str]) -> bool:
+        """Returns true if doc collides with a stored doc."""
+        if doc["_id"] in self.docs:
+            return True
+        for index in self.indices.values():
+            if index.unique and index.values(doc) in index.hash:
+                return True
+        if unique_key and not any(
+                index.unique and index.keys == unique_key
+                for index in self.indices.values()):
+            for _ in self.find({k: doc.get(k) for k in unique_key}):
+                return True
+        return False
+
+    def add(self, doc: Dict[str, Any]) -> None:
+        seq = next(self.seq)
+        self.docs[doc["_id"]] = (seq, doc)
+        for index in self.indices.values():
+            index.add(doc, seq)
+
+    def replace(self, doc: Dict[str, Any], new: Dict[str, Any]) -> None:
+        seq, _ = self.docs[doc["_id"]]
+        for index in self.indices.values():
+            index.remove(doc, seq)
+            index.add(new, seq)
+        self.docs[doc["_id"]] = (seq, new)
+
+    def remove(self, doc: Dict[str, Any]) -> None:
+        seq, _ = self.docs.pop(doc["_id"])
+        for index in self.indices.values():
+            index.remove(doc, seq)
+
+
+class MemoryManager(DBManager):
+    """MemoryManager keeps every collection in memory, with real indices.
+
+    Queries use the indices created by sync_indices, see _Index, and fall
+    back to a scan. Stored documents are shallow copies of the payloads, and
+    reads return shallow copies, so callers can't change stored fields.
+    Everything is lost when the process exits.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # (db_name, table_name) -> _Table
+        self._tables = {}
+
+    def _table(self, db_name: str, table_name: str) -> _Table:
+        return self._tables.setdefault((db_name, table_name), _Table())
+
+    def insert(
+            self,
+            payload: Dict[str, Any],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None) -> bool:
+        payload.setdefault("_id", ObjectId())
+        with self._lock:
+            table = self._table(db_name, table_name)
+            if table.duplicate(payload, unique_key):
+                return False
+            table.add(dict(payload))
+            return True
+
+    def insert_many(
+            self,
+            payloads: List[Dict[str, Any]],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None) -> int:
+        with self._lock:
+            return sum(self.insert(payload, db_name, table_name, unique_key)
+                       for payload in payloads)
+
+    def find(
+            self,
+            filter: dict,
+            limit: int,
+            db_name: str,
+            table_name: str,
+            projection: dict = None) -> list[Dict[str, Any]]:
+        with self._lock:
+            found = []
+            for doc in self._table(db_name, table_name).find(filter):
+                found.append(_project(dict(doc), projection))
+                if len(found) == limit:
+                    break
+            return found
+
+    def iter_find(
+            self,
+            filter: dict,
+            db_name: str,
+            table_name: str,
+            batch_size: int = 100,
+            sort: list = None,
+            projection: dict = None) -> Iterator[Dict[str, Any]]:
+        records = self.find(filter, 0, db_name, table_name)
+        for key, direction in reversed(sort or []):
+            records.sort(key=lambda r: _sort_key(_get_field(r, key)),
+                         reverse=direction < 0)
+        return (_project(r, projection) for r in records)
+
+    def update(
+            self,
+            filter: dict,
+            changes: dict,
+            db_name: str,
+            table_name: str,
+            upsert: bool = False) -> None:
+        with self._lock:
+            table = self._table(db_name, table_name)
+            for doc in table.find(filter):
+                # Copy, so the indices can still find the old values.
+                new = _apply_update(
+                    {k: (dict(v) if isinstance(v, dict) else v)
+                     for k, v in doc.items()}, changes, False)
+                table.replace(doc, new)
+                return
+            if upsert:
+                new = _apply_update(_upsert_base(filter), changes, True)
+                new.setdefault("_id", ObjectId())
+                table.add(new)
+
+    def delete(self, filter: dict, db_name: str, table_name: str) -> int:
+        with self._lock:
+            table = self._table(db_name, table_name)
+            docs = list(table.find(filter))
+            for doc in docs:
+                table.remove(doc)
+            return len(docs)
+
+    def sync_indices(
+            self,
+            db_name: str,
+            table_name: str,
+            indices: list,
+            droppable: List[str] = None) -> None:
+        """sync_indices rebuilds the indices whose spec changed."""
+        with self._lock:
+            table = self._table(db_name, table_name)
+            declared = {spec["name"]: spec for spec in indices}
+            for name in list(table.indices):
+                if (name not in declared and droppable is not None
+                        and name not in droppable):
+                    continue
+                if table.indices[name].spec != declared.get(name):
+                    del table.indices[name]
+            for name, spec in declared.items():
+                if name in table.indices:
+                    continue
+                index = _Index(spec)
+                for seq, doc in table.docs.values():
+                    index.add(doc, seq)
+                table.indices[name] = index
+
+    def _delete_all(self, db_name: str, table_name: str) -> None:
+        with self._lock:
+            table = self._table(db_name, table_name)
+            indices = [index.spec for index in table.indices.values()]
+            del self._tables[(db_name, table_name)]
+            self.sync_indices(db_name, table_name, indices)
+
+    def _drop_database(self, db_name: str) -> None:
+        with self._lock:
+            for key in [k for k in self._tables if k[0] == db_name]:
+                del self._tables[key]
@@ -0,0 +1,138 @@
+import unittest
+from datetime import datetime, timedelta
+from pymongo import DESCENDING
+from store.db import TelegramStore
+from store.memory import MemoryManager
+
+TEST_USER_ID = 123
+
+
+class TestMemoryManager(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        self.manager = MemoryManager()
+        self.ts = TelegramStore(self.manager, bot_name="test")
+        self.ts.wait_for_indices()
+        self.start = datetime(2024, 1, 1)
+
+    def _metadata(self, update_id, user_id=TEST_USER_ID, price=None):
+        metadata = {
+            "update_id": update_id,
+            "selection_path": f"{user_id}:/start:food:rice",
+            "timestamp": self.start + timedelta(hours=update_id),
+            "user_id": user_id,
+            "user_name": "ram",
+        }
+        if price is not None:
+            metadata.update(
+                {"category": "food", "subcategory": "rice", "price_high": price})
+        return metadata
+
+    def _find(self, filter, limit=0):
+        return self.manager.find(
+            filter, limit, self.ts.db_name, self.ts.metadata_table_name)
+
+    async def test_metadata_and_rollups(self):
+        for i in range(3):
+            await self.ts.insert_metadata_async(self._metadata(i, price=50))
+        await self.ts.insert_metadata_async(self._metadata(1, price=50))
+        await self.ts.insert_metadata_async(self._metadata(9, user_id=999))
+
+        self.assertEqual(len(await self.ts.get_metadata_async(TEST_USER_ID)), 3)
+        rollups = self.ts.get_rollups(TEST_USER_ID)
+        self.assertEqual(rollups["category_totals"], {"food": 150})
+        self.assertEqual(rollups["end"], self.start + timedelta(hours=2))
+
+    def test_index_lookups(self):
+        self.manager.insert_many(
+            [self._metadata(i, user_id=i % 3) for i in range(30)],
+            self.ts.db_name, self.ts.metadata_table_name)
+        table = self.manager._table(
+            self.ts.db_name, self.ts.metadata_table_name)
+
+        # Equality on the prefix of (user_id, timestamp), in time order.
+        ids, _ = table.lookup({"user_id": 1})
+        self.assertEqual(len(ids), 10)
+        found = self._find({"user_id": 1})
+        self.assertEqual(
+            [m["update_id"] for m in found], list(range(1, 30, 3)))
+
+        # A time range on the last key.
+        found = self._find({
+            "user_id": 1,
+            "timestamp": {"$gte": self.start + timedelta(hours=4),
+                          "$lt": self.start + timedelta(hours=13)}})
+        self.assertEqual([m["update_id"] for m in found], [4, 7, 10])
+        found = self._find({
+            "user_id": 1,
+            "timestamp": {"$gt": self.start + timedelta(hours=4),
+                          "$lte": self.start + timedelta(hours=13)}})
+        self.assertEqual([m["update_id"] for m in found], [7, 10, 13])
+
+        # $in on the prefix of (update_id, selection_path).
+        ids, served = table.lookup({"update_id": {"$in": [1, 2, 2]}})
+        self.assertEqual((len(ids), served), (2, ["update_id"]))
+        self.assertEqual(len(self._find({"update_id": {"$in": [1, 2]}})), 2)
+        self.assertEqual(len(self._find({"user_id": 2}, limit=4)), 4)
+
+    def test_update_reindexes(self):
+        self.manager.insert(
+            self._metadata(1), self.ts.db_name, self.ts.metadata_table_name)
+        self.manager.update(
+            {"update_id": 1}, {"$set": {"user_id": 7}},
+            self.ts.db_name, self.ts.metadata_table_name)
+        self.assertEqual(self._find({"user_id": TEST_USER_ID}), [])
+        self.assertEqual(len(self._find({"user_id": 7})), 1)
+
+    def test_iter_find_sorts(self):
+        self.manager.insert_many(
+            [self._metadata(i) for i in range(5)],
+            self.ts.db_name, self.ts.metadata_table_name)
+        found = self.manager.iter_find(
+            {"user_id": TEST_USER_ID}, self.ts.db_name,
+            self.ts.metadata_table_name, sort=[("timestamp", DESCENDING)],
+            projection={"update_id": 1})
+        self.assertEqual([m["update_id"] for m in found], [4, 3, 2, 1, 0])
+
+
+class TestTimeseriesMetadata(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        self.manager = MemoryManager()
+        self.ts = TelegramStore(
+            self.manager, bot_name="test", timeseries_metadata=True)
+        self.ts.wait_for_indices()
+
+    async def test_metadata_is_queried_by_meta(self):
+        metadata = {
+            "update_id": 1,
+            "selection_path": f"{TEST_USER_ID}:/start:food:rice:within:50",
+            "timestamp": datetime(2024, 1, 1),
+            "user_id": TEST_USER_ID,
+            "category": "food",
+            "subcategory": "rice",
+            "price_high": 50,
+        }
+        await self.ts.insert_metadata_async(dict(metadata))
+        await self.ts.insert_metadata_async(dict(metadata))
+
+        found = await self.ts.get_metadata_async(TEST_USER_ID)
+        self.assertEqual(len(found), 1)
+        self.assertEqual(
+            found[0]["meta"], {"user_id": TEST_USER_ID, "category": "food"})
+        table = self.manager._table(
+            self.ts.db_name, self.ts.metadata_table_name)
+        self.assertIn("meta_user_id_timestamp", table.indices)
+        self.assertEqual(
+            table.lookup({"meta.user_id": TEST_USER_ID})[1],
+            ["meta.user_id"])
+        self.assertEqual(
+            self.ts.get_rollups(TEST_USER_ID)["category_totals"], {"food": 50})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+"""Persists context.user_data in the TelegramStore.
+
+The handlers keep a user's state, eg Lipok's selection path, in
+context.user_data, which python-telegram-bot keeps in memory. With
+StorePersistence the state survives restarts, and a user's state can be
+picked up by another process.
+
+Usage:
+    app = Application.builder().token(api_key).persistence(
+        StorePersistence(update_interval=5)).build()
+"""
+
+from copy import deepcopy
+from typing import Any, Dict, Optional
+from telegram.ext import BasePersistence, PersistenceInput
+from store.db import TelegramStore
+
+
+class StorePersistence(BasePersistence):
+    """StorePersistence stores every user's user_data as one document of the
+    user_data collection, see TelegramStore.update_user_data_async.
+
+    Writes are coalesced: the application hands over the user_data of the
+    users whose updates were handled every update_interval seconds, so a
+    user's rapid button presses cost one write per interval. Users whose
+    user_data didn't change since it was last written are skipped.
+
+    Reads are lazy: nothing is loaded at startup, a user's user_data is
+    loaded before the handlers run for the user's first update. After that
+    this process' copy is authoritative, so a user's updates should be
+    handled by one process at a time.
+
+    chat_data, bot_data, callback data and conversations aren't persisted.
+    """
+
+    def __init__(
+            self,
+            update_interval: float = 5,
+            store: Optional[TelegramStore] = None):
+        """
+        Args:
+            update_interval: seconds between the writes of a user's changes.
+            store: the store to persist to, the TelegramStore singleton by
+                default. The store is resolved on first use, so this can be
+                created before the store is set up.
+        """
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=True,
+                callback_data=False),
+            update_interval=update_interval)
+        self._store = store
+        # user_id -> the user_data as last loaded or written.
+        self._persisted: Dict[int, Dict[str, Any]] = {}
+
+    @property
+    def store(self) -> TelegramStore:
+        return self._store or TelegramStore()
+
+    @store.setter
+    def store(self, store: TelegramStore) -> None:
+        self._store = store
+
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        # Users are loaded lazily, see refresh_user_data.
+        return {}
+
+    async def refresh_user_data(
+            self, user_id: int, user_data: Dict[str, Any]) -> None:
+        if user_id in self._persisted:
+            return
+        data = await self.store.get_user_data_async(user_id)
+        self._persisted[user_id] = deepcopy(data)
+        user_data.update(data)
+
+    async def update_user_data(
+            self, user_id: int, data: Dict[str, Any]) -> None:
+        # data is already a copy, see Application.update_persistence.
+        if self._persisted.get(user_id) == data:
+            return
+        await self.store.update_user_data_async(user_id, data)
+        self._persisted[user_id] = data
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self.update_user_data(user_id, {})
+
+    async def flush(self) -> None:
+        # Every change is written by update_user_data, the application
+        # calls it one last time on shutdown.
+        pass
+
+    # Only user_data is persisted.
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Any:
+        return {}
+
+    async def get_callback_data(self) -> Any:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def update_bot_data(self, data: Any) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
@@ -0,0 +1,77 @@
+import unittest
+from store.db import TelegramStore
+from store.memory import MemoryManager
+from store.persistence import StorePersistence
+
+
+class CountingManager(MemoryManager):
+    """A MemoryManager that counts the writes and reads of user_data."""
+
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+        self.reads = 0
+
+    def update(self, filter, changes, db_name, table_name, upsert=False):
+        if table_name == TelegramStore.user_data_table_name:
+            self.writes += 1
+        return super().update(filter, changes, db_name, table_name, upsert)
+
+    def find(self, filter, limit, db_name, table_name, projection=None):
+        if table_name == TelegramStore.user_data_table_name:
+            self.reads += 1
+        return super().find(filter, limit, db_name, table_name, projection)
+
+
+class TestStorePersistence(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        self.manager = CountingManager()
+        self.ts = TelegramStore(self.manager, bot_name="test")
+        self.ts.wait_for_indices()
+
+    async def test_lazy_load(self):
+        p = StorePersistence()
+        await self.ts.update_user_data_async(1, {"state": "awaiting_custom_price"})
+        self.assertEqual(await p.get_user_data(), {})
+        self.assertEqual(self.manager.reads, 0)
+
+        user_data = {}
+        await p.refresh_user_data(1, user_data)
+        self.assertEqual(user_data, {"state": "awaiting_custom_price"})
+        # The user is only loaded on their first update.
+        user_data["state"] = "done"
+        await p.refresh_user_data(1, user_data)
+        self.assertEqual(user_data, {"state": "done"})
+        self.assertEqual(self.manager.reads, 1)
+
+        # Unknown users start out empty.
+        user_data = {}
+        await p.refresh_user_data(2, user_data)
+        self.assertEqual(user_data, {})
+
+    async def test_coalesced_writes(self):
+        p = StorePersistence()
+        user_data = {}
+        await p.refresh_user_data(1, user_data)
+        for path in ["/start", "/start:food", "/start:food:rice"]:
+            user_data["t4g_selection_path"] = path
+        await p.update_user_data(1, dict(user_data))
+        # Handled updates that didn't change the user_data aren't written.
+        await p.update_user_data(1, dict(user_data))
+        self.assertEqual(self.manager.writes, 1)
+
+        # After a restart, the last written state is loaded.
+        restarted = StorePersistence()
+        user_data = {}
+        await restarted.refresh_user_data(1, user_data)
+        self.assertEqual(user_data, {"t4g_selection_path": "/start:food:rice"})
+
+        await restarted.drop_user_data(1)
+        self.assertEqual(await self.ts.get_user_data_async(1), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,434 @@
+"""An embedded SQLite backend for the store.
+
+Small deployments only store a few thousand rows per survey, so running a
+mongod next to the bot is overkill. SQLiteManager keeps every collection in
+a single SQLite file instead.
+
+Usage:
+    TelegramStore(SQLiteManager("/var/lib/count/billa.sqlite3"))
+"""
+
+import re
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timezone
+from bson import ObjectId, json_util
+from typing import Any, Dict, Iterator, List
+from store.db import (
+    DBManager, _apply_update, _project, _upsert_base)
+
+logger = logging.getLogger(__name__)
+
+
+def _regexp(pattern: str, value: Any) -> bool:
+    return isinstance(value, str) and re.search(pattern, value) is not None
+
+
+def _path(key: str) -> str:
+    """Returns the SQL expression of a dotted key, eg "message.from.id".
+
+    Indices are on these expressions, and SQLite only uses an expression
+    index if the query spells the expression the same way, so every query
+    must build it here.
+    """
+    if key == "_id":
+        return "_id"
+    labels = ".".join(f'"{part}"' for part in key.split("."))
+    return f"json_extract(doc, '$.{labels}')"
+
+
+def _date(value: datetime) -> str:
+    """Returns value as a fixed width ISO string in UTC, with milliseconds,
+    eg "2024-01-01T00:00:05.000Z". Unlike the strings of json_util, these
+    compare in the same order as the dates. Naive dates are in UTC."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return (f"{value.year:04d}-{value:%m-%dT%H:%M:%S}."
+            f"{value.microsecond // 1000:03d}Z")
+
+
+def _dates(value: Any) -> Any:
+    """Replaces every date in value with its extended json form, see _date."""
+    if isinstance(value, datetime):
+        return {"$date": _date(value)}
+    if isinstance(value, dict):
+        return {k: _dates(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_dates(v) for v in value]
+    return value
+
+
+def _param(key: str, value: Any) -> Any:
+    """Returns value as json_extract returns it for a document.
+
+    Dates and ObjectIds are stored in their extended json form, with dates
+    as fixed width strings (see _date), which compares in the same order as
+    the values themselves.
+    """
+    if key == "_id":
+        return str(value)
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (datetime, ObjectId, dict, list)):
+        return json.dumps(json.loads(_encode(value)), separators=(",", ":"))
+    return value
+
+
+def _where(filter: dict) -> tuple[str, list]:
+    """Compiles a mongo style filter to a WHERE clause and its parameters.
+
+    Like store.db._matches, this only supports the filter shapes
+    TelegramStore uses: equality on (dotted) keys and the $regex, $in,
+    $exists and range operators.
+    """
+    clauses, params = [], []
+    for key, condition in filter.items():
+        expr = _path(key)
+        if not isinstance(condition, dict):
+            clauses.append(f"{expr} IS ?")
+            params.append(_param(key, condition))
+            continue
+        for op, arg in condition.items():
+            if op == "$regex":
+                clauses.append(f"{expr} REGEXP ?")
+                params.append(arg)
+            elif op == "$in":
+                values = [v for v in arg if v is not None]
+                ors = []
+                if values:
+                    ors.append(f"{expr} IN ({', '.join('?' * len(values))})")
+                    params.extend(_param(key, v) for v in values)
+                if len(values) < len(arg):
+                    ors.append(f"{expr} IS NULL")
+                clauses.append(f"({' OR '.join(ors) or '0'})")
+            elif op == "$exists":
+                clauses.append(f"{expr} IS {'NOT ' if arg else ''}NULL")
+            elif op in ("$gt", "$gte", "$lt", "$lte"):
+                sign = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}[op]
+                clauses.append(f"{expr} {sign} ?")
+                params.append(_param(key, arg))
+            else:
+                raise ValueError(f"Unsupported filter operator {op}")
+    return " AND ".join(clauses) or "1", params
+
+
+def _encode(doc: Dict[str, Any]) -> str:
+    return json_util.dumps(_dates(doc))
+
+
+def _decode(doc: str) -> Dict[str, Any]:
+    return json_util.loads(doc)
+
+
+class SQLiteManager(DBManager):
+    """SQLiteManager stores every collection as a table in one SQLite file.
+
+    Every table has an _id primary key and the document as json, queries and
+    indices go through json_extract. Collection db_name:table_name is the
+    table "db_name.table_name".
+
+    The file is in WAL mode, so reads don't wait on writes. Writes go through
+    a single connection, one transaction per insert or update, and one per
+    batch in insert_many (use a WriteBuffer to batch inserts). With
+    synchronous=NORMAL a committed write survives a crash of the bot, but
+    not necessarily a power loss. Reads use a connection per thread.
+
+    With path ":memory:" the db only lives in the writer connection, so
+    reads go through it too, under the write lock.
+    """
+
+    # The version of the document encoding, kept in PRAGMA user_version.
+    # Before version 1 dates were stored as json_util strings, which drop
+    # the milliseconds of whole seconds, see _date.
+    encoding_version = 1
+
+    def __init__(self, path: str = "count.sqlite3", busy_timeout: float = 5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.in_memory = path == ":memory:"
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._readers = threading.local()
+        self._tables = set()
+        self._upgrade()
+
+    def _upgrade(self) -> None:
+        """Re-encodes the documents of a file written by an older version,
+        see encoding_version."""
+        version, = self._writer.execute("PRAGMA user_version").fetchone()
+        if version >= self.encoding_version:
+            return
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                tables = [name for name, in self._writer.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' "
+                    "AND name NOT LIKE 'sqlite_%'").fetchall()]
+                for name in tables:
+                    logger.info(f"Re-encoding the dates of {name}")
+                    rows = self._writer.execute(
+                        f'SELECT _id, doc FROM "{name}"').fetchall()
+                    for _id, doc in rows:
+                        encoded = _encode(_decode(doc))
+                        if encoded != doc:
+                            self._writer.execute(
+                                f'UPDATE "{name}" SET doc = ? WHERE _id = ?',
+                                (encoded, _id))
+                self._writer.execute(
+                    f"PRAGMA user_version = {self.encoding_version}")
+            except Exception:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit, the writes BEGIN and COMMIT their transactions.
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            isolation_level=None,
+            check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.create_function("regexp", 2, _regexp, deterministic=True)
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._readers, "conn", None)
+        if conn is None:
+            conn = self._readers.conn = self._connect()
+        return conn
+
+    def _read(self, sql: str, params: list) -> list:
+        """Returns the rows of a query, see in_memory."""
+        if self.in_memory:
+            with self._write_lock:
+                return self._writer.execute(sql, params).fetchall()
+        return self._reader().execute(sql, params).fetchall()
+
+    @staticmethod
+    def _table(db_name: str, table_name: str) -> str:
+        return f'"{db_name}.{table_name}"'
+
+    def _ensure_table(self, db_name: str, table_name: str) -> str:
+        """Creates the table on first use, like mongo creates collections."""
+        table = self._table(db_name, table_name)
+        if table not in self._tables:
+            with self._write_lock:
+                self._writer.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} "
+                    "(_id TEXT PRIMARY KEY, doc TEXT NOT NULL)")
+            self._tables.add(table)
+        return table
+
+    def _insert_row(
+            self,
+            table: str,
+            payload: Dict[str, Any],
+            unique_key: List[str]) -> bool:
+        """Inserts payload, the caller holds the write lock."""
+        payload.setdefault("_id", ObjectId())
+        if unique_key:
+            where, params = _where({k: payload.get(k) for k in unique_key})
+            if self._writer.execute(
+                    f"SELECT 1 FROM {table} WHERE {where} LIMIT 1",
+                    params).fetchone():
+                return False
+        cursor = self._writer.execute(
+            f"INSERT OR IGNORE INTO {table} (_id, doc) VALUES (?, ?)",
+            (str(payload["_id"]), _encode(payload)))
+        return cursor.rowcount == 1
+
+    def insert(
+            self,
+            payload: Dict[str, Any],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None) -> bool:
+        """insert adds the payload to the table, see DBManager.insert.
+
+        Duplicates are detected with a lookup on unique_key, which is served
+        by the unique indices in TelegramStore.index_specs.
+        """
+        table = self._ensure_table(db_name, table_name)
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                inserted = self._insert_row(table, payload, unique_key)
+            except Exception:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+        return inserted
+
+    def insert_many(
+            self,
+            payloads: List[Dict[str, Any]],
+            db_name: str,
+            table_name: str,
+            unique_key: List[str] = None) -> int:
+        """insert_many inserts the batch in a single transaction."""
+        table = self._ensure_table(db_name, table_name)
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                inserted = sum(self._insert_row(table, payload, unique_key)
+                               for payload in payloads)
+            except Exception:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+        return inserted
+
+    def find(
+            self,
+            filter: dict,
+            limit: int,
+            db_name: str,
+            table_name: str,
+            projection: dict = None) -> list[Dict[str, Any]]:
+        table = self._ensure_table(db_name, table_name)
+        where, params = _where(filter)
+        rows = self._read(
+            f"SELECT doc FROM {table} WHERE {where} LIMIT ?",
+            params + [limit if limit > 0 else -1])
+        return [_project(_decode(doc), projection) for doc, in rows]
+
+    def iter_find(
+            self,
+            filter: dict,
+            db_name: str,
+            table_name: str,
+            batch_size: int = 100,
+            sort: list = None,
+            projection: dict = None) -> Iterator[Dict[str, Any]]:
+        """iter_find streams records, batch_size rows at a time.
+
+        The rows are read through a dedicated connection, so the generator
+        can be consumed from any thread. In memory, the rows are read at
+        once.
+        """
+        table = self._ensure_table(db_name, table_name)
+        where, params = _where(filter)
+        order = ""
+        if sort:
+            order = " ORDER BY " + ", ".join(
+                f"{_path(k)} {'DESC' if d < 0 else 'ASC'}" for k, d in sort)
+
+        sql = f"SELECT doc FROM {table} WHERE {where}{order}"
+        if self.in_memory:
+            return (_project(_decode(doc), projection)
+                    for doc, in self._read(sql, params))
+
+        def _iter():
+            conn = self._connect()
+            try:
+                cursor = conn.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        return
+                    for doc, in rows:
+                        yield _project(_decode(doc), projection)
+            finally:
+                conn.close()
+        return _iter()
+
+    def update(
+            self,
+            filter: dict,
+            changes: dict,
+            db_name: str,
+            table_name: str,
+            upsert: bool = False) -> None:
+        """update applies changes to the first matching document.
+
+        The read, modify and write happen in one transaction.
+        """
+        table = self._ensure_table(db_name, table_name)
+        where, params = _where(filter)
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._writer.execute(
+                    f"SELECT _id, doc FROM {table} WHERE {where} LIMIT 1",
+                    params).fetchone()
+                if row is not None:
+                    doc = _apply_update(_decode(row[1]), changes, False)
+                    self._writer.execute(
+                        f"UPDATE {table} SET doc = ? WHERE _id = ?",
+                        (_encode(doc), row[0]))
+                elif upsert:
+                    doc = _apply_update(_upsert_base(filter), changes, True)
+                    self._insert_row(table, doc, None)
+            except Exception:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+
+    def delete(self, filter: dict, db_name: str, table_name: str) -> int:
+        table = self._ensure_table(db_name, table_name)
+        where, params = _where(filter)
+        with self._write_lock:
+            return self._writer.execute(
+                f"DELETE FROM {table} WHERE {where}", params).rowcount
+
+    def sync_indices(
+            self,
+            db_name: str,
+            table_name: str,
+            indices: list,
+            droppable: List[str] = None) -> None:
+        """sync_indices reconciles the table's indices with the specs.
+
+        Every key of a spec becomes a json_extract expression. Indices are
+        named "db_name.table_name.name", since the tables of several dbs
+        share the file, and matched by their SQL, an index whose SQL differs
+        from its spec is rebuilt.
+        """
+        table = self._ensure_table(db_name, table_name)
+        if droppable is not None:
+            droppable = {f'"{db_name}.{table_name}.{name}"' for name in droppable}
+        declared = {}
+        for spec in indices:
+            name = f'"{db_name}.{table_name}.{spec["name"]}"'
+            unique = "UNIQUE " if spec.get("options", {}).get("unique") else ""
+            keys = ", ".join(
+                f"{_path(k)} {'DESC' if d < 0 else 'ASC'}" for k, d in spec["keys"])
+            declared[name] = f"CREATE {unique}INDEX {name} ON {table} ({keys})"
+
+        with self._write_lock:
+            existing = {
+                f'"{name}"': sql for name, sql in self._writer.execute(
+                    "SELECT name, sql FROM sqlite_master "
+                    "WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                    (table.strip('"'),))}
+            for name, sql in existing.items():
+                if (name not in declared and droppable is not None
+                        and name not in droppable):
+                    continue
+                if declared.get(name) != sql:
+                    logger.info(f"Dropping stale index {table}.{name}")
+                    self._writer.execute(f"DROP INDEX {name}")
+            for name, sql in declared.items():
+                if existing.get(name) != sql:
+                    logger.info(f"Creating index {table}.{name}")
+                    self._writer.execute(sql)
+
+    def _delete_all(self, db_name: str, table_name: str) -> None:
+        """_delete_all deletes every row of a table. Only used in testing."""
+        table = self._ensure_table(db_name, table_name)
+        with self._write_lock:
+            self._writer.execute(f"DELETE FROM {table}")
+
+    def _drop_database(self, db_name: str) -> None:
+        """_drop_database drops every table of db_name."""
+        with self._write_lock:
+            tables = [name for name, in self._writer.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")
+                if name.startswith(f"{db_name}.")]
+            for name in tables:
+                self._writer.execute(f'DROP TABLE "{name}"')
+                self._tables.discard(f'"{name}"')
@@ -0,0 +1,199 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from bson import json_util
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, DESCENDING
+from telegram import Update, Message, Chat, User
+from store.db import TelegramStore, WriteBuffer
+from store.sqlite import SQLiteManager, _where
+
+TEST_USER_ID = 123
+TEST_USER_NAME = "ram"
+
+
+class TestSQLiteManager(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        self.dir = tempfile.TemporaryDirectory()
+        self.manager = SQLiteManager(os.path.join(self.dir.name, "test.sqlite3"))
+        self.ts = TelegramStore(self.manager, bot_name="test")
+        self.ts.wait_for_indices()
+
+    def tearDown(self):
+        self.ts.close()
+        self.dir.cleanup()
+
+    def _update(self, msg, update_id, user_id=TEST_USER_ID, date=None):
+        u = User(id=user_id, first_name=TEST_USER_NAME, is_bot=False)
+        return Update(
+            update_id=update_id,
+            message=Message(
+                message_id=update_id,
+                date=date or datetime.now(),
+                chat=Chat(id=user_id, type="private"),
+                text=msg,
+                from_user=u,
+            ),
+        )
+
+    def _metadata(self, update_id, price=None, timestamp=None):
+        metadata = {
+            "update_id": update_id,
+            "selection_path": f"{TEST_USER_ID}:/start:food:rice",
+            "timestamp": timestamp or datetime.now(),
+            "user_id": TEST_USER_ID,
+            "user_name": TEST_USER_NAME,
+        }
+        if price is not None:
+            metadata.update(
+                {"category": "food", "subcategory": "rice", "price_high": price})
+        return metadata
+
+    def test_updates(self):
+        now = datetime.now()
+        for i, msg in enumerate(["b", "a", "c"]):
+            self.ts.insert_update(
+                self._update(msg, i, date=now - timedelta(minutes=i)))
+        self.ts.insert_update(self._update("other", 10, user_id=999))
+        # A redelivered update is ignored.
+        self.ts.insert_update(self._update("b", 0))
+
+        updates = self.ts.get_updates({"message.from.id": TEST_USER_ID})
+        self.assertEqual(len(updates), 3)
+        streamed = self.ts.get_updates(
+            {"message.from.id": TEST_USER_ID}, limit=-1,
+            sort=[("message.date", ASCENDING)],
+            projection=TelegramStore.OM_SUMMARY)
+        self.assertEqual([u.message.text for u in streamed], ["c", "a", "b"])
+        self.assertEqual(
+            len(self.ts.get_updates({"message.text": {"$regex": "^oth"}})), 1)
+        self.assertEqual(len(self.ts.get_updates(limit=2)), 2)
+
+    async def test_metadata_and_rollups(self):
+        start = datetime(2024, 1, 1)
+        for i in range(3):
+            await self.ts.insert_metadata_async(self._metadata(
+                i, price=50, timestamp=start + timedelta(days=i)))
+        await self.ts.insert_metadata_async(self._metadata(0, price=50))
+
+        self.assertEqual(len(await self.ts.get_metadata_async(TEST_USER_ID)), 3)
+        rollups = self.ts.get_rollups(TEST_USER_ID)
+        self.assertEqual(rollups["category_totals"], {"food": 150})
+        self.assertEqual(rollups["start"], start)
+        self.assertEqual(rollups["end"], start + timedelta(days=2))
+        self.assertEqual(
+            len(self.ts.get_updates_by_metadata(TEST_USER_ID)), 0)
+
+    def test_filters(self):
+        t = datetime(2024, 1, 1)
+        docs = [{"k": i, "t": t + timedelta(hours=i), "s": f"v{i}"}
+                for i in range(5)]
+        docs.append({"k": None})
+        self.manager.insert_many(docs, "db", "table")
+
+        def keys(filter, sort=None):
+            return [d.get("k") for d in self.manager.iter_find(
+                filter, "db", "table", batch_size=2, sort=sort)]
+
+        self.assertEqual(keys({"k": {"$in": [1, 3]}}), [1, 3])
+        self.assertEqual(keys({"k": {"$in": [None, 4]}}), [4, None])
+        self.assertEqual(keys({"t": {"$gte": t + timedelta(hours=3)}}), [3, 4])
+        self.assertEqual(keys({"s": {"$exists": False}}), [None])
+        self.assertEqual(keys({"k": {"$gt": 2, "$lte": 3}}), [3])
+        self.assertEqual(
+            keys({"k": {"$exists": True}}, sort=[("t", DESCENDING)]),
+            [4, 3, 2, 1, 0])
+
+    def test_dates_compare_in_order(self):
+        t = datetime(2024, 1, 1, 0, 0, 5)
+        times = [t + timedelta(milliseconds=123), t,
+                 t - timedelta(milliseconds=1), t + timedelta(seconds=1)]
+        self.manager.insert_many(
+            [{"k": i, "t": v} for i, v in enumerate(times)], "db", "table")
+
+        def keys(filter, sort=None):
+            return [d["k"] for d in self.manager.iter_find(
+                filter, "db", "table", sort=sort)]
+
+        self.assertEqual(keys({}, sort=[("t", ASCENDING)]), [2, 1, 0, 3])
+        self.assertEqual(
+            keys({"t": {"$gte": t, "$lt": t + timedelta(seconds=1)}},
+                 sort=[("t", ASCENDING)]), [1, 0])
+        self.assertEqual(keys({"t": {"$gt": t}}, sort=[("t", ASCENDING)]),
+                         [0, 3])
+        self.assertEqual(
+            self.manager.find({"k": 0}, 1, "db", "table")[0]["t"], times[0])
+
+    def test_upgrade_reencodes_dates(self):
+        path = os.path.join(self.dir.name, "old.sqlite3")
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE "db.table" (_id TEXT PRIMARY KEY, doc TEXT)')
+        for i, t in enumerate([datetime(2024, 1, 1, 0, 0, 5, 123000),
+                               datetime(2024, 1, 1, 0, 0, 5)]):
+            conn.execute('INSERT INTO "db.table" VALUES (?, ?)',
+                         (str(i), json_util.dumps({"_id": str(i), "t": t})))
+        conn.commit()
+        conn.close()
+
+        manager = SQLiteManager(path)
+        self.assertEqual(
+            [d["_id"] for d in manager.iter_find(
+                {}, "db", "table", sort=[("t", ASCENDING)])], ["1", "0"])
+
+    def test_in_memory(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        ts = TelegramStore(SQLiteManager(":memory:"), bot_name="memory")
+        ts.wait_for_indices()
+        for i, msg in enumerate(["a", "b"]):
+            ts.insert_update(self._update(msg, i))
+        self.assertEqual(len(ts.get_updates()), 2)
+        self.assertEqual(
+            [u.message.text for u in ts.get_updates(
+                limit=-1, sort=[("update_id", ASCENDING)])], ["a", "b"])
+
+    def test_indices_of_several_dbs(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        other = TelegramStore(self.manager, bot_name="other")
+        other.wait_for_indices()
+        names = {name for name, in self.manager._connect().execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' "
+            "AND name LIKE '%.updates.update_id'")}
+        self.assertEqual(names, {f"{self.ts.db_name}.updates.update_id",
+                                 f"{other.db_name}.updates.update_id"})
+
+    def test_queries_use_indices(self):
+        for filter, table in [
+                ({"user_id": 1}, "metadata"),
+                ({"update_id": {"$in": [1, 2]}}, "updates"),
+                ({"message.from.id": 1}, "updates")]:
+            where, params = _where(filter)
+            # A fresh connection, EXPLAIN doesn't reload a schema cached
+            # before the indices were created.
+            plan = self.manager._connect().execute(
+                f"EXPLAIN QUERY PLAN SELECT doc FROM "
+                f"{self.manager._table(self.ts.db_name, table)} WHERE {where}",
+                params).fetchall()
+            self.assertIn("USING INDEX", plan[0][-1])
+
+    def test_write_buffer(self):
+        TelegramStore._instance = None
+        TelegramStore._db_manager = None
+        ts = TelegramStore(
+            self.manager, bot_name="buffered",
+            write_buffer=WriteBuffer(self.manager, max_size=10, max_delay=60))
+        for i in range(3):
+            ts.insert_metadata(self._metadata(i))
+        self.assertEqual(len(ts.get_metadata(TEST_USER_ID)), 3)
+        ts.close()
+        self.assertEqual(len(self.manager.find(
+            {}, 0, ts.db_name, ts.metadata_table_name)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
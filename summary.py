@@ -12,13 +12,13 @@ reportlab to support Devanagari.
 """
 from fpdf import FPDF
 from typing import Any, Dict
-from constants import LABELS, TEST_SUMMARY, SUMMARY_PATTERN, CATEGORY_PATTERN, TEMPLATE_PATH, ALLOWED_CHARS, UNKNOWN
+from constants import LABELS, TEST_SUMMARY, SUMMARY_PATTERN, CATEGORY_PATTERN, TEMPLATE_PATH, ALLOWED_CHARS, UNKNOWN, PRICE_PATTERN
 import PyPDF2
 from pdfrw import PdfReader, PdfWriter, PageMerge
 import re
 import logging
 from collections import defaultdict
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable
 from datetime import datetime, date
 from io import BytesIO
 from telegram import Update
@@ -331,16 +331,25 @@ class Summary:
         return BytesIO(pdf_string)
 
 
-def updates_to_summary(updates: List[Update]) -> Summary:
+def updates_to_summary(
+        updates: Iterable[Update], presorted: bool = False) -> Summary:
     """Generates a summary object describing the given list of updates.
 
     Arguments:
-        updates: a list of telegram.ext update objects retrieved from the db.
+        updates: telegram.ext update objects retrieved from the db. This can
+            be a generator, eg TelegramStore.get_updates(limit=-1), in which
+            case it is consumed in a single pass.
+        presorted: set if the updates are already sorted by message date, so
+            they don't have to be collected into a list and sorted here.
 
     Return: 
         str: summary string 
+
+    Raises:
+        ValueError: if there are no updates.
     """
-    updates = _sort_updates_by_date(updates)
+    if not presorted:
+        updates = _sort_updates_by_date(updates)
 
     # category_totals eg:
     # {"Groceries": 100, "Transport": 10...}
@@ -352,8 +361,13 @@ def updates_to_summary(updates: List[Update]) -> Summary:
 
     current_category = ""
     current_description = UNKNOWN
+    first, last = None, None
 
     for update in updates:
+        if first is None:
+            first = update
+        last = update
+
         message_text = update.message.text.strip().lower()
         if (message_text == _get_label("start") or
                 message_text == _get_label("summary")):
@@ -372,10 +386,13 @@ def updates_to_summary(updates: List[Update]) -> Summary:
             if message_text != _get_label("cost"):
                 current_description = message_text
 
+    if first is None:
+        raise ValueError("Empty updates list provided")
+
     return Summary(
-        updates[0].message.from_user.name,
-        _fmt_date(updates[0].message.date),
-        _fmt_date(updates[-1].message.date),
+        first.message.from_user.name,
+        _fmt_date(first.message.date),
+        _fmt_date(last.message.date),
         category_totals,
         description_totals)
 
@@ -383,6 +400,19 @@ def updates_to_summary(updates: List[Update]) -> Summary:
 def metadata_to_summary(metadata: list[dict]) -> Summary:
     """Creates a summary object from the given metadata.
 
+    See metadata_to_totals for how the metadata is interpreted.
+    """
+    return totals_to_summary(metadata_to_totals(metadata))
+
+
+def metadata_to_totals(metadata: list[dict]) -> dict:
+    """Computes the spending totals of the given metadata in python.
+
+    This is the reference implementation of
+    TelegramStore.get_metadata_summary, which does the same work in a mongo
+    aggregation. It is used as a fallback for db managers that can't
+    aggregate, and to cross-check the pipeline in tests.
+
     Args:
         metadata: a list of dicts with the metadata. Eg:
         [
@@ -410,11 +440,10 @@ def metadata_to_summary(metadata: list[dict]) -> Summary:
         ]
 
     Returns:
-        Summary: a summary object. The fields of the summary are set as
-        follows:
+        dict: the totals in the shape that totals_to_summary takes:
         - user_name: the user name from the first metadata entry.
-        - start_date: the timestamp of the earliest metadata entry.
-        - end_date: the timestamp of the latest metadata entry.
+        - start: the timestamp of the earliest metadata entry.
+        - end: the timestamp of the latest metadata entry.
         - category_totals: a dict with the category totals, eg:
             {"food": 100, "fuel": 200}
         - description_totals: a dict with the description totals, eg:
@@ -450,8 +479,8 @@ def metadata_to_summary(metadata: list[dict]) -> Summary:
 
     # Get user info and dates from first/last entries
     user_name = sorted_metadata[0]['user_name']
-    start_date = _fmt_date(sorted_metadata[0]['timestamp'])
-    end_date = _fmt_date(sorted_metadata[-1]['timestamp'])
+    start = sorted_metadata[0]['timestamp']
+    end = sorted_metadata[-1]['timestamp']
 
     for entry in sorted_metadata:
         path_elements = entry['selection_path'].split(':')
@@ -464,22 +493,11 @@ def metadata_to_summary(metadata: list[dict]) -> Summary:
         # Get the last element (potential cost)
         last_element = path_elements[-1]
 
-        # Check if it contains a cost
-        # In both ValueError cases we conclude that the last element is not a
-        # cost and ignore this metadata entry.
-        cost = None
-        if '-' in last_element:
-            # Take the higher number for range selections
-            try:
-                cost = max(int(x) for x in last_element.split('-'))
-            except ValueError:
-
-                continue
-        else:
-            try:
-                cost = int(last_element)
-            except ValueError:
-                continue
+        # Check if it contains a cost, otherwise ignore this metadata entry.
+        if not re.fullmatch(PRICE_PATTERN, last_element):
+            continue
+        # Take the higher number for range selections
+        cost = max(int(x) for x in last_element.split('-'))
 
         # With a valid cost entry, we can work backwards:
         #   * Category is the third element (index 2)
@@ -498,6 +516,38 @@ def metadata_to_summary(metadata: list[dict]) -> Summary:
     logging.info(f"Category Totals: {category_totals}")
     logging.info(f"Description Totals: {description_totals}")
 
+    return {
+        "user_name": user_name,
+        "start": start,
+        "end": end,
+        "category_totals": dict(category_totals),
+        "description_totals": {
+            k: dict(v) for k, v in description_totals.items()},
+    }
+
+
+def totals_to_summary(totals: dict) -> Summary:
+    """Creates a summary object from a user's spending totals.
+
+    Args:
+        totals: the totals returned by metadata_to_totals,
+        TelegramStore.get_metadata_summary or TelegramStore.get_rollups, eg:
+        {
+            "user_name": "redpig",
+            "start": datetime(2025, 1, 16, 15, 18),
+            "end": datetime(2025, 1, 18, 9, 2),
+            "category_totals": {"food": 150},
+            "description_totals": {"food": {"rice": 100, "wheat": 50}},
+        }
+
+    Returns:
+        Summary: a summary with translated category and description names.
+        Note that for rollups the dates span the first and last priced
+        entry, rather than all of the user's metadata.
+    """
+    category_totals = totals["category_totals"]
+    description_totals = totals["description_totals"]
+
     # TODO(prashanth@): Add language to the summary instead of inlining it
     # here. Key off-of the language kwarg already given to set font-family.
     # It is done here currently just so we don't disrupt the OM flow.
@@ -506,9 +556,9 @@ def metadata_to_summary(metadata: list[dict]) -> Summary:
     # issues supporting Gargi font and NotoDevanagari doesn't work with fpdf.
     # We need to use reportlab to support Devanagari.
     return Summary(
-        user_name=user_name,
-        start_date=start_date,
-        end_date=end_date,
+        user_name=totals["user_name"],
+        start_date=_fmt_date(totals["start"]),
+        end_date=_fmt_date(totals["end"]),
         category_totals={
             get_button_text(k, language=LANGUAGE): v
             for k, v in category_totals.items()
@@ -524,17 +574,29 @@ def metadata_to_summary(metadata: list[dict]) -> Summary:
     )
 
 
-def create_summary(updates: list[Update], metadata: list[dict]) -> BytesIO:
+def create_summary(
+        updates: Iterable[Update],
+        metadata: list[dict],
+        presorted: bool = False,
+        totals: dict = None) -> BytesIO:
     """Creates a temp pdf file with a summary of the given updates. 
 
     Args: 
         updates: usually telegram bot updates of a single user. 
+        presorted: see updates_to_summary.
+        totals: optional, a user's spending totals (see totals_to_summary).
+            If given, updates and metadata must be empty.
 
     Returns: 
         BytesIO: A temp buffer with the file contents. 
     """
-    if updates and not metadata:
-        summary = updates_to_summary(updates)
+    if totals is not None:
+        if updates or metadata:
+            raise ValueError(
+                "Totals provided with updates or metadata. Only one is allowed.")
+        summary = totals_to_summary(totals)
+    elif updates and not metadata:
+        summary = updates_to_summary(updates, presorted=presorted)
     elif metadata and not updates:
         summary = metadata_to_summary(metadata)
     elif updates and metadata:
@@ -1,6 +1,6 @@
 import unittest
 from telegram import Update, Message, User, Chat
-from summary import create_summary, Summary
+from summary import create_summary, updates_to_summary, Summary
 from datetime import datetime
 from constants import INDIA_TZ, LABELS
 from pytz import timezone
@@ -92,6 +92,19 @@ class TestSummary(unittest.IsolatedAsyncioTestCase):
             for assertion in test_case.assertions:
                 assert assertion(json_summary)
 
+    def test_updates_to_summary_streaming(self):
+        """A presorted generator is summarized in a single pass."""
+        messages = [LABELS["start"], LABELS["c1"], "20", LABELS["c1"], "5"]
+        summary = updates_to_summary(
+            (self._update(m) for m in messages), presorted=True)
+        self.assertEqual(summary.category_totals[_label("c1")], 25)
+        with self.assertRaises(ValueError):
+            updates_to_summary(iter([]), presorted=True)
+
+
+def _label(key):
+    return LABELS[key].lower()
+
 
 if __name__ == '__main__':
     unittest.main()
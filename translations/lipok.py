@@ -155,6 +155,8 @@ TRANSLATIONS_MARATHI = {
 
 # TODO(prashanth@): Make this dynamic. Pipe it from the cmdline.
 LANGUAGE = "mr"
+# Every language get_button_text translates to.
+LANGUAGES = ("en", "mr")
 
 
 def get_button_text(key: str, language: str = LANGUAGE) -> str: